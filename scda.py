@@ -13,30 +13,94 @@ import datetime
 import textwrap
 import csv
 import numpy as np
-import scipy.ndimage.interpolation
-import scipy.special
 import pdb
 import getpass
 import socket
 import itertools
 import pprint
 import pickle
+import subprocess
+import time
+import math
+import hashlib
+import re
+import json
+import zipfile
+import multiprocessing
+import importlib
+import functools
+try:
+    import resource # memory high-water mark, not available on Windows
+except ImportError:
+    resource = None
 try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
-import pyfits
-import matplotlib
-matplotlib.use('Agg') # non-interactive
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-import matplotlib.patches
-matplotlib.rcParams['image.origin'] = 'lower'
-matplotlib.rcParams['image.interpolation'] = 'nearest'
-matplotlib.rcParams['image.cmap'] = 'gray'
-matplotlib.rcParams['axes.linewidth'] = 1.
-matplotlib.rcParams['lines.linewidth'] = 2.5
-matplotlib.rcParams['font.size'] = 12
+
+class _LazyModule(object):
+    # Stand-in for a heavy module that is imported on first attribute access. Survey construction, state loading
+    # and AMPL/SLURM script writing never touch SciPy, FITS or plotting, so the cron queue filler and short status
+    # scripts don't pay for loading them.
+    def __init__(self, name, loader=None):
+        self.__dict__['_name'] = name
+        self.__dict__['_loader'] = loader
+        self.__dict__['_module'] = None
+    def _load(self):
+        if self.__dict__['_module'] is None:
+            if self.__dict__['_loader'] is not None:
+                self.__dict__['_module'] = self.__dict__['_loader']()
+            else:
+                self.__dict__['_module'] = importlib.import_module(self.__dict__['_name'])
+        return self.__dict__['_module']
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+    def __setattr__(self, attr, val):
+        setattr(self._load(), attr, val)
+    def __repr__(self):
+        if self.__dict__['_module'] is None:
+            return "<lazy module '{:s}' (not loaded)>".format(self.__dict__['_name'])
+        return repr(self.__dict__['_module'])
+
+def _load_matplotlib():
+    import matplotlib
+    if 'matplotlib.pyplot' not in sys.modules:
+        matplotlib.use('Agg') # non-interactive
+    import matplotlib.pyplot
+    import matplotlib.gridspec
+    import matplotlib.patches
+    matplotlib.rcParams['image.origin'] = 'lower'
+    matplotlib.rcParams['image.interpolation'] = 'nearest'
+    matplotlib.rcParams['image.cmap'] = 'gray'
+    matplotlib.rcParams['axes.linewidth'] = 1.
+    matplotlib.rcParams['lines.linewidth'] = 2.5
+    matplotlib.rcParams['font.size'] = 12
+    return matplotlib
+
+def _load_scipy():
+    import scipy.ndimage.interpolation
+    import scipy.special
+    return sys.modules['scipy']
+
+matplotlib = _LazyModule('matplotlib', _load_matplotlib)
+plt = _LazyModule('matplotlib.pyplot', lambda: matplotlib._load().pyplot)
+gridspec = _LazyModule('matplotlib.gridspec', lambda: matplotlib._load().gridspec)
+scipy = _LazyModule('scipy', _load_scipy)
+pyfits = _LazyModule('pyfits')
+
+def get_import_time(module_name='scda', Nrep=5, preload=()):
+    # Cold-start cost of importing a module, in seconds: the best of Nrep fresh interpreters, each timing the
+    # import plus any attributes in preload (e.g. 'pyfits.HDUList', 'plt.figure') so the lazily loaded modules
+    # can be timed too. Only the import is timed, not the interpreter start-up.
+    preload_stmt = "".join(["; {:s}.{:s}".format(module_name, attr) for attr in preload])
+    timer_code = "import time; t0 = time.time(); import {:s}{:s}; print(time.time() - t0)".format(module_name, preload_stmt)
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    import_time_vec = []
+    for ri in range(Nrep):
+        import_time_vec.append(float(subprocess.check_output([sys.executable, '-c', timer_code], cwd=cwd).split()[-1]))
+    logging.info("Import time of {:s}{:s}: {:.3f} s (best of {:d})".format(
+                 module_name, " + " + ", ".join(preload) if len(preload) else "", min(import_time_vec), Nrep))
+    return min(import_time_vec)
 
 def configure_log(log_fname=None):
 #    logger = logging.getLogger("scda.logger")
@@ -159,9 +223,966 @@ def merge_design_param_surveys(survey_list, merged_survey_fname=None):
     ID_fmt_str = "{{:s}}-{{:0{:d}d}}".format(num_ID_digits)
     for idx, coron in enumerate(merged_survey.coron_list): # overwrite design IDs in coron_list
         coron.fileorg['design ID'] = ID_fmt_str.format(merged_survey_name, idx)
-    
+
     return merged_survey
 
+def get_design_params(coron):
+    # Copy of the settable design parameters of a coronagraph, leaving out the
+    # fields derived in the constructor (e.g. 'Nimg', 'bw+', 's'), so that
+    # the dictionary can be handed back to a coronagraph constructor.
+    design = {}
+    for keycat in coron._design_fields:
+        design[keycat] = {}
+        for param in coron._design_fields[keycat]:
+            if param in coron.design[keycat]:
+                design[keycat][param] = coron.design[keycat][param]
+    return design
+
+def make_proxy_coron(coron, proxy_dir, proxy_label, design_mods=None, solver=None):
+    # Build a reduced-size stand-in for a coronagraph design, with its AMPL program,
+    # solution and log written to proxy_dir. The masks are drawn from the same
+    # directories as the original design. design_mods is a dictionary of parameter
+    # overrides keyed by category, e.g. {'Pupil': {'N': 50}, 'Image': {'Nlam': 2}}.
+    design = get_design_params(coron)
+    if design_mods is not None:
+        for keycat, mods in design_mods.items():
+            for param, value in mods.items():
+                if param in design[keycat]:
+                    design[keycat][param] = value
+    if solver is None:
+        solver = coron.solver
+    proxy_fileorg = {'work dir': proxy_dir, 'ampl src dir': proxy_dir, 'sol dir': proxy_dir, 'log dir': proxy_dir,
+                     'slurm dir': proxy_dir, 'eval dir': proxy_dir, 'job name': proxy_label,
+                     'ampl src fname': os.path.join(proxy_dir, proxy_label + ".mod"),
+                     'sol fname': os.path.join(proxy_dir, "ApodSol_" + proxy_label + ".dat"),
+                     'log fname': os.path.join(proxy_dir, proxy_label + ".log")}
+    for namekey in ['TelAp dir', 'FPM dir', 'LS dir']:
+        if namekey in coron.fileorg:
+            proxy_fileorg[namekey] = coron.fileorg[namekey]
+    return coron.__class__(design=design, fileorg=proxy_fileorg, solver=solver)
+
+def parse_ampl_log(log_fname):
+    # Extract the solver time (hours), the AMPL solve result and the objective value from an optimization log
+    log_info = {'time': None, 'result': None, 'objective': None}
+    if not os.path.exists(log_fname):
+        return log_info
+    log = open(log_fname)
+    lines = log.readlines()
+    log.close()
+    for line in lines:
+        if log_info['time'] is None and 'iterations' in line and 'seconds' in line:
+            split_line = line.split()
+            try:
+                log_info['time'] = float(split_line[split_line.index('seconds')-1])/3600
+            except ValueError:
+                pass
+        elif line.startswith('solve_result ='):
+            log_info['result'] = line.split('=')[-1].strip()
+        elif 'objective' in line and ';' in line: # e.g. "Gurobi 6.5.0: optimal solution; objective 0.4512"
+            try:
+                log_info['objective'] = float(line.split()[-1])
+            except ValueError:
+                pass
+    return log_info
+
+def _run_ampl_job(job):
+    # Worker for the local process pool: run one AMPL program and summarize its log
+    ampl_cmd, ampl_src_fname, log_fname = job
+    t0 = time.time()
+    try:
+        log_fobj = open(log_fname, "w")
+        retcode = subprocess.call([ampl_cmd, ampl_src_fname], stdout=log_fobj, stderr=subprocess.STDOUT)
+        log_fobj.close()
+    except OSError:
+        retcode = None
+    log_info = parse_ampl_log(log_fname)
+    log_info['walltime'] = (time.time() - t0)/3600
+    if log_info['time'] is None:
+        log_info['time'] = log_info['walltime']
+    log_info['retcode'] = retcode
+    return log_info
+
+def run_ampl_jobs(job_list, Nproc=None):
+    # Run a list of (ampl_cmd, ampl_src_fname, log_fname) jobs on a local process pool
+    if len(job_list) == 0:
+        return []
+    if Nproc == 1:
+        return [_run_ampl_job(job) for job in job_list]
+    pool = multiprocessing.Pool(processes=Nproc)
+    try:
+        results = pool.map(_run_ampl_job, job_list, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def get_solver_grid(base_solver=None, methods=('bar', 'barhom', 'dualsimp'), presolve_opts=(True, False),
+                    crossover_opts=(None, True), convtol_opts=(None,)):
+    # List of distinct solver option dictionaries to try in autotune_survey_solver().
+    # Crossover and convergence tolerance only apply to the barrier methods.
+    if base_solver is None:
+        base_solver = {}
+    solver_grid = []
+    for method, presolve, crossover, convtol in itertools.product(methods, presolve_opts, crossover_opts, convtol_opts):
+        solver = dict(base_solver)
+        solver['method'] = method
+        solver['presolve'] = presolve
+        if method == 'dualsimp':
+            solver['crossover'] = None
+            solver['convtol'] = None
+        else:
+            solver['crossover'] = crossover
+            solver['convtol'] = convtol
+        if solver not in solver_grid:
+            solver_grid.append(solver)
+    return solver_grid
+
+def fit_solver_time_scaling(N_vec, Nlam_vec, time_vec):
+    # Power-law fit of solver time, log(t) = a + p*log(N) + q*log(Nlam).
+    # Exponents that cannot be constrained by the samples fall back on the
+    # scaling assumed by the queue time estimates, t ~ N^2 * Nlam^3.
+    logN = np.log(np.array(N_vec, dtype=float))
+    logNlam = np.log(np.array(Nlam_vec, dtype=float))
+    logt = np.log(np.array(time_vec, dtype=float))
+    p = 2.
+    q = 3.
+    cols = [np.ones_like(logt)]
+    fit_p = len(set(N_vec)) > 1
+    fit_q = len(set(Nlam_vec)) > 1
+    if fit_p:
+        cols.append(logN)
+    else:
+        logt = logt - p*logN
+    if fit_q:
+        cols.append(logNlam)
+    else:
+        logt = logt - q*logNlam
+    coeffs = np.linalg.lstsq(np.array(cols).T, logt, rcond=-1)[0]
+    a = coeffs[0]
+    if fit_p:
+        p = coeffs[1]
+    if fit_q:
+        q = coeffs[-1]
+    return a, p, q
+
+def autotune_survey_solver(survey, N_rep=3, proxy_N_vec=(50, 100), proxy_Nlam_vec=(2, 3), solver_grid=None,
+                           autotune_dir=None, ampl_cmd='ampl', Nproc=None, apply_solver=True):
+    # Pick the solver options for a survey by timing reduced-size proxies of a few
+    # representative designs under a grid of solver settings on a local process pool,
+    # and extrapolating the timing to the full-size designs. Proxies need input masks
+    # at the reduced array sizes in the survey's mask directories.
+    if solver_grid is None:
+        solver_grid = get_solver_grid(base_solver=survey.solver)
+    if autotune_dir is None:
+        autotune_dir = os.path.join(survey.fileorg['work dir'], 'autotune')
+    if not os.path.exists(autotune_dir):
+        os.makedirs(autotune_dir)
+    rep_inds = sorted(set(np.round(np.linspace(0, survey.N_combos-1, min(N_rep, survey.N_combos))).astype(int)))
+
+    job_list = []
+    job_meta = []
+    for ri in rep_inds:
+        coron = survey.coron_list[ri]
+        for si, solver in enumerate(solver_grid):
+            for N_proxy, Nlam_proxy in itertools.product(proxy_N_vec, proxy_Nlam_vec):
+                design_mods = {'Pupil': {'N': N_proxy}, 'Image': {'Nlam': Nlam_proxy}}
+                if 'N' in coron.design['LS']: # SPLC has separate Lyot plane sampling
+                    design_mods['LS'] = {'N': N_proxy}
+                proxy_label = "autotune_rep{0:03d}_solver{1:02d}_N{2:04d}_Nlam{3:02d}".format(ri, si, N_proxy, Nlam_proxy)
+                proxy = make_proxy_coron(coron, autotune_dir, proxy_label, design_mods=design_mods, solver=solver)
+                if proxy.write_ampl(overwrite=True, verbose=False) != 0:
+                    logging.warning("Skipping autotune proxy {:s}, missing input files".format(proxy_label))
+                    continue
+                job_list.append((ampl_cmd, proxy.fileorg['ampl src fname'], proxy.fileorg['log fname']))
+                job_meta.append((ri, si, proxy.design['Pupil']['N'], proxy.design['Image']['Nlam']))
+    logging.info("Running {0:d} autotune proxy optimizations for {1:d} representative designs and {2:d} solver settings".format(
+                 len(job_list), len(rep_inds), len(solver_grid)))
+    results = run_ampl_jobs(job_list, Nproc=Nproc)
+
+    report = []
+    for si, solver in enumerate(solver_grid):
+        pred_time = 0.
+        for ri in rep_inds:
+            coron = survey.coron_list[ri]
+            samples = [(N, Nlam, res['time']) for (rj, sj, N, Nlam), res in zip(job_meta, results)
+                       if rj == ri and sj == si and res['result'] == 'solved' and res['time'] > 0]
+            if len(samples) == 0:
+                pred_time = np.inf
+                break
+            a, p, q = fit_solver_time_scaling(*zip(*samples))
+            pred_time += np.exp(a + p*np.log(coron.design['Pupil']['N']) + q*np.log(coron.design['Image']['Nlam']))
+        report.append({'solver': solver, 'pred time': pred_time})
+    report.sort(key=lambda entry: entry['pred time'])
+
+    for entry in report:
+        logging.info("Predicted solver time {0:.2f} h summed over representative designs for {1}".format(entry['pred time'], entry['solver']))
+    if not np.isfinite(report[0]['pred time']):
+        logging.warning("None of the solver settings solved all the autotune proxies; survey solver left unchanged")
+        return None, report
+    best_solver = report[0]['solver']
+    if apply_solver:
+        survey.set_solver(best_solver)
+    return best_solver, report
+
+def get_zernike_basis(noll_inds, xs):
+    # Zernike polynomials in Noll order on the square grid xs x xs, normalized to unit RMS over the
+    # unit diameter circle (D = 1) and zero outside it
+    XX, YY = np.meshgrid(np.asarray(xs).ravel(), np.asarray(xs).ravel())
+    rr = np.sqrt(XX**2 + YY**2)/0.5
+    theta = np.arctan2(YY, XX)
+    basis = np.zeros((len(noll_inds),) + rr.shape)
+    for zi, j in enumerate(noll_inds):
+        n = 0
+        j1 = j - 1
+        while j1 > n:
+            n += 1
+            j1 -= n
+        m = (-1)**j*((n % 2) + 2*int((j1 + ((n + 1) % 2))/2))
+        R = np.zeros(rr.shape)
+        for k in range((n - abs(m))//2 + 1):
+            R += (-1)**k*math.factorial(n - k)/(math.factorial(k)*math.factorial((n + abs(m))//2 - k)*
+                                                math.factorial((n - abs(m))//2 - k))*rr**(n - 2*k)
+        if m == 0:
+            basis[zi] = np.sqrt(n + 1)*R
+        elif m > 0:
+            basis[zi] = np.sqrt(2*(n + 1))*R*np.cos(m*theta)
+        else:
+            basis[zi] = np.sqrt(2*(n + 1))*R*np.sin(-m*theta)
+    basis[:, rr > 1] = 0
+    return basis
+
+file_checksum_cache = {}
+
+def get_file_checksum(fname):
+    # MD5 checksum of a file, cached as long as its size and modification time are unchanged
+    fname = os.path.abspath(fname)
+    fstat = os.stat(fname)
+    cache_key = (fname, fstat.st_size, fstat.st_mtime)
+    if cache_key not in file_checksum_cache:
+        md5 = hashlib.md5()
+        fobj = open(fname, 'rb')
+        for chunk in iter(lambda: fobj.read(1 << 20), b''):
+            md5.update(chunk)
+        fobj.close()
+        file_checksum_cache[cache_key] = md5.hexdigest()
+    return file_checksum_cache[cache_key]
+
+def get_binary_sol_fname(sol_fname):
+    return os.path.splitext(sol_fname)[0] + '.npz'
+
+def _get_column_pattern(col):
+    # (values, repeat, tile) such that col == np.tile(np.repeat(values, repeat), tile), e.g. a coordinate column
+    # of a solution on a regular grid, or None
+    n_pts = len(col)
+    repeat = 1
+    while repeat < n_pts and col[repeat] == col[0]:
+        repeat += 1
+    period_end = repeat
+    while period_end < n_pts and col[period_end] != col[0]:
+        period_end += 1
+    if n_pts % period_end != 0:
+        return None
+    values = col[:period_end:repeat]
+    if np.array_equal(np.tile(np.repeat(values, repeat), n_pts//period_end), col):
+        return values, repeat, n_pts//period_end
+    return None
+
+def binary_solution_is_current(sol_fname):
+    # Whether the binary copy of a text solution exists and was converted from the text file as it is now
+    bin_fname = get_binary_sol_fname(sol_fname)
+    if not os.path.exists(bin_fname):
+        return False
+    if not os.path.exists(sol_fname):
+        return True
+    sol_stat = os.stat(sol_fname)
+    bin_data = np.load(bin_fname)
+    current = bin_data['source_size'] == sol_stat.st_size and bin_data['source_mtime'] == sol_stat.st_mtime
+    bin_data.close()
+    return bool(current)
+
+def write_binary_solution(sol_fname, bin_fname=None, precision='double', pack_tol=0.):
+    # Convert a text solution printed by AMPL (coordinate columns and the apodizer in the last column) to the
+    # compact binary format read by load_solution(). Coordinate columns on a regular grid are kept as grid
+    # metadata, and the apodizer as a float64 or float32 array. With pack_tol not None, the apodizer pixels
+    # within pack_tol of 0 or 1 are bit-packed, and only the gray residual pixels are kept as values.
+    # Returns the binary file name.
+    if bin_fname is None:
+        bin_fname = get_binary_sol_fname(sol_fname)
+    sol_stat = os.stat(sol_fname)
+    sol = np.loadtxt(sol_fname, ndmin=2)
+    dtype = np.float32 if precision == 'single' else np.float64
+    content = {'version': 1, 'n_pts': sol.shape[0], 'n_cols': sol.shape[1],
+               'source_size': sol_stat.st_size, 'source_mtime': sol_stat.st_mtime}
+    for ci in range(sol.shape[1] - 1):
+        pattern = _get_column_pattern(sol[:,ci])
+        if pattern is not None:
+            content['col{:d}_values'.format(ci)], content['col{:d}_repeat'.format(ci)], content['col{:d}_tile'.format(ci)] = pattern
+        else:
+            content['col{:d}'.format(ci)] = sol[:,ci]
+    A = sol[:,-1]
+    if pack_tol is not None:
+        A_round = np.round(A)
+        binary_mask = (np.abs(A - A_round) <= pack_tol) & ((A_round == 0) | (A_round == 1))
+        content['apod_bits'] = np.packbits(A_round == 1)
+        content['apod_gray_index'] = np.flatnonzero(~binary_mask).astype(np.uint32)
+        content['apod_gray_values'] = A[~binary_mask].astype(dtype)
+    else:
+        content['apod'] = A.astype(dtype)
+    tmp_fname = bin_fname[:-4] + ".{:d}.npz".format(os.getpid())
+    np.savez(tmp_fname, **content)
+    os.rename(tmp_fname, bin_fname)
+    return bin_fname
+
+def load_solution(sol_fname):
+    # Solution array with the same columns as the AMPL text file, read from its binary copy if that is current,
+    # and from the text file otherwise
+    bin_fname = get_binary_sol_fname(sol_fname)
+    if os.path.exists(bin_fname):
+        try:
+            if not binary_solution_is_current(sol_fname):
+                return np.loadtxt(sol_fname, ndmin=2)
+            bin_data = np.load(bin_fname)
+            n_pts = int(bin_data['n_pts'])
+            sol = np.empty((n_pts, int(bin_data['n_cols'])))
+            for ci in range(sol.shape[1] - 1):
+                if 'col{:d}'.format(ci) in bin_data.files:
+                    sol[:,ci] = bin_data['col{:d}'.format(ci)]
+                else:
+                    sol[:,ci] = np.tile(np.repeat(bin_data['col{:d}_values'.format(ci)], int(bin_data['col{:d}_repeat'.format(ci)])),
+                                        int(bin_data['col{:d}_tile'.format(ci)]))
+            if 'apod' in bin_data.files:
+                sol[:,-1] = bin_data['apod']
+            else:
+                sol[:,-1] = np.unpackbits(bin_data['apod_bits'])[:n_pts]
+                sol[bin_data['apod_gray_index'],-1] = bin_data['apod_gray_values']
+            bin_data.close()
+            return sol
+        except (IOError, KeyError, ValueError):
+            logging.warning("Could not read the binary solution {:s}, reading the text file".format(bin_fname))
+    return np.loadtxt(sol_fname, ndmin=2)
+
+telap_ref_psf_cache = {}
+
+def get_telap_ref_psf(TelAp_fname, TelAp, xs, dx, xis, wrs, precision='double', cache_dir=None):
+    # Band-averaged PSF of the clear telescope aperture on the image plane grid xis, and its band-averaged peak,
+    # for the throughput metrics. TelAp is the full aperture array built from the file TelAp_fname. Every design
+    # of a survey that shares the aperture file, the grids and the wavelengths shares one reference, which is
+    # kept in memory and, if cache_dir is given, in a file there keyed by the aperture checksum and the grids.
+    # The file is written under a temporary name and renamed, and an unreadable one is recomputed and replaced.
+    xs = np.asarray(xs, dtype=float).ravel()
+    xis = np.asarray(xis, dtype=float).ravel()
+    wrs = np.asarray(wrs, dtype=float).ravel()
+    ref_key_str = "{0:s} {1:s} {2:d} {3:.12g} {4:d} {5:.12g} {6:.12g} {7:s} {8:s}".format(
+                  get_file_checksum(TelAp_fname), TelAp.shape, len(xs), dx, len(xis), xis[0], xis[-1],
+                  " ".join(["{:.12g}".format(wr) for wr in wrs]), precision)
+    ref_key = hashlib.md5(ref_key_str.encode('utf-8')).hexdigest()
+    ref_fname = None
+    if cache_dir is not None:
+        ref_fname = os.path.join(cache_dir, "TelAp_refpsf_{:s}.npz".format(ref_key))
+    ref_stored = ref_fname is not None and os.path.exists(ref_fname)
+    if ref_key not in telap_ref_psf_cache and ref_stored:
+        try:
+            ref_data = np.load(ref_fname)
+            telap_ref_psf_cache[ref_key] = (ref_data['intens'], float(ref_data['peak']))
+            ref_data.close()
+        except (IOError, OSError, ValueError, KeyError, zipfile.BadZipfile) as err:
+            logging.warning("Could not read the telescope reference PSF from {0:s}, recomputing it: {1:s}".format(ref_fname, str(err)))
+            ref_stored = False
+    if ref_key not in telap_ref_psf_cache:
+        core = PropagationCore(wrs, precision=precision)
+        Psi_TelAp = core.mft(TelAp, xs, xis, dx, 'TelAp')
+        intens_TelAp = np.mean(core.intensity(Psi_TelAp, 'I_TelAp'), axis=0)
+        intens_TelAp_peak = np.mean((np.sum(TelAp)*dx*dx/core.wrs)**2)
+        telap_ref_psf_cache[ref_key] = (intens_TelAp, intens_TelAp_peak)
+    if ref_fname is not None and not ref_stored:
+        try:
+            tmp_fname = ref_fname[:-4] + ".{:d}.npz".format(os.getpid())
+            np.savez(tmp_fname, intens=telap_ref_psf_cache[ref_key][0], peak=telap_ref_psf_cache[ref_key][1])
+            os.rename(tmp_fname, ref_fname)
+        except (IOError, OSError) as err:
+            logging.warning("Could not write the telescope reference PSF to {0:s}: {1:s}".format(ref_fname, str(err)))
+    return telap_ref_psf_cache[ref_key]
+
+class FileStatusIndex(object):
+    # Directory-listing index for file status queries. Each directory holding a queried file is listed once,
+    # and existence checks are answered from the name listing instead of a stat call per file. That matters on
+    # a shared parallel file system, where every stat is a metadata server round trip. refresh() stats each
+    # listed directory and lists it again only if its modification time changed, i.e. entries were added,
+    # removed or renamed. File stats are fetched on demand and kept until the next refresh() of their directory,
+    # whether or not it is listed again, since a file appended to or rewritten in place leaves the directory mtime
+    # unchanged. So stat() is a snapshot as of the last refresh: content staleness checks, like the mask library's,
+    # stat the file directly.
+    # Without os.scandir (python 2) links can't be told apart in a listing, so a dangling link counts as a file.
+    def __init__(self):
+        self.dir_listings = {} # directory path -> (directory mtime, {file name: DirEntry or None})
+        self.file_stats = {} # file path -> stat result
+    def _list_dir(self, dir_path):
+        try:
+            dir_mtime = os.stat(dir_path).st_mtime
+            if hasattr(os, 'scandir'):
+                entries = dict([(entry.name, entry) for entry in os.scandir(dir_path)])
+            else:
+                entries = dict([(name, None) for name in os.listdir(dir_path)])
+        except OSError: # missing or unreadable directory
+            dir_mtime = None
+            entries = {}
+        for name in self.dir_listings.get(dir_path, (None, {}))[1]:
+            self.file_stats.pop(os.path.join(dir_path, name), None)
+        self.dir_listings[dir_path] = (dir_mtime, entries)
+        return entries
+    def _get_entries(self, dir_path):
+        if dir_path not in self.dir_listings:
+            return self._list_dir(dir_path)
+        return self.dir_listings[dir_path][1]
+    def refresh(self, dir_path=None):
+        # Re-list the given directory, or all listed directories, whose modification time changed.
+        # Returns the number of directories that were listed again.
+        if dir_path is not None:
+            dir_list = [os.path.abspath(dir_path)]
+        else:
+            dir_list = list(self.dir_listings.keys())
+        relist_count = 0
+        for dir_path in dir_list:
+            try:
+                dir_mtime = os.stat(dir_path).st_mtime
+            except OSError:
+                dir_mtime = None
+            if dir_path not in self.dir_listings or dir_mtime != self.dir_listings[dir_path][0]:
+                self._list_dir(dir_path)
+                relist_count += 1
+            else:
+                for name in self.dir_listings[dir_path][1]:
+                    self.file_stats.pop(os.path.join(dir_path, name), None)
+        return relist_count
+    def invalidate(self, fname=None):
+        # Forget the listing of a file's directory, or everything, e.g. after writing files in place
+        if fname is None:
+            self.dir_listings = {}
+            self.file_stats = {}
+        else:
+            fname = os.path.abspath(fname)
+            self.dir_listings.pop(os.path.dirname(fname), None)
+            self.file_stats.pop(fname, None)
+    def exists(self, fname):
+        fname = os.path.abspath(fname)
+        dir_path, name = os.path.split(fname)
+        entries = self._get_entries(dir_path)
+        if name not in entries:
+            return False
+        if entries[name] is not None and entries[name].is_symlink(): # could be a dangling link
+            return os.path.exists(fname)
+        return True
+    def stat(self, fname):
+        fname = os.path.abspath(fname)
+        if not self.exists(fname):
+            raise OSError(2, "No such file or directory", fname)
+        if fname not in self.file_stats: # not DirEntry.stat(), which is cached for the life of the listing
+            self.file_stats[fname] = os.stat(fname)
+        return self.file_stats[fname]
+    def getmtime(self, fname):
+        return self.stat(fname).st_mtime
+
+file_status_index = FileStatusIndex()
+
+class MaskLibrary(object):
+    # Catalogue of input mask files (telescope apertures, FPMs, Lyot stops and Lyot dark zones), queryable by
+    # design parameters. The catalogue of a directory holds only the parameters parsed from its file names, so
+    # indexing it costs one listing. A file's contents are checksummed lazily, when the file itself is requested,
+    # and the checksum is reused while a fresh stat of the file shows the same size and mtime, so a mask
+    # rewritten in place is checksummed again. Nothing is written to the mask directories. Only with an explicit
+    # cache_dir, load() serves arrays from binary copies in cache_dir filed under the checksum of the text file,
+    # so a stale copy is never served, and the checksums are kept in cache_dir/mask_index.json for later sessions.
+    _index_fname = 'mask_index.json'
+    _query_fields = ['kind', 'symm', 'prim', 'secobs', 'thick', 'centobs', 'gap', 'N', 'descrip']
+
+    def __init__(self, cache_dir=None):
+        self.library_dirs = [] # shared mask directories searched for any design
+        self.catalogue = {} # directory path -> (directory mtime, {file name: parameters})
+        self.cache_dir = cache_dir # location of the binary copies and the checksum index, none by default
+        self.checksums = None # file path -> {'size', 'mtime', 'checksum'}, read from the cache_dir index on first use
+        self.telap_src_dir = None # high-resolution aperture sources for telescope aperture levels missing on disk
+        self._telap_re = None
+
+    def parse_fname(self, fname):
+        # Parameters encoded in a mask file name, or None if it doesn't follow the naming conventions
+        name = os.path.basename(fname)
+        if self._telap_re is None:
+            prims = sorted(LyotCoronagraph._aperture_menu['prim'], key=len, reverse=True)
+            secobs = sorted(LyotCoronagraph._aperture_menu['secobs'], key=len, reverse=True) + ['None']
+            self._telap_re = re.compile(r"^TelAp_(?P<symm>quart|half|full)_(?P<prim>{0:s})(?P<secobs>{1:s})(?P<thick>\d{{3}})"
+                                        r"cobs(?P<centobs>\d)gap(?P<gap>\d)_N(?P<N>\d{{4}})\.dat$".format('|'.join(prims), '|'.join(secobs)))
+        match = self._telap_re.match(name)
+        if match is None:
+            match = re.match(r"^(?P<kind>TelAp|FPM|LS|LDZ)_(?P<symm>quart|half|full)_(?P<descrip>.+?)(_N(?P<N>\d{4}))?\.dat$", name)
+        if match is None:
+            return None
+        params = dict([(key, val) for key, val in match.groupdict().items() if val is not None])
+        params.setdefault('kind', 'TelAp')
+        for key in ('centobs', 'gap', 'N'):
+            if key in params:
+                params[key] = int(params[key])
+        return params
+
+    def _index_dir(self, dir_path):
+        try:
+            dir_mtime = os.stat(dir_path).st_mtime
+        except OSError:
+            self.catalogue[dir_path] = (None, {})
+            return {}
+        if dir_path in self.catalogue and self.catalogue[dir_path][0] == dir_mtime:
+            return self.catalogue[dir_path][1]
+        entries = {}
+        for name in os.listdir(dir_path):
+            params = self.parse_fname(name)
+            if params is not None:
+                entries[name] = params
+        self.catalogue[dir_path] = (dir_mtime, entries)
+        return entries
+
+    def _get_checksums(self):
+        if self.checksums is None:
+            self.checksums = {}
+            if self.cache_dir is not None and os.path.exists(os.path.join(self.cache_dir, self._index_fname)):
+                try:
+                    self.checksums = json.load(open(os.path.join(self.cache_dir, self._index_fname)))
+                except ValueError:
+                    logging.warning("Could not read the mask checksum index in {:s}, rebuilding it".format(self.cache_dir))
+        return self.checksums
+
+    def _write_checksums(self):
+        # Merge the checksums into the index in cache_dir, which other processes may have updated meanwhile
+        if self.cache_dir is None:
+            return
+        index_fname = os.path.join(self.cache_dir, self._index_fname)
+        try:
+            stored = {}
+            if os.path.exists(index_fname):
+                try:
+                    stored = json.load(open(index_fname))
+                except ValueError:
+                    pass
+            stored.update(self.checksums)
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            tmp_fname = index_fname + ".{:d}".format(os.getpid())
+            index_fobj = open(tmp_fname, 'w')
+            json.dump(stored, index_fobj, sort_keys=True, indent=1)
+            index_fobj.close()
+            os.rename(tmp_fname, index_fname)
+        except (IOError, OSError): # no write access, keep the checksums in memory only
+            pass
+
+    def invalidate(self, fname=None):
+        # Forget the catalogue of a file's directory, or of every directory, e.g. after writing masks
+        if fname is None:
+            self.catalogue = {}
+        else:
+            self.catalogue.pop(os.path.dirname(os.path.abspath(fname)), None)
+
+    def add_dir(self, dir_path):
+        # Register a shared mask directory, searched by locate() and find() for any design
+        dir_path = os.path.abspath(os.path.expanduser(dir_path))
+        if dir_path not in self.library_dirs:
+            self.library_dirs.append(dir_path)
+        return len(self._index_dir(dir_path))
+
+    def get_entry(self, fname):
+        # Parameters, size, mtime and checksum of a mask file, or None if it's missing or not a recognized mask file
+        fname = os.path.abspath(fname)
+        dir_path, name = os.path.split(fname)
+        params = self._index_dir(dir_path).get(name)
+        if params is None:
+            return None
+        try:
+            fstat = os.stat(fname)
+        except OSError: # removed since the directory was indexed
+            self.invalidate(fname)
+            return None
+        checksums = self._get_checksums()
+        stored = checksums.get(fname)
+        if stored is None or stored['size'] != fstat.st_size or stored['mtime'] != fstat.st_mtime:
+            stored = {'size': fstat.st_size, 'mtime': fstat.st_mtime, 'checksum': get_file_checksum(fname)}
+            checksums[fname] = stored
+            self._write_checksums()
+        return dict(params, **stored)
+
+    def query(self, search_dirs=(), **params):
+        # File names of the masks in the given and the library directories whose parameters match
+        # all the given values, e.g. query(kind='TelAp', prim='hex3', gap=0, N=250)
+        for key in params:
+            if key not in self._query_fields:
+                raise ValueError("Unrecognized mask parameter {}".format(key))
+        matches = []
+        for dir_path in [os.path.abspath(d) for d in search_dirs] + self.library_dirs:
+            for name, entry in sorted(self._index_dir(dir_path).items()):
+                if all([entry.get(key) == val for key, val in params.items()]):
+                    fname = os.path.join(dir_path, name)
+                    if fname not in matches:
+                        matches.append(fname)
+        return matches
+
+    def find(self, search_dirs=(), **params):
+        # First match of query(), or None
+        matches = self.query(search_dirs, **params)
+        if len(matches) > 0:
+            return matches[0]
+        return None
+
+    def locate(self, fname, search_dirs=()):
+        # Path of a mask file: the name itself if it exists, or else the same file name in the given or
+        # the library directories, or None
+        if os.path.exists(fname):
+            return fname
+        name = os.path.basename(fname)
+        for dir_path in [os.path.abspath(d) for d in search_dirs] + self.library_dirs:
+            if name in self._index_dir(dir_path):
+                return os.path.join(dir_path, name)
+        return None
+
+    def load(self, fname):
+        # Mask array, with a cache_dir from its binary copy, which is made from the text file on the first load
+        if self.cache_dir is None:
+            return np.loadtxt(fname)
+        entry = self.get_entry(fname)
+        if entry is None: # not a catalogued mask, read the text file as is
+            return np.loadtxt(fname)
+        cache_dir = self.cache_dir
+        bin_fname = os.path.join(cache_dir, entry['checksum'] + '.npy')
+        if os.path.exists(bin_fname):
+            return np.load(bin_fname)
+        mask = np.loadtxt(fname)
+        try:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_fname = bin_fname[:-4] + ".{:d}.npy".format(os.getpid())
+            np.save(tmp_fname, mask)
+            os.rename(tmp_fname, bin_fname)
+        except (IOError, OSError): # no write access, keep serving the text file
+            pass
+        return mask
+
+    def get_missing(self, coron_list):
+        # Input mask files that the given designs need but don't exist, and the IDs of the designs that need each
+        missing = OrderedDict()
+        for coron in coron_list:
+            for namekey in SolutionStore._input_fname_keys:
+                fname = coron.fileorg.get(namekey)
+                if fname is None or (namekey == 'LDZ fname' and coron.design['LS'].get('aligntol') is None):
+                    continue
+                if not file_status_index.exists(fname):
+                    missing.setdefault(fname, []).append(coron.fileorg.get('design ID'))
+        return missing
+
+mask_library = MaskLibrary()
+
+class EvalBundleWriter(object):
+    # Writer of a multi-extension FITS bundle of a design's evaluation products. The primary HDU holds the
+    # common header, and each product is appended as a named extension as soon as it's produced, tile-compressed
+    # one frame per tile (losslessly unless a quantize_level > 0 is given). A cube can be written frame by frame:
+    # every section_frames frames go to the file as one extension, with the same EXTNAME, increasing EXTVER,
+    # and the cube position in FRAME0 and NFRAMES, so the cube is never held in memory whole.
+    def __init__(self, fname, header=None, compress=True, quantize_level=0., section_frames=64):
+        self.fname = fname
+        self.compress = compress
+        self.quantize_level = quantize_level
+        self.section_frames = section_frames
+        self.cube_sections = {} # extname -> frames waiting to be written and the position of the section
+        if os.path.exists(fname):
+            os.remove(fname)
+        pyfits.PrimaryHDU(header=header).writeto(fname)
+    def _append(self, hdu):
+        hdulist = pyfits.open(self.fname, mode='append')
+        hdulist.append(hdu)
+        hdulist.close()
+    def write_image(self, extname, data, header=None, extver=1):
+        data = np.ascontiguousarray(data) # pyfits writes the raw buffer, so a transposed or strided view would be scrambled
+        if self.compress and data.ndim >= 2 and data.size > 0:
+            tile_size = list(data.shape[::-1][:2]) + [1]*(data.ndim - 2)
+            hdu = pyfits.CompImageHDU(data, name=extname, compression_type='GZIP_1',
+                                      quantize_level=self.quantize_level, tile_size=tile_size)
+        else:
+            hdu = pyfits.ImageHDU(data, name=extname)
+        if header is not None: # product keywords go after the structural ones the HDU made
+            for card in header.cards:
+                if card.keyword not in ('SIMPLE', 'BITPIX', 'EXTEND') and not card.keyword.startswith('NAXIS'):
+                    hdu.header[card.keyword] = (card.value, card.comment)
+        hdu.header['EXTVER'] = extver
+        self._append(hdu)
+    def write_frame(self, extname, frame, n_frames, header=None):
+        # Add the next frame of a cube of n_frames frames
+        section = self.cube_sections.setdefault(extname, {'frames': [], 'frame0': 0, 'extver': 1})
+        section['frames'].append(np.asarray(frame))
+        if len(section['frames']) == self.section_frames or section['frame0'] + len(section['frames']) == n_frames:
+            section_header = header.copy() if header is not None else pyfits.Header()
+            section_header['FRAME0'] = (section['frame0'], 'first cube frame in this section')
+            section_header['NFRAMES'] = (n_frames, 'frames in the cube')
+            self.write_image(extname, np.array(section['frames']), header=section_header, extver=section['extver'])
+            section['frame0'] += len(section['frames'])
+            section['extver'] += 1
+            section['frames'] = []
+
+class EvalBundleCube(object):
+    # Lazy view of a cube in an evaluation bundle: indexing along the first axis decompresses only the sections
+    # holding the requested frames
+    def __init__(self, bundle, extname):
+        self.bundle = bundle
+        self.extname = extname
+        header = bundle.hdulist[bundle.sections[extname][0][2]].header
+        self.shape = (header['NFRAMES'], header['NAXIS2'], header['NAXIS1'])
+    def __len__(self):
+        return self.shape[0]
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            frames = self[key[0]]
+            if isinstance(key[0], slice):
+                return frames[(slice(None),) + key[1:]]
+            return frames[key[1:]]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.shape[0])
+            return self.bundle.get_frames(self.extname, start, stop)[::step]
+        key = key % self.shape[0]
+        return self.bundle.get_frames(self.extname, key, key + 1)[0]
+    def __array__(self, dtype=None):
+        return np.asarray(self.bundle.get_frames(self.extname, 0, self.shape[0]), dtype=dtype)
+
+class EvalBundle(object):
+    # Reader of an evaluation bundle written by EvalBundleWriter. The file is opened memory-mapped and an
+    # extension is only read, and decompressed, when its data is requested.
+    def __init__(self, fname):
+        self.fname = fname
+        self.hdulist = pyfits.open(fname, memmap=True)
+        self.header = self.hdulist[0].header
+        self.sections = OrderedDict() # extname -> [(first frame, number of frames, HDU index)] in EXTVER order
+        for hi in range(1, len(self.hdulist)):
+            hdu_header = self.hdulist[hi].header
+            n_section_frames = hdu_header['NAXIS3'] if 'FRAME0' in hdu_header else None
+            self.sections.setdefault(self.hdulist[hi].name, []).append((hdu_header.get('FRAME0'), n_section_frames, hi))
+    def extnames(self):
+        return list(self.sections.keys())
+    def get(self, extname, extver=1):
+        # Data of an extension, or a whole sectioned cube
+        if self.sections[extname][0][0] is not None:
+            return np.asarray(self.cube(extname))
+        return self.hdulist[self.sections[extname][extver - 1][2]].data
+    def get_header(self, extname, extver=1):
+        return self.hdulist[self.sections[extname][extver - 1][2]].header
+    def get_frames(self, extname, start, stop):
+        # Frames start to stop - 1 of a sectioned cube
+        frames = []
+        for frame0, n_section_frames, hi in self.sections[extname]:
+            if frame0 < stop and frame0 + n_section_frames > start:
+                frames.append(np.array(self.hdulist[hi].data[max(start - frame0, 0):min(stop - frame0, n_section_frames)]))
+                del self.hdulist[hi].data # drop the decompressed section
+        if len(frames) == 0:
+            return np.zeros((0,) + self.cube(extname).shape[1:])
+        return np.concatenate(frames, axis=0)
+    def cube(self, extname):
+        return EvalBundleCube(self, extname)
+    def close(self):
+        self.hdulist.close()
+
+class StageTimer(object):
+    # Registry of wall times spent in named stages of the evaluation pipeline. A stage is timed with
+    # "with stage_timer('name'):" or with the timed_stage('name') decorator. A stage entered inside another one
+    # is recorded under 'outer/inner'. With track_memory, the process memory high-water mark (RSS, MB) is
+    # recorded at each stage exit. A disabled timer hands out a shared no-op context, so the hooks cost
+    # only a function call.
+    def __init__(self):
+        self.enabled = False
+        self.track_memory = False
+        self.reset()
+    def enable(self, track_memory=False):
+        self.enabled = True
+        self.track_memory = track_memory and resource is not None
+    def disable(self):
+        self.enabled = False
+    def reset(self):
+        self.stages = OrderedDict() # stage path -> {'calls', 'time', 'max rss MB'}
+        self.stack = []
+        self.start_time = time.time()
+    def __call__(self, name):
+        if not self.enabled:
+            return _null_stage
+        return _TimedStage(self, name)
+    def _record(self, stage_path, elapsed):
+        if stage_path not in self.stages:
+            self.stages[stage_path] = {'calls': 0, 'time': 0., 'max rss MB': None}
+        stage = self.stages[stage_path]
+        stage['calls'] += 1
+        stage['time'] += elapsed
+        if self.track_memory:
+            rss_MB = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024. # kB on Linux
+            stage['max rss MB'] = max(stage['max rss MB'], rss_MB) if stage['max rss MB'] is not None else rss_MB
+    def snapshot(self):
+        # Current totals, to report only what was timed after this point with get_report(since=...)
+        return (time.time(), OrderedDict([(stage_path, dict(stage)) for stage_path, stage in self.stages.items()]))
+    def get_report(self, since=None):
+        # Stage times since the last reset, or since a snapshot. The memory high-water mark isn't differenced.
+        report = OrderedDict()
+        if since is None:
+            report['wall time'] = time.time() - self.start_time
+            report['stages'] = OrderedDict([(stage_path, dict(stage)) for stage_path, stage in self.stages.items()])
+            return report
+        start_time, start_stages = since
+        report['wall time'] = time.time() - start_time
+        report['stages'] = OrderedDict()
+        for stage_path, stage in self.stages.items():
+            start_stage = start_stages.get(stage_path, {'calls': 0, 'time': 0.})
+            if stage['calls'] > start_stage['calls']:
+                report['stages'][stage_path] = {'calls': stage['calls'] - start_stage['calls'],
+                                                'time': stage['time'] - start_stage['time'],
+                                                'max rss MB': stage['max rss MB']}
+        return report
+    def write_report(self, json_fname, extra=None, since=None):
+        # JSON report of the stage times, with optional extra entries (e.g. the design label)
+        report = OrderedDict()
+        if extra is not None:
+            report.update(extra)
+        report.update(self.get_report(since))
+        json_fobj = open(json_fname, 'w')
+        json.dump(report, json_fobj, indent=2)
+        json_fobj.close()
+        return report
+
+class _TimedStage(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+    def __enter__(self):
+        self.timer.stack.append(self.name)
+        self.t0 = time.time()
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.time() - self.t0
+        stage_path = "/".join(self.timer.stack)
+        self.timer.stack.pop()
+        self.timer._record(stage_path, elapsed)
+        return False
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+_null_stage = _NullStage()
+stage_timer = StageTimer()
+
+def timed_stage(name):
+    # Decorator that times every call of a function as a stage of the module stage_timer
+    def decorator(func):
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            if not stage_timer.enabled:
+                return func(*args, **kwargs)
+            with stage_timer(name):
+                return func(*args, **kwargs)
+        return timed_func
+    return decorator
+
+def get_eval_timing_summary(timing_reports):
+    # Aggregate the per-design stage timing reports of a survey: for each stage, the number of designs it
+    # appears in, and the total, mean and maximum time over designs, along with the largest memory high-water
+    summary = OrderedDict()
+    for report in timing_reports:
+        for stage_path, stage in report['stages'].items():
+            if stage_path not in summary:
+                summary[stage_path] = {'designs': 0, 'calls': 0, 'total time': 0., 'max time': 0., 'max rss MB': None}
+            stage_sum = summary[stage_path]
+            stage_sum['designs'] += 1
+            stage_sum['calls'] += stage['calls']
+            stage_sum['total time'] += stage['time']
+            stage_sum['max time'] = max(stage_sum['max time'], stage['time'])
+            if stage['max rss MB'] is not None:
+                stage_sum['max rss MB'] = max(stage_sum['max rss MB'], stage['max rss MB']) \
+                                          if stage_sum['max rss MB'] is not None else stage['max rss MB']
+    for stage_sum in summary.values():
+        stage_sum['mean time'] = stage_sum['total time']/stage_sum['designs']
+    return summary
+
+class SolutionStore(object):
+    # Content-addressed store of optimization solutions, shared between surveys. Each solution is
+    # filed under a hash of the coronagraph class, design parameters, solver options and the
+    # checksums of the input mask files, so a physically identical design in a later survey
+    # can link the stored solution and log instead of being optimized again.
+    _input_fname_keys = ['TelAp fname', 'FPM fname', 'LS fname', 'LDZ fname']
+
+    def __init__(self, store_dir):
+        setattr(self, 'store_dir', os.path.abspath(os.path.expanduser(store_dir)))
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+
+    def get_key(self, coron):
+        # Returns None if an input file is missing, since the design can't be addressed without it
+        input_checksums = {}
+        for namekey in self._input_fname_keys:
+            if namekey in coron.fileorg and coron.fileorg[namekey] is not None:
+                if not os.path.exists(coron.fileorg[namekey]):
+                    return None
+                input_checksums[namekey] = get_file_checksum(coron.fileorg[namekey])
+        content = {'class': coron.__class__.__name__, 'design': get_design_params(coron),
+                   'solver': coron.solver, 'input checksums': input_checksums}
+        return hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_entry_dir(self, key):
+        return os.path.join(self.store_dir, key[:2], key)
+
+    def lookup(self, coron):
+        # Location of the stored solution for a design, or None
+        key = self.get_key(coron)
+        if key is None:
+            return None
+        stored_sol_fname = os.path.join(self.get_entry_dir(key), 'sol.dat')
+        if os.path.exists(stored_sol_fname):
+            return stored_sol_fname
+        return None
+
+    def deposit(self, coron, overwrite=False):
+        # Copy a design's solution and log into the store. Returns the key, or None if nothing was stored.
+        if not os.path.exists(coron.fileorg['sol fname']) or os.path.islink(coron.fileorg['sol fname']):
+            return None
+        key = self.get_key(coron)
+        if key is None:
+            return None
+        entry_dir = self.get_entry_dir(key)
+        stored_sol_fname = os.path.join(entry_dir, 'sol.dat')
+        if os.path.exists(stored_sol_fname) and not overwrite:
+            return key
+        if not os.path.exists(entry_dir):
+            os.makedirs(entry_dir)
+        shutil.copy2(coron.fileorg['sol fname'], stored_sol_fname)
+        os.chmod(stored_sol_fname, 0644)
+        if 'log fname' in coron.fileorg and os.path.exists(coron.fileorg['log fname']):
+            shutil.copy2(coron.fileorg['log fname'], os.path.join(entry_dir, 'sol.log'))
+        info_fobj = open(os.path.join(entry_dir, 'info.json'), 'w')
+        json.dump({'class': coron.__class__.__name__, 'design': get_design_params(coron), 'solver': coron.solver,
+                   'design ID': coron.fileorg.get('design ID'), 'sol fname': os.path.abspath(coron.fileorg['sol fname']),
+                   'deposited by': getpass.getuser(), 'date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M")},
+                  info_fobj, sort_keys=True, indent=2)
+        info_fobj.close()
+        return key
+
+    def link(self, coron):
+        # Symlink a stored solution and log to the design's own file names. Returns True if the design is
+        # now covered by a stored solution, so it doesn't need to be optimized. A dangling link left by a store
+        # that has since moved is replaced.
+        if os.path.exists(coron.fileorg['sol fname']):
+            return False
+        stored_sol_fname = self.lookup(coron)
+        if stored_sol_fname is None:
+            return False
+        if os.path.lexists(coron.fileorg['sol fname']): # dangling link
+            os.remove(coron.fileorg['sol fname'])
+        os.symlink(stored_sol_fname, coron.fileorg['sol fname'])
+        stored_log_fname = os.path.join(os.path.dirname(stored_sol_fname), 'sol.log')
+        if 'log fname' in coron.fileorg and os.path.exists(stored_log_fname) and not os.path.exists(coron.fileorg['log fname']):
+            if os.path.lexists(coron.fileorg['log fname']): # dangling link
+                os.remove(coron.fileorg['log fname'])
+            os.symlink(stored_log_fname, coron.fileorg['log fname'])
+        coron.ampl_submission_status = True # so the queue filler counts it as done
+        coron.solution_status = True
+        return True
+
 class DesignParamSurvey(object):
     def __init__(self, coron_class, survey_config, **kwargs):
         #self.logger = logging.getLogger('scda.logger')
@@ -312,6 +1333,17 @@ class DesignParamSurvey(object):
         if 'crossover' not in self.solver: self.solver['crossover'] = None
          
         setattr(self, 'coron_list', [])
+        self._build_coron_list()
+ 
+        setattr(self, 'ampl_infile_status', False)
+        if not self.check_ampl_input_files():
+            self.report_missing_masks()
+        setattr(self, 'ampl_src_status', False)
+        setattr(self, 'ampl_submission_status', False)
+        setattr(self, 'solution_status', False)
+        setattr(self, 'eval_status', False)
+
+    def _build_coron_list(self):
         design = {}
         for keycat in self._param_menu:
             design[keycat] = {}
@@ -330,14 +1362,96 @@ class DesignParamSurvey(object):
             num_ID_digits = int(np.floor(np.log10(self.N_combos))) + 1
             ID_fmt_str = "{{:s}}-{{:0{:d}d}}".format(num_ID_digits)
             coron_fileorg['design ID'] = ID_fmt_str.format(survey_name, idx)
-            self.coron_list.append( coron_class(design=design, fileorg=coron_fileorg, solver=self.solver) )
- 
-        setattr(self, 'ampl_infile_status', False)
+            self.coron_list.append( self.coron_class(design=design, fileorg=coron_fileorg, solver=self.solver) )
+
+    def set_solver(self, solver):
+        # Update the survey solver options, e.g. with the recommendation of autotune_survey_solver().
+        # The AMPL program and solution file names depend on the solver options, so the coronagraph
+        # list is rebuilt. Call this before write_ampl_batch() and write_slurm_batch().
+        for field, value in solver.items():
+            if field in self._file_fields['solver']:
+                if value in self._solver_menu[field]:
+                    self.solver[field] = value
+                else:
+                    logging.warning("Warning: Unrecognized solver option \"{0}\" in field \"{1}\", keeping \"{2}\"".format(value, field, self.solver[field]))
+            else:
+                logging.warning("Warning: Unrecognized field {0} in solver argument".format(field))
+        self._build_coron_list()
         self.check_ampl_input_files()
-        setattr(self, 'ampl_src_status', False)
-        setattr(self, 'ampl_submission_status', False)
-        setattr(self, 'solution_status', False)
-        setattr(self, 'eval_status', False)
+        self.ampl_src_status = False
+        self.ampl_submission_status = False
+        self.solution_status = False
+        self.eval_status = False
+        logging.info("Survey solver options are now {}".format(self.solver))
+
+    def screen_feasibility(self, N_screen=50, fpres_screen=1, dominance_frac=0.1, screen_dir=None,
+                           ampl_cmd='ampl', Nproc=None):
+        # Run a cheap proxy of every design in the survey (reduced N, one wavelength, coarse dark zone
+        # sampling) on a local process pool before submitting the full optimizations. Designs whose proxy
+        # is infeasible, or whose proxy throughput is below dominance_frac times the best in the survey,
+        # get their screen_status flagged, and are then skipped by the batch writers and the queue filler.
+        # The proxies need input masks at N_screen in the survey's mask directories.
+        if screen_dir is None:
+            screen_dir = os.path.join(self.fileorg['work dir'], 'screen')
+        if not os.path.exists(screen_dir):
+            os.makedirs(screen_dir)
+        job_list = []
+        job_corons = []
+        for coron in self.coron_list:
+            design_mods = {'Pupil': {'N': N_screen}, 'Image': {'fpres': fpres_screen}}
+            if 'N' in coron.design['LS']: # SPLC has separate Lyot plane sampling
+                design_mods['LS'] = {'N': N_screen}
+            proxy_label = "screen_" + coron.fileorg['design ID']
+            proxy = make_proxy_coron(coron, screen_dir, proxy_label, design_mods=design_mods)
+            proxy.design['Image']['Nlam'] = 1 # the constructor resets Nlam=1 to the bandwidth-based default
+            if proxy.write_ampl(overwrite=True, verbose=False) != 0:
+                continue
+            job_list.append((ampl_cmd, proxy.fileorg['ampl src fname'], proxy.fileorg['log fname']))
+            job_corons.append(coron)
+        if len(job_list) < self.N_combos:
+            logging.warning("Could not write screening proxies for {0:d} of {1:d} designs, they will not be screened".format(
+                            self.N_combos - len(job_list), self.N_combos))
+        logging.info("Running {0:d} feasibility screening proxies in {1:s}".format(len(job_list), screen_dir))
+        results = run_ampl_jobs(job_list, Nproc=Nproc)
+
+        for coron in self.coron_list:
+            coron.screen_status = None
+        solved_objs = [res['objective'] for res in results if res['result'] == 'solved' and res['objective'] is not None]
+        if len(solved_objs) > 0:
+            best_obj = max(solved_objs)
+        else:
+            best_obj = None
+        for coron, res in zip(job_corons, results):
+            if res['result'] == 'infeasible':
+                coron.screen_status = 'infeasible'
+            elif res['result'] == 'solved' and res['objective'] is not None and best_obj is not None and \
+                 res['objective'] < dominance_frac*best_obj:
+                coron.screen_status = 'dominated'
+        infeasible_count = len([coron for coron in self.coron_list if coron.screen_status == 'infeasible'])
+        dominated_count = len([coron for coron in self.coron_list if coron.screen_status == 'dominated'])
+        saved_hours = sum(coron.estimate_solver_hours() for coron in self.coron_list if coron.screen_status is not None)
+        total_hours = sum(coron.estimate_solver_hours() for coron in self.coron_list)
+        logging.info("Feasibility screen flagged {0:d} infeasible and {1:d} dominated designs out of {2:d}, saving an estimated {3:.1f} of {4:.1f} solver hours".format(
+                     infeasible_count, dominated_count, self.N_combos, saved_hours, total_hours))
+        return saved_hours
+
+    def link_stored_solutions(self, solution_store):
+        # Link the solutions of designs already optimized in this or another survey
+        link_count = 0
+        for coron in self.coron_list:
+            if solution_store.link(coron):
+                link_count += 1
+        logging.info("Linked {0:d} of {1:d} designs to stored solutions in {2:s}".format(link_count, self.N_combos, solution_store.store_dir))
+        return link_count
+
+    def deposit_solutions(self, solution_store, overwrite=False):
+        # Add this survey's completed solutions to a store so later surveys can reuse them
+        deposit_count = 0
+        for coron in self.coron_list:
+            if solution_store.deposit(coron, overwrite=overwrite) is not None:
+                deposit_count += 1
+        logging.info("Deposited {0:d} of {1:d} survey solutions in {2:s}".format(deposit_count, self.N_combos, solution_store.store_dir))
+        return deposit_count
 
     def write_serial_bash(self, serial_bash_fname=None, overwrite=False, override_infile_status=False):
         # Write a bash script to sequentially run each program in a design survey
@@ -370,11 +1484,19 @@ class DesignParamSurvey(object):
             logging.warning("Denied overwrite of serial bash survey script {:s}".format(serial_bash_fname))
             return 1
 
-    def write_ampl_batch(self, overwrite=False, override_infile_status=False):
+    def write_ampl_batch(self, overwrite=False, override_infile_status=False, solution_store=None):
         write_count = 0
         overwrite_deny_count = 0
         infile_deny_count = 0
+        screen_skip_count = 0
+        reuse_count = 0
         for coron in self.coron_list:
+            if getattr(coron, 'screen_status', None) is not None:
+                screen_skip_count += 1
+                continue
+            if solution_store is not None and (solution_store.link(coron) or os.path.islink(coron.fileorg['sol fname'])):
+                reuse_count += 1
+                continue
             status = coron.write_ampl(overwrite, override_infile_status, verbose=False)
             if status == 2:
                 infile_deny_count += 1
@@ -382,24 +1504,35 @@ class DesignParamSurvey(object):
                 overwrite_deny_count += 1
             else:
                 write_count += 1
-        if write_count == self.N_combos:
-            logging.info("Wrote all {0:d} of {1:d} design survey AMPL programs into {2:s}".format(write_count, self.N_combos, self.fileorg['ampl src dir']))
+        if screen_skip_count > 0:
+            logging.info("Skipped {0:d} designs flagged by the feasibility screen".format(screen_skip_count))
+        if reuse_count > 0:
+            logging.info("Skipped {0:d} designs linked to stored solutions".format(reuse_count))
+        if write_count + screen_skip_count + reuse_count == self.N_combos:
+            logging.info("Wrote all {0:d} of {1:d} design survey AMPL programs into {2:s}".format(write_count, self.N_combos - screen_skip_count - reuse_count, self.fileorg['ampl src dir']))
         else:
             logging.warning("Wrote {0:d} of {1:d} design survey AMPL programs into {2:s}. {3:d} already existed and were denied overwriting. {4:d} were denied writing because of a failed input file configuration status.".format(write_count, self.N_combos, self.fileorg['ampl src dir'], overwrite_deny_count, infile_deny_count))
 
     def write_slurm_batch(self, queue_spec='auto', account='s1649', email=None, arch=None,
-                          overwrite=False, override_infile_status=False):
+                          overwrite=False, override_infile_status=False, solution_store=None):
         write_count = 0
         overwrite_deny_count = 0
+        skip_count = 0
         for coron in self.coron_list:
+            if getattr(coron, 'screen_status', None) is not None:
+                skip_count += 1
+                continue
+            if solution_store is not None and (solution_store.link(coron) or os.path.islink(coron.fileorg['sol fname'])):
+                skip_count += 1
+                continue
             status = coron.write_slurm_script(queue_spec=queue_spec, account=account, email=email, arch=arch,
                                               overwrite=overwrite, verbose=False)
             if status == 1:
                 overwrite_deny_count += 1
             else:
                 write_count += 1
-        if write_count == self.N_combos:
-            logging.info("Wrote all {0:d} of {1:d} design survey slurm scripts into {2:s}".format(write_count, self.N_combos, self.fileorg['slurm dir']))
+        if write_count + skip_count == self.N_combos:
+            logging.info("Wrote all {0:d} of {1:d} design survey slurm scripts into {2:s}".format(write_count, self.N_combos - skip_count, self.fileorg['slurm dir']))
         else:
             logging.warning("Wrote {0:d} of {1:d} design survey AMPL programs into {2:s}. {3:d} already existed and were denied overwriting.".format(write_count, self.N_combos, self.fileorg['slurm dir'], overwrite_deny_count))
 
@@ -421,10 +1554,34 @@ class DesignParamSurvey(object):
         print("Varied parameter combo tuple:")
         pprint.pprint(self.varied_param_combos[-1])
 
+    def make_missing_masks(self, telap_src_dir=None, Nproc=None, overwrite=False):
+        # Generate the input mask files that the survey designs are missing from the high-resolution
+        # telescope aperture sources in telap_src_dir, in parallel over Nproc processes
+        import scda_masks
+        written = scda_masks.make_missing_masks(self.coron_list, telap_src_dir, Nproc=Nproc, overwrite=overwrite)
+        for fname in written:
+            file_status_index.invalidate(fname)
+            mask_library.invalidate(fname)
+        logging.info("Made {0:d} mask files for the survey".format(len(written)))
+        return self.check_ampl_input_files()
+
+    def report_missing_masks(self):
+        # Log every input mask file missing for the survey, once, with the number of designs that need it.
+        # Returns a dictionary of the missing file names and the IDs of the designs that need them.
+        file_status_index.refresh()
+        missing = mask_library.get_missing(self.coron_list)
+        if len(missing) > 0:
+            N_designs = len(set([design_ID for design_IDs in missing.values() for design_ID in design_IDs]))
+            logging.warning("{0:d} input mask files are missing for {1:d} of {2:d} designs:".format(len(missing), N_designs, len(self.coron_list)))
+            for fname, design_IDs in missing.items():
+                logging.warning("    {0:s} ({1:d} designs)".format(fname, len(design_IDs)))
+        return missing
+
     def check_ampl_input_files(self):
         survey_status = True
+        file_status_index.refresh()
         for coron in self.coron_list: # Update all individual statuses
-            coron_status = coron.check_ampl_input_files()
+            coron_status = coron.check_ampl_input_files(status_index=file_status_index)
             if coron_status is False: # If one is missing input files, set the survey-wide input file status to False
                 survey_status = False
         self.ampl_infile_status = survey_status
@@ -432,8 +1589,9 @@ class DesignParamSurvey(object):
 
     def check_ampl_src_files(self):
         status = True
+        file_status_index.refresh()
         for coron in self.coron_list:
-            if not os.path.exists(coron.fileorg['ampl src fname']):
+            if not file_status_index.exists(coron.fileorg['ampl src fname']):
                 status = False
                 break
         self.ampl_src_status = status
@@ -441,13 +1599,29 @@ class DesignParamSurvey(object):
 
     def check_solution_files(self):
         status = True
+        file_status_index.refresh()
         for coron in self.coron_list:
-            if not os.path.exists(coron.fileorg['sol fname']):
+            if not file_status_index.exists(coron.fileorg['sol fname']):
                 status = False
                 break
         self.solution_status = status
         return status
 
+    def get_eval_timing_summary(self, json_fname=None):
+        # Survey-level summary of the stage timing reports left by write_eval_products() with the module
+        # stage_timer enabled, optionally written to a JSON file
+        timing_reports = [coron.eval_timing for coron in self.coron_list if getattr(coron, 'eval_timing', None) is not None]
+        if len(timing_reports) == 0:
+            logging.warning("No evaluation stage timing reports found, enable scda.stage_timer before write_eval_products()")
+            return None
+        summary = get_eval_timing_summary(timing_reports)
+        if json_fname is not None:
+            json_fobj = open(json_fname, 'w')
+            json.dump(OrderedDict([('designs', len(timing_reports)), ('stages', summary)]), json_fobj, indent=2)
+            json_fobj.close()
+            logging.info("Wrote survey evaluation timing summary to {:s}".format(json_fname))
+        return summary
+
     def check_eval_status(self):
         status = True
         for coron in self.coron_list: # Update all individual statuses
@@ -457,17 +1631,24 @@ class DesignParamSurvey(object):
         self.eval_status = status
         return status
 
-    def get_metrics(self, fp2res=16, verbose=False):
+    def get_metrics(self, fp2res=16, verbose=False, ref_psf_dir=None):
         telap_warning = False
+        file_status_index.refresh()
         for coron in self.coron_list:
-            if os.path.exists(coron.fileorg['sol fname']) and \
+            if file_status_index.exists(coron.fileorg['sol fname']) and \
                 (coron.eval_metrics['fwhm area'] is None \
                  or coron.eval_metrics['apod nb res ratio'] is None):
-                telap_flag = coron.get_metrics(verbose=verbose)
+                if isinstance(coron, (SPLC, NdiayeAPLC)): # share telescope reference PSFs between designs
+                    coron_ref_psf_dir = ref_psf_dir
+                    if coron_ref_psf_dir is None: # next to the aperture masks
+                        coron_ref_psf_dir = os.path.dirname(os.path.abspath(coron.fileorg['TelAp fname']))
+                    telap_flag = coron.get_metrics(verbose=verbose, ref_psf_dir=coron_ref_psf_dir)
+                else:
+                    telap_flag = coron.get_metrics(verbose=verbose)
                 coron.eval_status = True
                 if telap_flag > 0:
                     telap_warning = True
-            if os.path.exists(coron.fileorg['sol fname']) and os.path.exists(coron.fileorg['log fname']) and \
+            if file_status_index.exists(coron.fileorg['sol fname']) and file_status_index.exists(coron.fileorg['log fname']) and \
                (not hasattr(coron, 'ampl_completion_time') or coron.ampl_completion_time is None):
                 setattr(coron, 'ampl_completion_time', None)
                 log = open(coron.fileorg['log fname'])
@@ -498,6 +1679,7 @@ class DesignParamSurvey(object):
         logging.info("Wrote the design parameter survey object to {:s}".format(self.fileorg['survey fname']))
  
     def write_spreadsheet(self, overwrite=False, csv_fname=None):
+        file_status_index.refresh()
         if csv_fname is not None:
             if os.path.dirname(csv_fname) is '': # if no path specified, assume work dir
                 csv_fname = os.path.join(self.fileorg['work dir'], csv_fname)
@@ -642,7 +1824,7 @@ class DesignParamSurvey(object):
                     param_combo_row = list(param_combo)
                     param_combo_row.append(self.coron_list[ii].fileorg['design ID'])
                     param_combo_row.append(os.path.basename(self.coron_list[ii].fileorg['ampl src fname'])) 
-                    if os.path.exists(self.coron_list[ii].fileorg['ampl src fname']):
+                    if file_status_index.exists(self.coron_list[ii].fileorg['ampl src fname']):
                         param_combo_row.append('Y')
                     else:
                         param_combo_row.append('N')
@@ -655,7 +1837,7 @@ class DesignParamSurvey(object):
                     else:
                         param_combo_row.append('N')
                     param_combo_row.append(os.path.basename(self.coron_list[ii].fileorg['sol fname'])) 
-                    if os.path.exists(self.coron_list[ii].fileorg['sol fname']):
+                    if file_status_index.exists(self.coron_list[ii].fileorg['sol fname']):
                         param_combo_row.append('Y')
                     else:
                         param_combo_row.append('N')
@@ -709,6 +1891,143 @@ class DesignParamSurvey(object):
         os.chmod(csv_fname, 0644)
         logging.info("Wrote design survey spreadsheet to {:s}".format(csv_fname))
 
+def get_pareto_front(objective_vals):
+    # Indices of the non-dominated rows of an (N_points x N_objectives) array, all objectives maximized
+    objective_vals = np.array(objective_vals, dtype=float)
+    front_inds = []
+    for ii in range(objective_vals.shape[0]):
+        dominated = np.any(np.all(objective_vals >= objective_vals[ii], axis=1) & \
+                           np.any(objective_vals > objective_vals[ii], axis=1))
+        if not dominated:
+            front_inds.append(ii)
+    return front_inds
+
+class AdaptiveDesignParamSurvey(DesignParamSurvey):
+    # Design survey that only optimizes a subset of the full parameter grid. It starts from a coarse
+    # subgrid (every coarse_stride-th value of each varied parameter, plus the last value) and then
+    # successively refines the grid around the best designs harvested so far, halving the stride
+    # each time, until no new neighbors turn up at stride 1. The coron_list, varied_param_combos and
+    # N_combos attributes hold only the active designs, so the batch writers, spreadsheet and queue
+    # manager work unchanged. Design IDs are indexed in the full grid and stay fixed as it refines.
+    def __init__(self, coron_class, survey_config, coarse_stride=4, **kwargs):
+        setattr(self, 'stride', max(int(coarse_stride), 1))
+        setattr(self, 'converged', False)
+        setattr(self, 'refine_count', 0)
+        setattr(self, 'slurm_opts', {})
+        DesignParamSurvey.__init__(self, coron_class, survey_config, **kwargs)
+
+    def _build_coron_list(self):
+        if not hasattr(self, 'candidate_combos'): # first call, from the base class constructor
+            self.candidate_combos = self.varied_param_combos
+            self.grid_shape = tuple(len(self.survey_config[keycat][param]) for (keycat, param) in self.varied_param_index)
+            self.active_inds = self._get_coarse_inds()
+        self.varied_param_combos = self.candidate_combos
+        self.N_combos = len(self.candidate_combos)
+        DesignParamSurvey._build_coron_list(self)
+        self.candidate_list = self.coron_list
+        self._select_active()
+
+    def _get_coarse_inds(self):
+        coarse_axes = []
+        for N_vals in self.grid_shape:
+            axis_inds = list(range(0, N_vals, self.stride))
+            if axis_inds[-1] != N_vals - 1:
+                axis_inds.append(N_vals - 1)
+            coarse_axes.append(axis_inds)
+        return sorted(int(np.ravel_multi_index(grid_idx, self.grid_shape)) for grid_idx in itertools.product(*coarse_axes))
+
+    def _select_active(self):
+        self.coron_list = [self.candidate_list[ci] for ci in self.active_inds]
+        self.varied_param_combos = tuple(self.candidate_combos[ci] for ci in self.active_inds)
+        self.N_combos = len(self.active_inds)
+
+    def write_slurm_batch(self, queue_spec='auto', account='s1649', email=None, arch=None,
+                          overwrite=False, override_infile_status=False, solution_store=None):
+        # Remember the queue options so refine() can write the scripts of the new designs
+        self.slurm_opts = {'queue_spec': queue_spec, 'account': account, 'email': email, 'arch': arch}
+        DesignParamSurvey.write_slurm_batch(self, queue_spec=queue_spec, account=account, email=email, arch=arch,
+                                            overwrite=overwrite, override_infile_status=override_infile_status,
+                                            solution_store=solution_store)
+
+    def get_elite_inds(self, objectives=(('fwhm thrupt', 'max'),), N_elite=3):
+        # Candidate indices of the best evaluated designs. Each objective is a pair of a source, either
+        # an eval_metrics key or a (keycat, param) design parameter tuple, and a sense, 'max' or 'min'.
+        # With a single objective the N_elite top designs are returned, otherwise the Pareto front.
+        eval_inds = []
+        objective_vals = []
+        for ci in self.active_inds:
+            coron = self.candidate_list[ci]
+            vals = []
+            for source, sense in objectives:
+                if isinstance(source, tuple):
+                    val = coron.design[source[0]][source[1]]
+                else:
+                    val = coron.eval_metrics[source]
+                if val is None:
+                    break
+                vals.append(val if sense == 'max' else -val)
+            if len(vals) == len(objectives):
+                eval_inds.append(ci)
+                objective_vals.append(vals)
+        if len(eval_inds) == 0:
+            return []
+        if len(objectives) == 1:
+            order = np.argsort(-np.array(objective_vals)[:,0], kind='mergesort')
+            return [eval_inds[oi] for oi in order[:N_elite]]
+        return [eval_inds[fi] for fi in get_pareto_front(objective_vals)]
+
+    def _get_neighbor_inds(self, elite_inds, step):
+        neighbor_inds = set()
+        for ci in elite_inds:
+            grid_idx = np.unravel_index(ci, self.grid_shape)
+            neighbor_axes = []
+            for ai, N_vals in zip(grid_idx, self.grid_shape):
+                neighbor_axes.append(sorted(set(ii for ii in (ai - step, ai, ai + step) if 0 <= ii < N_vals)))
+            for neighbor_idx in itertools.product(*neighbor_axes):
+                neighbor_inds.add(int(np.ravel_multi_index(neighbor_idx, self.grid_shape)))
+        return sorted(neighbor_inds - set(self.active_inds))
+
+    def refine(self, objectives=(('fwhm thrupt', 'max'),), N_elite=3, write_files=True, overwrite=False):
+        # Add the grid neighbors of the best designs to the active list, and write their AMPL programs
+        # and slurm scripts. All active designs must have solutions. Returns the list of new coronagraphs.
+        if self.converged:
+            return []
+        file_status_index.refresh()
+        if not all(file_status_index.exists(self.candidate_list[ci].fileorg['sol fname']) or \
+                   getattr(self.candidate_list[ci], 'screen_status', None) is not None for ci in self.active_inds):
+            logging.warning("Not all active designs have solutions yet, postponing the survey refinement")
+            return []
+        self.get_metrics()
+        elite_inds = self.get_elite_inds(objectives=objectives, N_elite=N_elite)
+        if len(elite_inds) == 0:
+            logging.warning("No evaluated designs to refine around")
+            return []
+        new_inds = []
+        while len(new_inds) == 0 and not self.converged:
+            self.stride = max(self.stride // 2, 1)
+            new_inds = self._get_neighbor_inds(elite_inds, self.stride)
+            if len(new_inds) == 0 and self.stride == 1:
+                self.converged = True
+        if self.converged:
+            logging.info("Adaptive survey converged after {0:d} refinements, with {1:d} of {2:d} grid designs optimized".format(
+                         self.refine_count, len(self.active_inds), len(self.candidate_combos)))
+            return []
+        self.active_inds = sorted(self.active_inds + new_inds)
+        self._select_active()
+        self.refine_count += 1
+        new_corons = [self.candidate_list[ci] for ci in new_inds]
+        if write_files:
+            for coron in new_corons:
+                coron.write_ampl(overwrite=overwrite, verbose=False)
+                coron.write_slurm_script(overwrite=overwrite, verbose=False, **self.slurm_opts)
+        self.ampl_src_status = False
+        self.ampl_submission_status = False
+        self.solution_status = False
+        self.eval_status = False
+        logging.info("Refinement {0:d} at stride {1:d} added {2:d} designs, {3:d} of {4:d} grid designs are now active".format(
+                     self.refine_count, self.stride, len(new_inds), len(self.active_inds), len(self.candidate_combos)))
+        return new_corons
+
 class LyotCoronagraph(object): # Lyot coronagraph base class
     _file_fields = { 'fileorg': ['work dir', 'ampl src dir', 'TelAp dir', 'FPM dir', 'LS dir',
                                  'sol dir', 'log dir', 'eval dir', 'eval subdir', 'slurm dir',
@@ -766,44 +2085,18 @@ class LyotCoronagraph(object): # Lyot coronagraph base class
         if not os.path.exists(self.fileorg['log dir']):
             os.mkdir(self.fileorg['log dir'])
        
-        # If the location of the optimizer input file is not known, 
-        # look for it in the directory corresponding to its specific category
-        if 'TelAp fname' in self.fileorg and self.fileorg['TelAp fname'] is not None and \
-        not os.path.exists(self.fileorg['TelAp fname']) and os.path.exists(self.fileorg['TelAp dir']) and \
-        os.path.dirname(self.fileorg['TelAp fname']) == '':
-            try_fname = os.path.join(self.fileorg['TelAp dir'], self.fileorg['TelAp fname']) 
-            if os.path.exists(try_fname):
-                self.fileorg['TelAp fname'] = try_fname
-            else:
-                logging.warning("Warning: Could not find the specified telescope aperture file \"{0}\" in {1}".format(self.fileorg['TelAp fname'], \
-                                 self.fileorg['TelAp dir']))
-        if 'FPM fname' in self.fileorg and self.fileorg['FPM fname'] is not None and \
-        not os.path.exists(self.fileorg['FPM fname']) and os.path.exists(self.fileorg['FPM dir']) and \
-        os.path.dirname(self.fileorg['FPM fname']) == '':
-            try_fname = os.path.join(self.fileorg['FPM dir'], self.fileorg['FPM fname']) 
-            if os.path.exists(try_fname):
-                self.fileorg['FPM fname'] = try_fname
-            else:
-                logging.warning("Warning: Could not find the specified FPM file \"{0}\" in {1}".format(self.fileorg['FPM fname'], \
-                                 self.fileorg['FPM dir']))
-        if 'LS fname' in self.fileorg and self.fileorg['LS fname'] is not None and \
-        not os.path.exists(self.fileorg['LS fname']) and os.path.exists(self.fileorg['LS dir']) and \
-        os.path.dirname(self.fileorg['LS fname']) == '':
-            try_fname = os.path.join(self.fileorg['LS dir'], self.fileorg['LS fname']) 
-            if os.path.exists(try_fname):
-                self.fileorg['LS fname'] = try_fname
-            else:
-                logging.warning("Warning: Could not find the specified LS file \"{0}\" in {1}".format(self.fileorg['LS fname'], \
-                                 self.fileorg['LS dir']))
-        if 'LDZ fname' in self.fileorg and self.fileorg['LDZ fname'] is not None and \
-        not os.path.exists(self.fileorg['LDZ fname']) and os.path.exists(self.fileorg['LS dir']) and \
-        os.path.dirname(self.fileorg['LDZ fname']) == '':
-            try_fname = os.path.join(self.fileorg['LS dir'], self.fileorg['LDZ fname']) 
-            if os.path.exists(try_fname):
-                self.fileorg['LDZ fname'] = try_fname
-            else:
-                logging.warning("Warning: Could not find the specified LDZ file \"{0}\" in {1}".format(self.fileorg['LDZ fname'], \
-                                 self.fileorg['LS dir']))
+        # If the location of an optimizer input file is not known, look it up in the mask library:
+        # in the directory corresponding to its specific category, then in the shared library directories
+        for namekey, dirkey, descrip in [('TelAp fname', 'TelAp dir', 'telescope aperture'), ('FPM fname', 'FPM dir', 'FPM'),
+                                         ('LS fname', 'LS dir', 'LS'), ('LDZ fname', 'LS dir', 'LDZ')]:
+            if namekey in self.fileorg and self.fileorg[namekey] is not None and \
+            not os.path.exists(self.fileorg[namekey]) and os.path.dirname(self.fileorg[namekey]) == '':
+                try_fname = mask_library.locate(self.fileorg[namekey], search_dirs=[self.fileorg[dirkey]])
+                if try_fname is not None:
+                    self.fileorg[namekey] = try_fname
+                else:
+                    logging.warning("Warning: Could not find the specified {0} file \"{1}\" in {2} or the mask library".format(descrip, \
+                                     self.fileorg[namekey], self.fileorg[dirkey]))
 
         # If the specified ampl source filename is a simple name with no directory, append it to the ampl source directory.
         if 'ampl src fname' in self.fileorg and self.fileorg['ampl src fname'] is not None and \
@@ -846,6 +2139,7 @@ class LyotCoronagraph(object): # Lyot coronagraph base class
         setattr(self, 'ampl_submission_status', None) # Only changed by the queue filler program
         setattr(self, 'solution_status', False) # Only changed by the queue filler program
         setattr(self, 'ampl_completion_time', None)
+        setattr(self, 'screen_status', None) # Set to 'infeasible' or 'dominated' by a survey feasibility screen
 
         setattr(self, 'eval_metrics', {})
         self.eval_metrics['inc energy'] = None
@@ -859,20 +2153,419 @@ class LyotCoronagraph(object): # Lyot coronagraph base class
         self.eval_metrics['fwhm area'] = None
         self.eval_metrics['apod nb res ratio'] = None
 
-    def check_ampl_input_files(self):
+    def check_ampl_input_files(self, status_index=None):
+        # status_index: optional FileStatusIndex to answer the existence checks from directory listings
         status = True
         if self.design['LS']['aligntol'] is not None:
             checklist = ['TelAp fname', 'FPM fname', 'LS fname', 'LDZ fname']
         else:
             checklist = ['TelAp fname', 'FPM fname', 'LS fname']
+        path_exists = status_index.exists if status_index is not None else os.path.exists
+        for fname in checklist:
+            if not path_exists(self.fileorg[fname]) and len(mask_library.library_dirs) > 0:
+                library_fname = mask_library.locate(self.fileorg[fname])
+                if library_fname is not None: # same mask in a shared library directory
+                    self.fileorg[fname] = library_fname
         for fname in checklist:
-            if not os.path.exists(self.fileorg[fname]):
+            if not path_exists(self.fileorg[fname]):
                 status = False
                 logging.warning("Missing {:s}".format(self.fileorg[fname]))
                 break
         self.ampl_infile_status = status
         return status
 
+    def estimate_solver_hours(self):
+        # Rough optimization run time, scaled from the typical run time of a 125-point, 3-wavelength program
+        if 'aligntol' in self.design['LS'] and self.design['LS']['aligntol'] is not None:
+            return 3*(self.design['Pupil']['N']/125.)**2*(self.design['Image']['Nlam']/3.)**3
+        else:
+            return 1.5*(self.design['Pupil']['N']/125.)**2*(self.design['Image']['Nlam']/3.)**3
+
+    def get_telap_variant_fname(self, gap=None, N=None, required=False):
+        # Telescope aperture file of this design's aperture with another gap padding or array size, looked up
+        # in the mask library by its parameters. Returns None, or raises IOError if required, when there is none.
+        params = mask_library.parse_fname(self.fileorg['TelAp fname'])
+        variant_fname = None
+        if params is not None and 'gap' in params:
+            pupil = self.design['Pupil']
+            variant_fname = mask_library.find(search_dirs=[os.path.dirname(os.path.abspath(self.fileorg['TelAp fname'])),
+                                                           self.fileorg['TelAp dir']],
+                                              kind='TelAp', symm=params['symm'], prim=pupil['prim'], secobs=str(pupil['secobs']),
+                                              thick=pupil['thick'], centobs=int(pupil['centobs']),
+                                              gap=pupil['gap'] if gap is None else gap, N=pupil['N'] if N is None else N)
+        if variant_fname is None and required:
+            raise IOError("No telescope aperture like {0:s} with gap={1}, N={2} in the mask library".format(
+                          self.fileorg['TelAp fname'], gap, N))
+        return variant_fname
+
+    def get_telap_level(self, gap=None, N=None):
+        # Telescope aperture array of this design's aperture with another gap padding or array size. Served from
+        # the mask library, or else binned from the aperture's high-resolution master if mask_library.telap_src_dir
+        # is set, with the level cached in the aperture family's pyramid file in mask_library.cache_dir, if set.
+        variant_fname = self.get_telap_variant_fname(gap=gap, N=N)
+        if variant_fname is not None:
+            return mask_library.load(variant_fname)
+        params = mask_library.parse_fname(self.fileorg['TelAp fname'])
+        if mask_library.telap_src_dir is None or params is None or 'gap' not in params:
+            return mask_library.load(self.get_telap_variant_fname(gap=gap, N=N, required=True))
+        import scda_masks
+        pupil = self.design['Pupil']
+        return scda_masks.get_telap_level(mask_library.telap_src_dir, pupil['prim'], pupil['secobs'], pupil['thick'], pupil['centobs'],
+                                          pupil['gap'] if gap is None else gap, pupil['N'] if N is None else N,
+                                          symm=params['symm'], cache_dir=mask_library.cache_dir)
+
+    def __getstate__(self):
+        # Leave the propagation caches out of pickled survey files
+        state = self.__dict__.copy()
+        for key in list(state.keys()):
+            if key.startswith('_cache_'):
+                state.pop(key)
+        return state
+
+    def _get_onax_masks(self): # full-plane arrays for on-axis field propagation
+        if self.design['Pupil']['edge'] == 'floor': # floor to binary
+            TelAp_p = np.floor(mask_library.load(self.fileorg['TelAp fname'])).astype(int)
+        elif self.design['Pupil']['edge'] == 'round': # round to binary
+            TelAp_p = np.round(mask_library.load(self.fileorg['TelAp fname'])).astype(int)
+        else: # keey it gray
+            TelAp_p = mask_library.load(self.fileorg['TelAp fname'])
+        A_col = load_solution(self.fileorg['sol fname'])[:,-1]
+        FPM_p = mask_library.load(self.fileorg['FPM fname'])
+        LS_p = mask_library.load(self.fileorg['LS fname'])
+        A_p = A_col.reshape(TelAp_p.shape)
+        if isinstance(self, (QuarterplaneAPLC, QuarterplaneSPLC)):
+            TelAp = np.concatenate((np.concatenate((TelAp_p[::-1,::-1], TelAp_p[:,::-1]),axis=0),
+                                    np.concatenate((TelAp_p[::-1,:], TelAp_p),axis=0)), axis=1)
+            A = np.concatenate((np.concatenate((A_p[::-1,::-1], A_p[:,::-1]),axis=0),
+                                np.concatenate((A_p[::-1,:], A_p),axis=0)), axis=1)
+            FPM = np.concatenate((np.concatenate((FPM_p[::-1,::-1], FPM_p[:,::-1]),axis=0),
+                                  np.concatenate((FPM_p[::-1,:], FPM_p),axis=0)), axis=1)
+            LS = np.concatenate((np.concatenate((LS_p[::-1,::-1], LS_p[:,::-1]),axis=0),
+                                 np.concatenate((LS_p[::-1,:], LS_p),axis=0)), axis=1)
+        elif isinstance(self, (HalfplaneAPLC, HalfplaneSPLC)):
+            TelAp = np.concatenate((TelAp_p[:,::-1], TelAp_p), axis=1)
+            A = np.concatenate((A_p[:,::-1], A_p), axis=1)
+            FPM = np.concatenate((np.concatenate((FPM_p[::-1,::-1], FPM_p[:,::-1]),axis=0),
+                                  np.concatenate((FPM_p[::-1,:], FPM_p),axis=0)), axis=1)
+            LS = np.concatenate((LS_p[:,::-1], LS_p), axis=1)
+        else:
+            TelAp = TelAp_p
+            A = A_p
+            FPM = FPM_p
+            LS = LS_p
+        return TelAp, A, FPM, LS
+
+    def _get_lyot_plane_fields(self, Nlam=None):
+        # Occulted and unocculted Lyot plane fields at each wavelength, along with the on-axis setup and the
+        # PropagationCore over the wavelengths, cached until the solution changes
+        if Nlam is None:
+            Nlam = self.design['Image']['Nlam']
+        setup = self._get_onax_setup()
+        cache_key = (Nlam, setup['key'])
+        if getattr(self, '_cache_lyot_fields', None) is not None and self._cache_lyot_fields['key'] == cache_key:
+            return self._cache_lyot_fields
+        bw = self.design['Image']['bw']
+        core = PropagationCore(np.linspace(1.-bw/2, 1.+bw/2, Nlam))
+        Psi_C, Psi_C_0 = self._propagate_pupil_to_lyot(setup['Psi_A'], core, setup, get_unocculted=True)
+        self._cache_lyot_fields = dict(setup, key=cache_key, core=core, wrs=core.wrs, Psi_C=Psi_C, Psi_C_0=Psi_C_0)
+        return self._cache_lyot_fields
+
+    def _get_batch_core(self, fields, batch_len):
+        # PropagationCore over the wavelengths tiled batch_len times, so a batch of Lyot stops or pupil modes
+        # is propagated at all wavelengths as one stack, indexed [batch item*Nlam + wavelength]
+        batch_cores = fields.setdefault('batch cores', {})
+        if batch_len not in batch_cores:
+            batch_cores[batch_len] = PropagationCore(np.tile(fields['wrs'], batch_len))
+        return batch_cores[batch_len]
+
+    def get_lyot_misalignment_contrast(self, offsets, fp2res=4, rho_out=None, Nlam=None, batch_size=16):
+        # Band-averaged dark zone contrast for a list of Lyot stop misalignments, each given as a tuple
+        # (x shift, y shift, rotation), with the shifts in Lyot plane samples (the units of 'aligntol')
+        # and the rotation in degrees. The Lyot plane fields are computed once per wavelength and cached
+        # by _get_lyot_plane_fields(), so each misalignment costs only the final propagation, which is
+        # done for a batch of misaligned stops at all wavelengths at a time. Returns the mean and peak
+        # contrast arrays.
+        fields = self._get_lyot_plane_fields(Nlam=Nlam)
+        wrs = fields['wrs']
+        us = fields['us']
+        du = fields['du']
+        LS = fields['LS']
+        if rho_out is None:
+            rho_out = fields['rho out']
+        M_fp2 = int(np.ceil(rho_out*fp2res))
+        dxi = 1./fp2res
+        xis = np.linspace(-M_fp2+0.5,M_fp2-0.5,2*M_fp2)*dxi
+        dz_mask = self._get_dark_zone_mask(xis)
+
+        mean_contrast = np.zeros(len(offsets))
+        peak_contrast = np.zeros(len(offsets))
+        for b0 in range(0, len(offsets), batch_size):
+            batch = offsets[b0:b0+batch_size]
+            LS_batch = np.zeros((len(batch),) + LS.shape)
+            for bi, (shift_x, shift_y, rot) in enumerate(batch):
+                LS_mis = LS
+                if rot != 0:
+                    LS_mis = scipy.ndimage.interpolation.rotate(LS_mis, rot, reshape=False, order=1)
+                if shift_x != 0 or shift_y != 0:
+                    LS_mis = scipy.ndimage.interpolation.shift(LS_mis, (shift_y, shift_x), order=1)
+                LS_batch[bi] = LS_mis
+            core = self._get_batch_core(fields, len(batch))
+            Psi_C_stop = (fields['Psi_C'][None]*LS_batch[:,None]).reshape((-1,) + LS.shape)
+            Psi_D = core.mft(Psi_C_stop, us, xis, du, 'D')
+            Psi_D_0_peak = np.abs(np.sum(fields['Psi_C_0'][None]*LS_batch[:,None], axis=(2,3)))*du*du/wrs
+            intens_batch = np.mean(core.intensity(Psi_D, 'I_D').reshape((len(batch), len(wrs), 2*M_fp2, 2*M_fp2))/
+                                   np.power(Psi_D_0_peak, 2)[:,:,None,None], axis=1)
+            mean_contrast[b0:b0+len(batch)] = np.mean(intens_batch[:,dz_mask], axis=1)
+            peak_contrast[b0:b0+len(batch)] = np.max(intens_batch[:,dz_mask], axis=1)
+        return mean_contrast, peak_contrast
+
+    def get_lyot_misalignment_map(self, max_shift=None, Nshift=9, rot=0., **kwargs):
+        # Contrast over a grid of x-y Lyot stop shifts, for checking a design against its 'aligntol'.
+        # Returns the shift values and the mean and peak contrast maps indexed [y shift, x shift].
+        if max_shift is None:
+            if self.design['LS']['aligntol'] is not None:
+                max_shift = 2*self.design['LS']['aligntol']
+            else:
+                max_shift = 2
+        shift_vals = np.linspace(-max_shift, max_shift, Nshift)
+        offsets = [(shift_x, shift_y, rot) for shift_y in shift_vals for shift_x in shift_vals]
+        mean_contrast, peak_contrast = self.get_lyot_misalignment_contrast(offsets, **kwargs)
+        return shift_vals, mean_contrast.reshape((Nshift, Nshift)), peak_contrast.reshape((Nshift, Nshift))
+
+    def _get_variant_design(self, design_mods):
+        # Copy of the design dictionary with parameter overrides keyed by category, as in make_proxy_coron()
+        design = dict((keycat, dict(self.design[keycat])) for keycat in self.design)
+        for keycat, mods in design_mods.items():
+            design[keycat].update(mods)
+        return design
+
+    def _get_gray_fpm(self, fp1, fpm_quarter):
+        # Full-plane FPM on the FP1 grid of get_fpm_variant_contrast() from the quarter of a gray-pixel mask made
+        # by scda_masks, the same sampling as the solved masks, zero beyond the extent of the mask
+        M_fp1 = len(fp1['mxs'])//2
+        M = min(M_fp1, fpm_quarter.shape[0])
+        quarter = np.zeros((M_fp1, M_fp1))
+        quarter[:M,:M] = fpm_quarter[:M,:M]
+        return np.concatenate((np.concatenate((quarter[::-1,::-1], quarter[:,::-1]),axis=0),
+                               np.concatenate((quarter[::-1,:], quarter),axis=0)), axis=1)
+
+    def get_fpm_variant_contrast(self, fpm_variants, fp1res=None, fp2res=4, rho_out=None, Nlam=None):
+        # Band-averaged image plane intensity and dark zone contrast of this apodizer with each of a list of
+        # focal plane mask variants, given as design overrides, e.g. [{'FPM': {'rad': 3.5}}, {'FPM': {'rad': 4.},
+        # 'Image': {'bowang': 60}}] for an APLC or [{'FPM': {'R0': 3.6, 'openang': 90}}] for an SPLC. The FP1 field
+        # is propagated once per wavelength on a grid covering the largest mask and cached by _get_fp1_field(),
+        # so each variant only costs the masking and the propagations downstream of the FPM. Each variant's
+        # contrast is measured over its own dark zone. The variant masks are gray-pixel masks sampled like the
+        # solved ones (see scda_masks), so with the default fp1res a variant with the solved design's parameters
+        # reproduces get_onax_psf(). Returns the image plane coordinates, the intensity maps, and the mean and
+        # peak contrast arrays.
+        variant_designs = [self._get_variant_design(design_mods) for design_mods in fpm_variants]
+        fp1_extent = max([self._get_fpm_extent(design)[0] for design in variant_designs])
+        fp1 = self._get_fp1_field(fp1_extent, fp1res=fp1res, Nlam=Nlam)
+        core = fp1['core']
+        if rho_out is None:
+            rho_out = max([self._get_fpm_extent(design)[1] for design in variant_designs])
+        M_fp2 = int(np.ceil(rho_out*fp2res))
+        dxi = 1./fp2res
+        xis = np.linspace(-M_fp2+0.5,M_fp2-0.5,2*M_fp2)*dxi
+
+        intens_maps = np.zeros((len(variant_designs), 2*M_fp2, 2*M_fp2))
+        mean_contrast = np.zeros(len(variant_designs))
+        peak_contrast = np.zeros(len(variant_designs))
+        for vi, design in enumerate(variant_designs):
+            Psi_C_stop, Psi_D_0_peak = self._propagate_fp1_to_lyot(fp1, design)
+            Psi_D = core.mft(Psi_C_stop, fp1['us'], xis, fp1['du'], 'D')
+            intens_maps[vi] = np.mean(core.intensity(Psi_D, 'I_D')/np.power(np.absolute(Psi_D_0_peak), 2)[:,None,None], axis=0)
+            dz_mask = self._get_dark_zone_mask(xis, design)
+            mean_contrast[vi] = np.mean(intens_maps[vi][dz_mask])
+            peak_contrast[vi] = np.max(intens_maps[vi][dz_mask])
+        return xis, intens_maps, mean_contrast, peak_contrast
+
+    def get_aberration_jacobian(self, basis=None, Nzern=None, fp2res=4, rho_out=None, Nlam=None, batch_size=8):
+        # Linear response of the normalized image plane field to a basis of pupil phase modes, at each
+        # wavelength. The basis holds the wavefront of each mode in waves at the central wavelength, per
+        # unit amplitude, on the pupil grid; by default it is Noll Zernikes 2 through the 'Aber' category's
+        # Nzern, in waves RMS. A custom basis can hold e.g. segment piston modes. The Jacobian and the
+        # aberration-free field are cached, so the contrast curves and maps below only cost matrix products.
+        fields = self._get_lyot_plane_fields(Nlam=Nlam)
+        if basis is None:
+            if Nzern is None:
+                Nzern = self._eval_fields['Aber']['Nzern'][1]
+            basis_key = ('zern', Nzern)
+        else:
+            basis = np.asarray(basis, dtype=float)
+            basis_key = hashlib.sha1(basis.tobytes()).hexdigest()
+        if rho_out is None:
+            rho_out = fields['rho out']
+        cache_key = (fields['key'], basis_key, fp2res, rho_out)
+        if getattr(self, '_cache_aber_jacobian', None) is not None and self._cache_aber_jacobian['key'] == cache_key:
+            return self._cache_aber_jacobian
+        if basis is None:
+            basis = get_zernike_basis(range(2, Nzern+1), fields['xs'])
+
+        wrs = fields['wrs']
+        us = fields['us']
+        du = fields['du']
+        LS = fields['LS']
+        M_fp2 = int(np.ceil(rho_out*fp2res))
+        dxi = 1./fp2res
+        xis = np.linspace(-M_fp2+0.5,M_fp2-0.5,2*M_fp2)*dxi
+        Psi_D_0_peak = np.abs(np.sum(fields['Psi_C_0']*LS, axis=(1,2)))*du*du/wrs
+        E_0 = fields['core'].mft(fields['Psi_C']*LS, us, xis, du, 'D')/Psi_D_0_peak[:,None,None]
+        jacobian = np.zeros((len(wrs), basis.shape[0], 2*M_fp2, 2*M_fp2), dtype=complex)
+        for b0 in range(0, basis.shape[0], batch_size):
+            modes = basis[b0:b0+batch_size]
+            core = self._get_batch_core(fields, len(modes))
+            dPsi_A = ((1j*2*np.pi/wrs)[None,:,None,None]*modes[:,None]*fields['Psi_A']).reshape((-1,) + fields['Psi_A'].shape)
+            dPsi_C = self._propagate_pupil_to_lyot(dPsi_A, core, fields)
+            dPsi_D = core.mft(dPsi_C*LS, us, xis, du, 'D').reshape((len(modes), len(wrs), 2*M_fp2, 2*M_fp2))
+            jacobian[:, b0:b0+len(modes)] = (dPsi_D/Psi_D_0_peak[None,:,None,None]).transpose(1,0,2,3)
+        self._cache_aber_jacobian = {'key': cache_key, 'wrs': wrs, 'xis': xis, 'dz mask': self._get_dark_zone_mask(xis),
+                                     'E_0': E_0, 'jacobian': jacobian}
+        return self._cache_aber_jacobian
+
+    def get_aberration_contrast_curves(self, ampls, modes=None, **kwargs):
+        # Band-averaged mean dark zone contrast of the linearized field E_0 + a*J_k, for each mode k and
+        # amplitude a. Returns an array indexed [mode, amplitude].
+        jac = self.get_aberration_jacobian(**kwargs)
+        dz_mask = jac['dz mask']
+        E_0 = jac['E_0'][:, dz_mask]
+        J = jac['jacobian'][:, :, dz_mask]
+        if modes is None:
+            modes = range(J.shape[1])
+        ampls = np.asarray(ampls, dtype=float)
+        const_term = np.mean(np.abs(E_0)**2)
+        lin_term = np.mean(2*np.real(np.conj(E_0[:,None,:])*J), axis=(0,2))
+        quad_term = np.mean(np.abs(J)**2, axis=(0,2))
+        return np.array([const_term + lin_term[k]*ampls + quad_term[k]*ampls**2 for k in modes])
+
+    def get_aberration_sensitivity_maps(self, **kwargs):
+        # Band-averaged second-order contrast maps |J_k|^2 of each mode (contrast per squared unit
+        # amplitude) over the dark zone, zero elsewhere. Returns the image coordinates and the map cube.
+        jac = self.get_aberration_jacobian(**kwargs)
+        sens_maps = np.mean(np.abs(jac['jacobian'])**2, axis=0)
+        sens_maps[:, ~jac['dz mask']] = 0
+        return jac['xis'], sens_maps
+
+    def _get_image_fields(self, wrs, xis, setup):
+        # On-axis final focal plane fields at the given wavelength ratios only, normalized to the unocculted peak
+        core = PropagationCore(wrs)
+        du = setup['du']
+        Psi_C, Psi_C_0 = self._propagate_pupil_to_lyot(setup['Psi_A'], core, setup, get_unocculted=True)
+        Psi_D_0_peak = np.abs(np.sum(Psi_C_0*setup['LS'], axis=(1,2)))*du*du/core.wrs
+        return core.mft(Psi_C*setup['LS'], setup['us'], xis, du, 'D')/Psi_D_0_peak[:,None,None]
+
+    def get_onax_psf_interp(self, fp2res=8, rho_out=None, Nlam=None, Nanchor=3, mode='poly', check_error=True):
+        # On-axis PSF over the band, propagated exactly only at Nanchor anchor wavelengths. With mode 'poly',
+        # the normalized field at each wavelength is the Lagrange polynomial through the fields at Chebyshev
+        # anchor wavelengths. With mode 'scale', the fields at the two neighboring anchors (spaced evenly,
+        # band edges included) are resampled to the wavelength's scaled image coordinates, which accounts for
+        # the chromatic scaling of the final propagation, and blended linearly. When check_error is set, the
+        # interpolated intensity is compared with exact propagation midway between anchors, where the
+        # interpolation error peaks. Only the anchor and check wavelengths are propagated, in one stack.
+        # Returns the image coordinates, the intensity cube, and the error estimate.
+        setup = self._get_onax_setup()
+        bw = self.design['Image']['bw']
+        if Nlam is None:
+            Nlam = self.design['Image']['Nlam']
+        if rho_out is None:
+            rho_out = setup['rho out']
+        M_fp2 = int(np.ceil(rho_out*fp2res))
+        dxi = 1./fp2res
+        xis = np.linspace(-M_fp2+0.5,M_fp2-0.5,2*M_fp2)*dxi
+        wrs = np.linspace(1.-bw/2, 1.+bw/2, Nlam)
+        Nanchor = min(Nanchor, Nlam)
+        if mode == 'poly':
+            anchor_wrs = 1. + bw/2*np.cos((2*np.arange(Nanchor)[::-1] + 1)*np.pi/(2*Nanchor))
+        elif mode == 'scale':
+            anchor_wrs = np.linspace(1.-bw/2, 1.+bw/2, Nanchor)
+        else:
+            logging.error("Unrecognized chromatic interpolation mode {:s}".format(mode))
+            return 1
+        check_wrs = np.array([])
+        if check_error and Nanchor > 1:
+            check_wrs = (anchor_wrs[:-1] + anchor_wrs[1:])/2
+        image_fields = self._get_image_fields(np.concatenate([anchor_wrs, check_wrs]), xis, setup)
+        anchor_fields = image_fields[:Nanchor]
+
+        def interp_field(wr):
+            if mode == 'poly':
+                field = np.zeros(xis.shape*2, dtype=complex)
+                for ai, anchor_wr in enumerate(anchor_wrs):
+                    lagrange_weight = np.prod([(wr - other_wr)/(anchor_wr - other_wr)
+                                               for aj, other_wr in enumerate(anchor_wrs) if aj != ai])
+                    field += lagrange_weight*anchor_fields[ai]
+                return field
+            if Nanchor == 1:
+                ai = 0
+                blend = 0.
+            else:
+                ai = min(np.searchsorted(anchor_wrs, wr, side='right') - 1, Nanchor - 2)
+                blend = (wr - anchor_wrs[ai])/(anchor_wrs[ai+1] - anchor_wrs[ai])
+            field = np.zeros(xis.shape*2, dtype=complex)
+            for aj, weight in ((ai, 1. - blend), (ai + 1, blend)):
+                if weight == 0:
+                    continue
+                scaled_inds = (xis*anchor_wrs[aj]/wr - xis[0])/dxi
+                coords = np.meshgrid(scaled_inds, scaled_inds, indexing='ij')
+                field += weight*(scipy.ndimage.interpolation.map_coordinates(anchor_fields[aj].real, coords, order=3) +
+                                 1j*scipy.ndimage.interpolation.map_coordinates(anchor_fields[aj].imag, coords, order=3))
+            return field
+
+        intens_polychrom = np.array([np.abs(interp_field(wr))**2 for wr in wrs])
+        interp_err = None
+        if len(check_wrs) > 0:
+            dz_mask = self._get_dark_zone_mask(xis)
+            max_rel_err = 0.
+            mean_rel_err = 0.
+            for ci, wr in enumerate(check_wrs):
+                intens_exact = np.abs(image_fields[Nanchor + ci])**2
+                intens_interp = np.abs(interp_field(wr))**2
+                max_rel_err = max(max_rel_err, np.max(np.abs(intens_interp - intens_exact)[dz_mask])/np.max(intens_exact[dz_mask]))
+                mean_rel_err = max(mean_rel_err, np.abs(np.mean(intens_interp[dz_mask])/np.mean(intens_exact[dz_mask]) - 1))
+            interp_err = {'check wrs': check_wrs, 'max rel err': max_rel_err, 'mean contrast rel err': mean_rel_err}
+            logging.info("Chromatic interpolation ({0:s}, {1:d} anchors): max dark zone intensity error {2:.2e} of the dark zone maximum, mean contrast error {3:.2e}".format(
+                         mode, Nanchor, max_rel_err, mean_rel_err))
+        return xis, intens_polychrom, interp_err
+
+    def get_precision_report(self, fp2res=8, rho_out=None, Nlam=None, verbose=True):
+        # Compare single precision evaluation against double precision for this design: the band-averaged
+        # on-axis PSF in the dark zone, and each of the scalar evaluation metrics. Leaves eval_metrics as
+        # computed in double precision. Returns a dictionary of errors and run times.
+        report = {}
+        intens = {}
+        metrics = {}
+        for precision in ('single', 'double'):
+            t_start = time.time()
+            xis, intens_polychrom = self.get_onax_psf(fp2res=fp2res, rho_out=rho_out, Nlam=Nlam, precision=precision)[:2]
+            report['onax time ' + precision] = time.time() - t_start
+            intens[precision] = np.mean(intens_polychrom, axis=0)
+            t_start = time.time()
+            self.get_metrics(Nlam=Nlam, verbose=False, precision=precision)
+            report['metrics time ' + precision] = time.time() - t_start
+            metrics[precision] = dict(self.eval_metrics)
+        dz_mask = self._get_dark_zone_mask(np.ravel(xis))
+        contrast_err = np.abs(intens['single'] - intens['double'])[dz_mask]
+        report['mean contrast'] = np.mean(intens['double'][dz_mask])
+        report['max contrast abs err'] = np.max(contrast_err)
+        report['rms contrast abs err'] = np.sqrt(np.mean(contrast_err**2))
+        report['mean contrast rel err'] = np.abs(np.mean(intens['single'][dz_mask])/report['mean contrast'] - 1)
+        report['metric rel err'] = {}
+        for key in metrics['double']:
+            if isinstance(metrics['double'][key], (float, np.floating)) and metrics['double'][key] != 0:
+                report['metric rel err'][key] = abs(metrics['single'][key]/metrics['double'][key] - 1)
+        if verbose:
+            print("Single vs. double precision evaluation of {:s}".format(self.fileorg['job name']))
+            print("    mean dark zone contrast {0:.3e}, max abs error {1:.2e}, rms abs error {2:.2e}, mean contrast rel error {3:.2e}".format(
+                  report['mean contrast'], report['max contrast abs err'], report['rms contrast abs err'],
+                  report['mean contrast rel err']))
+            for key in sorted(report['metric rel err']):
+                print("    {0:s}: rel error {1:.2e}".format(key, report['metric rel err'][key]))
+            print("    on-axis PSF time {0:.2f} s (single) / {1:.2f} s (double), metrics time {2:.2f} s / {3:.2f} s".format(
+                  report['onax time single'], report['onax time double'],
+                  report['metrics time single'], report['metrics time double']))
+        return report
+
     def get_design_portrait(self, intens_maps, intens_curves, xis, seps, star_diams,
                             second_curve_diam=None, use_gray_gap_zero=False, get_big_telap=False):
         if get_big_telap:
@@ -961,10 +2654,12 @@ class LyotCoronagraph(object): # Lyot coronagraph base class
                         'FPM radius'], fontsize=12, loc='upper center')
         return portrait_fig
 
-    def write_design_package(self, eval_path=None, pixscale_lamoD=0.25, Nlam=None, dpi=300):
+    def write_design_package(self, eval_path=None, pixscale_lamoD=0.25, Nlam=None, dpi=300, bundle=False):
         """
         Write a coronagraph design package including mask files (Telescope pupil,
         Apodizer, FPM, Lyot stop) in FITS format and a simple portrait viewgraph.
+        With bundle=True the masks go to extensions of one compressed FITS file,
+        design_bundle.fits, instead of one file each.
         TBA: example PSF evaluation scripts.
         """
         if eval_path is None:
@@ -984,18 +2679,25 @@ class LyotCoronagraph(object): # Lyot coronagraph base class
             Nlam = 2*self.design['Image']['Nlam'] + 1
 
         TelAp, Apod, FPM, LS = self.get_coron_masks(use_gray_gap_zero=False)
-        telap_hdu = pyfits.PrimaryHDU(TelAp)
-        telap_fits_fname = os.path.join(eval_path, 'TelAp.fits')
-        telap_hdu.writeto(telap_fits_fname, clobber=True)
-        apod_hdu = pyfits.PrimaryHDU(Apod)
-        apod_fits_fname = os.path.join(eval_path, 'Apod.fits')
-        apod_hdu.writeto(apod_fits_fname, clobber=True)
-        fpm_hdu = pyfits.PrimaryHDU(FPM)
-        fpm_fits_fname = os.path.join(eval_path, 'FPM.fits')
-        fpm_hdu.writeto(fpm_fits_fname, clobber=True)
-        LS_hdu = pyfits.PrimaryHDU(LS)
-        LS_fits_fname = os.path.join(eval_path, 'LS.fits')
-        LS_hdu.writeto(LS_fits_fname, clobber=True)
+        if bundle: # masks as tile-compressed extensions of one file
+            bundle_header = pyfits.Header()
+            bundle_header['DESIGN'] = self.fileorg['job name']
+            bundle_writer = EvalBundleWriter(os.path.join(eval_path, 'design_bundle.fits'), header=bundle_header)
+            for extname, mask in zip(['TELAP', 'APOD', 'FPM', 'LS'], [TelAp, Apod, FPM, LS]):
+                bundle_writer.write_image(extname, mask)
+        else:
+            telap_hdu = pyfits.PrimaryHDU(TelAp)
+            telap_fits_fname = os.path.join(eval_path, 'TelAp.fits')
+            telap_hdu.writeto(telap_fits_fname, clobber=True)
+            apod_hdu = pyfits.PrimaryHDU(Apod)
+            apod_fits_fname = os.path.join(eval_path, 'Apod.fits')
+            apod_hdu.writeto(apod_fits_fname, clobber=True)
+            fpm_hdu = pyfits.PrimaryHDU(FPM)
+            fpm_fits_fname = os.path.join(eval_path, 'FPM.fits')
+            fpm_hdu.writeto(fpm_fits_fname, clobber=True)
+            LS_hdu = pyfits.PrimaryHDU(LS)
+            LS_fits_fname = os.path.join(eval_path, 'LS.fits')
+            LS_hdu.writeto(LS_fits_fname, clobber=True)
 
         if isinstance(self, NdiayeAPLC):
             xis, intens_polychrom, seps, radial_intens_polychrom = self.get_onax_psf(Nlam=Nlam)
@@ -1016,7 +2718,10 @@ class LyotCoronagraph(object): # Lyot coronagraph base class
         return eval_path
 
     def write_eval_products(self, pixscale_lamoD=0.25, star_diam_vec=None, Npts_star_diam=7, Nlam=None, 
-                            norm='aperture', second_curve_diam=0.2, dpi=300, get_big_telap=False):
+                            norm='aperture', second_curve_diam=0.2, dpi=300, get_big_telap=False,
+                            jitter_mas_vec=None, telap_diam=None, jitter_lam0_um=1.0, bundle=False):
+        # With bundle=True, the products go to extensions of one tile-compressed FITS file, eval_bundle.fits
+        # (see EvalBundleWriter), together with the masks, instead of one FITS file per product
         if 'eval subdir' not in self.fileorg or self.fileorg['eval subdir'] is None:
             if 'design ID' in self.fileorg:
                 design_label = "{:s}_{:s}".format(self.fileorg['design ID'],
@@ -1033,24 +2738,10 @@ class LyotCoronagraph(object): # Lyot coronagraph base class
             star_diam_vec = np.concatenate([np.linspace(0,0.09,10), np.linspace(0.1, 1, 10), np.array([2., 3., 4.])])
         if Nlam is None:
             Nlam = 2*self.design['Image']['Nlam'] + 1
+        timing_start = stage_timer.snapshot() # per-design stage timing report, leaving the totals to outer stages
 
-        stellar_intens_map, stellar_intens_curves, xis, seps, stellar_intens_diam_vec, \
-        offax_psf, offax_psf_offset_vec, sky_trans, contrast_convert_fac = \
-          self.get_yield_input_products(pixscale_lamoD, star_diam_vec, Npts_star_diam, Nlam, norm)
-
-        design_portrait_fig = \
-          self.get_design_portrait(stellar_intens_map*contrast_convert_fac,
-                                   stellar_intens_curves*contrast_convert_fac,
-                                   xis, seps, star_diam_vec,
-                                   second_curve_diam=second_curve_diam, use_gray_gap_zero=False,
-                                   get_big_telap=get_big_telap)
-        design_portrait_fname = os.path.join(self.fileorg['eval subdir'], 'DesignPortrait_{:s}.png'.format(self.fileorg['job name']))
-        design_portrait_fig.savefig(design_portrait_fname, dpi=dpi)
-        logging.info("Wrote design potrait to {:s}".format(design_portrait_fname))
-        plt.close(design_portrait_fig)
-
-        xycent_pix_coord = (float(stellar_intens_map.shape[2])/2, 
-                            float(stellar_intens_map.shape[1])/2)
+        M_fp2 = int(np.ceil((self.design['Image']['oda'] + 0.5)/pixscale_lamoD)) # as in get_yield_input_products()
+        xycent_pix_coord = (float(M_fp2), float(M_fp2))
         obscure_ratio = (np.pi/4 - self.eval_metrics['inc energy'])/(np.pi/4)
 
         stellar_intens_fname = os.path.join(self.fileorg['eval subdir'], 'stellar_intens.fits')
@@ -1072,22 +2763,85 @@ class LyotCoronagraph(object): # Lyot coronagraph base class
         header['N_LAM'] = (Nlam, 'number of wavelength samples used in evaluation')
         header['N_STAR'] = (Npts_star_diam, 'number of points across stellar diameter')
 
-        stellar_intens_hdu = pyfits.PrimaryHDU(stellar_intens_map, header=header)
-        stellar_intens_hdu.writeto(stellar_intens_fname, clobber=True)
-        diam_list_hdu = pyfits.PrimaryHDU(stellar_intens_diam_vec, header=header)
-        diam_list_hdu.writeto(stellar_intens_diam_list_fname, clobber=True)
-        offax_psf_hdu = pyfits.PrimaryHDU(offax_psf, header=header)
-        offax_psf_hdu.writeto(offax_psf_fname, clobber=True)
-        offset_list_hdu = pyfits.PrimaryHDU(offax_psf_offset_vec, header=header)
-        offset_list_hdu.writeto(offax_psf_offset_list_fname, clobber=True)
-        sky_trans_hdu = pyfits.PrimaryHDU(sky_trans, header=header)
-        sky_trans_hdu.writeto(sky_trans_fname, clobber=True)
+        # The off-axis PSF cube is streamed to its file as it is computed
+        if bundle:
+            bundle_fname = os.path.join(self.fileorg['eval subdir'], 'eval_bundle.fits')
+            bundle_writer = EvalBundleWriter(bundle_fname, header=header)
+            offax_psf_kwargs = {'offax_psf_bundle': bundle_writer}
+        else:
+            offax_psf_kwargs = {'offax_psf_fname': offax_psf_fname, 'offax_psf_header': header.copy()}
+        with stage_timer('yield products'):
+            stellar_intens_map, stellar_intens_curves, xis, seps, stellar_intens_diam_vec, \
+            offax_psf, offax_psf_offset_vec, sky_trans, contrast_convert_fac = \
+              self.get_yield_input_products(pixscale_lamoD, star_diam_vec, Npts_star_diam, Nlam, norm, **offax_psf_kwargs)
+
+        with stage_timer('portrait plotting'):
+            design_portrait_fig = \
+              self.get_design_portrait(stellar_intens_map*contrast_convert_fac,
+                                       stellar_intens_curves*contrast_convert_fac,
+                                       xis, seps, star_diam_vec,
+                                       second_curve_diam=second_curve_diam, use_gray_gap_zero=False,
+                                       get_big_telap=get_big_telap)
+            design_portrait_fname = os.path.join(self.fileorg['eval subdir'], 'DesignPortrait_{:s}.png'.format(self.fileorg['job name']))
+            design_portrait_fig.savefig(design_portrait_fname, dpi=dpi)
+            logging.info("Wrote design potrait to {:s}".format(design_portrait_fname))
+            plt.close(design_portrait_fig)
+        if bundle: # release the reader of the off-axis PSF cube before the bundle is appended to
+            offax_psf.bundle.close()
+
+        with stage_timer('FITS writing'):
+            if bundle:
+                bundle_writer.write_image('STELLAR_INTENS', stellar_intens_map)
+                bundle_writer.write_image('STAR_DIAMS', stellar_intens_diam_vec)
+                bundle_writer.write_image('OFFAX_OFFSETS', offax_psf_offset_vec)
+                bundle_writer.write_image('SKY_TRANS', sky_trans)
+                for extname, mask in zip(['TELAP', 'APOD', 'FPM', 'LS'], self.get_coron_masks(use_gray_gap_zero=False)):
+                    bundle_writer.write_image(extname, mask)
+            else:
+                stellar_intens_hdu = pyfits.PrimaryHDU(stellar_intens_map, header=header)
+                stellar_intens_hdu.writeto(stellar_intens_fname, clobber=True)
+                diam_list_hdu = pyfits.PrimaryHDU(stellar_intens_diam_vec, header=header)
+                diam_list_hdu.writeto(stellar_intens_diam_list_fname, clobber=True)
+                offset_list_hdu = pyfits.PrimaryHDU(offax_psf_offset_vec, header=header)
+                offset_list_hdu.writeto(offax_psf_offset_list_fname, clobber=True)
+                sky_trans_hdu = pyfits.PrimaryHDU(sky_trans, header=header)
+                sky_trans_hdu.writeto(sky_trans_fname, clobber=True)
         
-        logging.info("Wrote stellar intensity map to {:s}".format(stellar_intens_fname))
-        logging.info("Wrote stellar intensity diameter list to {:s}".format(stellar_intens_diam_list_fname))
-        logging.info("Wrote off-axis PSF to {:s}".format(offax_psf_fname))
-        logging.info("Wrote off-axis PSF offset list to {:s}".format(offax_psf_offset_list_fname))
-        logging.info("Wrote sky transmission map to {:s}".format(sky_trans_fname))
+        if bundle:
+            logging.info("Wrote evaluation products and masks to {:s}".format(bundle_fname))
+        else:
+            logging.info("Wrote stellar intensity map to {:s}".format(stellar_intens_fname))
+            logging.info("Wrote stellar intensity diameter list to {:s}".format(stellar_intens_diam_list_fname))
+            logging.info("Wrote off-axis PSF to {:s}".format(offax_psf_fname))
+            logging.info("Wrote off-axis PSF offset list to {:s}".format(offax_psf_offset_list_fname))
+            logging.info("Wrote sky transmission map to {:s}".format(sky_trans_fname))
+
+        if jitter_mas_vec is not None: # jitter-smeared copies of the stellar intensity map
+            with stage_timer('jitter maps'):
+                jitter_intens_map = self.get_jitter_stellar_intens(jitter_mas_vec, stellar_intens_map, telap_diam=telap_diam,
+                                                                   lam0_um=jitter_lam0_um, pixscale_lamoD=pixscale_lamoD,
+                                                                   Nlam=Nlam, norm=norm)
+            for ji, jitter_mas in enumerate(jitter_mas_vec):
+                header['JITTER'] = (jitter_mas, 'RMS jitter per axis in mas')
+                header['LAMBDA0'] = (jitter_lam0_um, 'wavelength in microns assumed for jitter')
+                if telap_diam is not None:
+                    header['TELDIAM'] = (telap_diam, 'telescope diameter in meters assumed for jitter')
+                else:
+                    header['TELDIAM'] = (self._eval_fields['Tel']['TelAp diam'][1], 'telescope diameter in meters assumed for jitter')
+                if bundle: # one extension version per jitter value
+                    bundle_writer.write_image('STELLAR_INTENS_JITTER', jitter_intens_map[ji], header=header, extver=ji+1)
+                    logging.info("Wrote stellar intensity map with {0:.2f} mas RMS jitter to {1:s}".format(jitter_mas, bundle_fname))
+                    continue
+                stellar_intens_jitter_fname = os.path.join(self.fileorg['eval subdir'], 'stellar_intens_jitter_{:.2f}mas.fits'.format(jitter_mas))
+                stellar_intens_jitter_hdu = pyfits.PrimaryHDU(jitter_intens_map[ji], header=header)
+                stellar_intens_jitter_hdu.writeto(stellar_intens_jitter_fname, clobber=True)
+                logging.info("Wrote stellar intensity map with {0:.2f} mas RMS jitter to {1:s}".format(jitter_mas, stellar_intens_jitter_fname))
+
+        if stage_timer.enabled:
+            timing_fname = os.path.join(self.fileorg['eval subdir'], 'eval_timing.json')
+            setattr(self, 'eval_timing', stage_timer.write_report(timing_fname, extra={'design': self.fileorg['job name']},
+                                                                  since=timing_start))
+            logging.info("Wrote evaluation stage timing report to {:s}".format(timing_fname))
 
 class AxisymAPLC(LyotCoronagraph): # 1-D axisymmetric APLC following Zimmerman et al. (2016)
     _design_fields = OrderedDict([ ( 'Pupil', OrderedDict([('N',(int, 500)), ('centobs',(int, 1))]) ),
@@ -1382,32 +3136,26 @@ class AxisymAPLC(LyotCoronagraph): # 1-D axisymmetric APLC following Zimmerman e
             logging.info("Wrote %s"%self.fileorg['ampl src fname'])
         return 0
 
-    def check_ampl_input_files(self): # dummy function for axisym APLC class
+    def check_ampl_input_files(self, status_index=None): # dummy function for axisym APLC class
         return True # Always pass the check because there are no input files for this design class.
 
     def get_coron_masks(self): # arrays for field propagation
-        rs = np.loadtxt(self.fileorg['sol fname'])[:,0]
+        rs = load_solution(self.fileorg['sol fname'])[:,0]
         M = self.design['FPM']['M']
         FPMrad = self.design['FPM']['R']
         mrs = (np.arange(M) + 0.5) / M * FPMrad
 
         TelAp = 0*rs
         TelAp[(rs > self.design['Pupil']['centobs']*0.5/100)] = 1
-        Apod = np.loadtxt(self.fileorg['sol fname'])[:,-1]
+        Apod = load_solution(self.fileorg['sol fname'])[:,-1]
         LS = 0*rs
         LS[((rs > self.design['LS']['id']*0.5/100) & \
             (rs < self.design['LS']['od']*0.5/100))] = 1
         return rs, mrs, TelAp, Apod, LS
 
-    def get_onax_psf(self, fp2res=8, rho_out=None, Nlam=None):
+    def get_onax_psf(self, fp2res=8, rho_out=None, Nlam=None, hankel_method='matrix'):
         rs, mrs, TelAp, Apod, LS = self.get_coron_masks()
 
-        rs = np.matrix(rs).T 
-        mrs = np.matrix(mrs).T 
-        TelAp = np.matrix(TelAp).T 
-        Apod = np.matrix(Apod).T 
-        LS = np.matrix(LS).T
-
         D = 1.
         N = self.design['Pupil']['N']
         dr = (D/2) / N
@@ -1426,26 +3174,19 @@ class AxisymAPLC(LyotCoronagraph): # 1-D axisymmetric APLC following Zimmerman e
         # wavelength ratios
         wrs = np.linspace(1.-bw/2, 1.+bw/2, Nlam)
 
-        radial_intens_polychrom = np.zeros((Nlam, Nrho))
-
-        for wi, wr in enumerate(wrs):
-            Psi_B = 2*np.pi*dr/wr * scipy.special.jn(0, 2*np.pi*mrs*rs.T/wr) * np.multiply(rs, Apod)
-            Psi_C = Apod - 2*np.pi*dmr/wr * scipy.special.jn(0, 2*np.pi*rs*mrs.T/wr) * np.multiply(mrs, Psi_B)
-            Psi_C_stop = np.multiply(Psi_C, LS)
-            Psi_D = 2*np.pi*dr * scipy.special.jn(0, 2*np.pi*rhos*rs.T/wr) * np.multiply(rs, Psi_C_stop)
-            Psi_D_0_peak = 2*np.pi*dr/wr*rs.T*np.multiply(Apod, LS)
-            radial_intens_polychrom[wi,:] = np.power(np.absolute(Psi_D)/np.absolute(Psi_D_0_peak), 2).T
+        engine = HankelEngine(wrs, method=hankel_method)
+        Psi_B = engine.transform(Apod, rs, mrs, dr, method='matrix')
+        Psi_C = Apod - engine.transform(Psi_B, mrs, rs, dmr, method='matrix')
+        Psi_C_stop = Psi_C*LS
+        Psi_D = engine.transform(Psi_C_stop, rs, rhos, dr)
+        Psi_D_0_peak = engine.peak(Apod*LS, rs, dr)
+        radial_intens_polychrom = np.power(np.absolute(Psi_D)/np.absolute(Psi_D_0_peak)[:,None], 2)
 
         return rhos, radial_intens_polychrom
 
-    def get_metrics(self, fp2res=16, verbose=True): # for Axisym APLC class
+    def get_metrics(self, fp2res=16, verbose=True, hankel_method='matrix'): # for Axisym APLC class
         rs, mrs, TelAp, Apod, LS = self.get_coron_masks()
 
-        rs = np.matrix(rs).T 
-        TelAp = np.matrix(TelAp).T 
-        Apod = np.matrix(Apod).T 
-        LS = np.matrix(LS).T
-
         D = 1.
         N = self.design['Pupil']['N']
         dr = (D/2) / N
@@ -1455,27 +3196,15 @@ class AxisymAPLC(LyotCoronagraph): # 1-D axisymmetric APLC following Zimmerman e
 
         rho_out = np.min([4., self.design['Image']['owa']])
         Nrho = np.int(np.ceil(rho_out * fp2res))
-        rhos = np.matrix(np.arange(Nrho) * 1./fp2res).T
+        drho = 1./fp2res
+        rhos = np.arange(Nrho) * drho
         p7ap_ind = np.less_equal(rhos, 0.7)
 
-        radial_intens_unocc = np.zeros((Nlam, Nrho))
-        radial_intens_telap = np.zeros((Nlam, Nrho))
-        peak_intens_unocc = np.zeros((Nlam, 1))
-        peak_intens_telap = np.zeros((Nlam, 1))
-
-        for wi, wr in enumerate(wrs):
-            Psi_unocc = 2*np.pi*dr/wr * scipy.special.jn(0, 2*np.pi*rhos*rs.T/wr) * \
-                        np.multiply(rs, np.multiply(Apod, LS))
-            Psi_telap = 2*np.pi*dr/wr * scipy.special.jn(0, 2*np.pi*rhos*rs.T/wr) * \
-                          np.multiply(rs, TelAp)
-
-            Psi_unocc_peak = 2*np.pi*dr/wr*rs.T*np.multiply(Apod, LS)
-            Psi_telap_peak = 2*np.pi*dr/wr*rs.T*TelAp
-
-            radial_intens_unocc[wi] = np.power(np.absolute(Psi_unocc), 2).T
-            radial_intens_telap[wi] = np.power(np.absolute(Psi_telap), 2).T
-            peak_intens_unocc[wi] = np.power(np.absolute(Psi_unocc_peak), 2)[0]
-            peak_intens_telap[wi] = np.power(np.absolute(Psi_telap_peak), 2)[0]
+        engine = HankelEngine(wrs, method=hankel_method)
+        radial_intens_unocc = np.power(np.absolute(engine.transform(Apod*LS, rs, rhos, dr)), 2)
+        radial_intens_telap = np.power(np.absolute(engine.transform(TelAp, rs, rhos, dr)), 2)
+        peak_intens_unocc = np.power(np.absolute(engine.peak(Apod*LS, rs, dr)), 2)
+        peak_intens_telap = np.power(np.absolute(engine.peak(TelAp, rs, dr)), 2)
 
         bandavg_intens_unocc = np.mean(radial_intens_unocc, axis=0)
         bandavg_intens_telap = np.mean(radial_intens_telap, axis=0)
@@ -1485,10 +3214,10 @@ class AxisymAPLC(LyotCoronagraph): # 1-D axisymmetric APLC following Zimmerman e
         fwhm_ind_APLC = np.greater_equal(bandavg_intens_unocc, bandavg_peak_unocc/2)
         fwhm_ind_TelAp = np.greater_equal(bandavg_intens_telap, bandavg_peak_telap/2)
 
-        fwhm_sum_APLC = 2*np.pi*dr*(rhos[fwhm_ind_APLC])*bandavg_intens_unocc[fwhm_ind_APLC]
-        fwhm_sum_TelAp = 2*np.pi*dr*(rhos[fwhm_ind_TelAp])*bandavg_intens_telap[fwhm_ind_TelAp]
-        p7ap_sum_APLC = 2*np.pi*dr*(rhos[p7ap_ind])*bandavg_intens_unocc[p7ap_ind]
-        p7ap_sum_TelAp = 2*np.pi*dr*(rhos[p7ap_ind])*bandavg_intens_telap[p7ap_ind]
+        fwhm_sum_APLC = np.sum(2*np.pi*drho*(rhos[fwhm_ind_APLC])*bandavg_intens_unocc[fwhm_ind_APLC])
+        fwhm_sum_TelAp = np.sum(2*np.pi*drho*(rhos[fwhm_ind_TelAp])*bandavg_intens_telap[fwhm_ind_TelAp])
+        p7ap_sum_APLC = np.sum(2*np.pi*drho*(rhos[p7ap_ind])*bandavg_intens_unocc[p7ap_ind])
+        p7ap_sum_TelAp = np.sum(2*np.pi*drho*(rhos[p7ap_ind])*bandavg_intens_telap[p7ap_ind])
 
         inc_energy_telap = np.sum(2*np.pi*np.multiply(rs, np.power(TelAp,2))*dr)
 
@@ -1530,7 +3259,7 @@ class SPLC(LyotCoronagraph): # SPLC following Zimmerman et al. (2016), uses diap
                                                            ('dR',(float, -0.5)), ('fpres',(int,2))]) ) ])
     _eval_fields =   { 'Pupil': _design_fields['Pupil'], 'FPM': _design_fields['FPM'], \
                        'LS': _design_fields['LS'], 'Image': _design_fields['Image'], \
-                       'Tel': {'TelAp diam':(float, 12.)}, 'Target': {}, 'Aber': {}, 'WFSC': {} }
+                       'Tel': {'TelAp diam':(float, 12.)}, 'Target': {}, 'Aber': {'Nzern':(int, 11)}, 'WFSC': {} }
 
     def __init__(self, verbose=False, **kwargs):
         super(SPLC, self).__init__(**kwargs)
@@ -1701,32 +3430,23 @@ class SPLC(LyotCoronagraph): # SPLC following Zimmerman et al. (2016), uses diap
         logging.info("Writing the AMPL program") # Not yet written for full-plane SPLC
 
     def get_coron_masks(self, use_gray_gap_zero=True, get_big_telap=False):
-        TelAp_basename = os.path.basename(self.fileorg['TelAp fname'])
         if use_gray_gap_zero:
-            gapstr_beg = TelAp_basename.find('gap')
-            TelAp_nopad_basename = TelAp_basename.replace(TelAp_basename[gapstr_beg:gapstr_beg+4], 'gap0')
-            TelAp_nopad_fname = os.path.join( os.path.dirname(self.fileorg['TelAp fname']), TelAp_nopad_basename )
-            TelAp_p = np.loadtxt(TelAp_nopad_fname)
+            TelAp_p = self.get_telap_level(gap=0)
         elif self.design['Pupil']['edge'] == 'floor': # floor to binary
-            TelAp_p = np.floor(np.loadtxt(self.fileorg['TelAp fname']))
+            TelAp_p = np.floor(mask_library.load(self.fileorg['TelAp fname']))
         else:
-            TelAp_p = np.round(np.loadtxt(self.fileorg['TelAp fname']))
+            TelAp_p = np.round(mask_library.load(self.fileorg['TelAp fname']))
 
         if get_big_telap:
             if self.design['Pupil']['N'] <= 128:
                 s = 4
             else:
                 s = 2
-            gapstr_beg = TelAp_basename.find('gap')
-            TelAp_nopad_basename = TelAp_basename.replace(TelAp_basename[gapstr_beg:gapstr_beg+4], 'gap0')
-            TelAp_nopad_fname = os.path.join( os.path.dirname(self.fileorg['TelAp fname']), TelAp_nopad_basename )
-            TelAp_big_nopad_fname = TelAp_nopad_fname.replace('N{:04d}'.format(self.design['Pupil']['N']),
-                                                              'N{:04d}'.format(s*self.design['Pupil']['N']))
-            TelAp_bp = np.loadtxt(TelAp_big_nopad_fname)
-
-        A_col = np.loadtxt(self.fileorg['sol fname'])[:,-1]
-        FPM_p = np.loadtxt(self.fileorg['FPM fname'])
-        LS_p = np.loadtxt(self.fileorg['LS fname'])
+            TelAp_bp = self.get_telap_level(gap=0, N=s*self.design['Pupil']['N'])
+
+        A_col = load_solution(self.fileorg['sol fname'])[:,-1]
+        FPM_p = mask_library.load(self.fileorg['FPM fname'])
+        LS_p = mask_library.load(self.fileorg['LS fname'])
         A_p = A_col.reshape(TelAp_p.shape)
         if isinstance(self, QuarterplaneSPLC):
             TelAp = np.concatenate((np.concatenate((TelAp_p[::-1,::-1], TelAp_p[:,::-1]),axis=0),
@@ -1796,16 +3516,99 @@ class SPLC(LyotCoronagraph): # SPLC following Zimmerman et al. (2016), uses diap
 
         return xs, dx, XX, YY, mxs, dmx, us, du, xis, dxi, wrs
 
-    def get_onax_psf(self, fp2res=8, rho_inc=0.25, rho_out=None, Nlam=None): # for SPLC
+    def _get_onax_setup(self): # for SPLC
+        # Masks and plane coordinates for on-axis propagation, without any propagation, cached until the
+        # solution changes
+        cache_key = os.path.getmtime(self.fileorg['sol fname'])
+        if getattr(self, '_cache_onax_setup', None) is not None and self._cache_onax_setup['key'] == cache_key:
+            return self._cache_onax_setup
+        TelAp, A, FPM, LS = self._get_onax_masks()
+        xs, dx, XX, YY, mxs, dmx, us, du, xis, dxi, wrs = self.get_coords()
+        mxs = np.linspace(-FPM.shape[0]//2+0.5, FPM.shape[0]//2-0.5, FPM.shape[0])*dmx
+        self._cache_onax_setup = {'key': cache_key, 'Psi_A': TelAp*A, 'FPM': FPM, 'LS': LS,
+                                  'xs': np.asarray(xs).ravel(), 'dx': dx, 'mxs': mxs, 'dmx': dmx,
+                                  'us': np.asarray(us).ravel(), 'du': du, 'rho out': self.design['FPM']['R1'] + 0.5}
+        return self._cache_onax_setup
+
+    def _get_fpm_extent(self, design): # for SPLC
+        # Half-width of the FP1 grid needed by a diaphragm, and the default image plane extent
+        return design['FPM']['R1'], design['FPM']['R1'] + 0.5
+
+    def _get_fp1_field(self, fp1_extent, fp1res=None, Nlam=None): # for SPLC
+        # FP1 field at each wavelength on a grid of half-width fp1_extent, cached until the solution changes
+        if fp1res is None:
+            fp1res = self.design['FPM']['fpmres']
+        if Nlam is None:
+            Nlam = self.design['Image']['Nlam']
+        cache_key = (fp1_extent, fp1res, Nlam, os.path.getmtime(self.fileorg['sol fname']))
+        if getattr(self, '_cache_fp1_field', None) is not None and self._cache_fp1_field['key'] == cache_key:
+            return self._cache_fp1_field
+        TelAp, A, FPM, LS = self._get_onax_masks()
+        xs, dx, XX, YY, mxs, dmx, us, du, xis, dxi, wrs = self.get_coords(Nlam=Nlam)
+        M_fp1 = int(np.ceil(fp1_extent*fp1res))
+        dmx = 1./fp1res
+        mxs = np.linspace(-M_fp1+0.5, M_fp1-0.5, 2*M_fp1)*dmx
+        core = PropagationCore(wrs)
+        Psi_B = core.mft(TelAp*A, xs, mxs, dx, 'B').copy()
+        self._cache_fp1_field = {'key': cache_key, 'core': core, 'Psi_B': Psi_B, 'mxs': mxs, 'dmx': dmx,
+                                 'LS': LS, 'us': np.asarray(us).ravel(), 'du': du}
+        return self._cache_fp1_field
+
+    def _propagate_fp1_to_lyot(self, fp1, design): # for SPLC
+        # Occulted Lyot plane field for an FPM variant, and the unocculted peak through the variant's FP1 grid
+        core = fp1['core']
+        mxs = fp1['mxs']
+        import scda_masks
+        FPM = self._get_gray_fpm(fp1, scda_masks.make_diaphragm_fpm(design['FPM']['R0'], design['FPM']['R1'], 1./fp1['dmx'],
+                                                                    design['FPM']['openang'], design['FPM']['orient']))
+        MXs, MYs = np.meshgrid(mxs, mxs)
+        M_fp1 = int(np.ceil(design['FPM']['R1']/fp1['dmx']))
+        FP1_window = ((np.abs(MXs) < M_fp1*fp1['dmx']) & (np.abs(MYs) < M_fp1*fp1['dmx'])).astype(float)
+        Psi_C_0_stop = core.mft(fp1['Psi_B']*FP1_window, mxs, fp1['us'], fp1['dmx'], 'C_0')
+        Psi_C_0_stop *= fp1['LS']
+        Psi_D_0_peak = np.sum(Psi_C_0_stop, axis=(1,2))*fp1['du']*fp1['du']/core.wrs
+        Psi_C_stop = core.mft(fp1['Psi_B']*FPM, mxs, fp1['us'], fp1['dmx'], 'C')
+        Psi_C_stop *= fp1['LS']
+        return Psi_C_stop, Psi_D_0_peak
+
+    def _propagate_pupil_to_lyot(self, Psi_A_stack, core, setup, get_unocculted=False): # for SPLC
+        # Occulted Lyot plane fields for a stack of pupil fields, one per wavelength of the core, or a single
+        # pupil field for all of them. With get_unocculted, also the unocculted fields, from the same FP1 field.
+        Psi_B = core.mft(Psi_A_stack, setup['xs'], setup['mxs'], setup['dx'], 'B')
+        Psi_C = core.mft(Psi_B*setup['FPM'], setup['mxs'], setup['us'], setup['dmx'], 'C').copy()
+        if not get_unocculted:
+            return Psi_C
+        return Psi_C, core.mft(Psi_B, setup['mxs'], setup['us'], setup['dmx'], 'C_0').copy()
+
+    def _get_dark_zone_mask(self, xis, design=None): # for SPLC
+        if design is None:
+            design = self.design
+        XXs, YYs = np.meshgrid(xis, xis)
+        RRs = np.sqrt(XXs**2 + YYs**2)
+        M_fp2 = len(xis)//2
+        rad_mask = (RRs >= design['FPM']['R0']) & (RRs <= design['FPM']['R1'])
+        if design['FPM']['openang'] < 180:
+            theta_quad = np.rad2deg(np.arctan2(YYs[M_fp2:,M_fp2:], XXs[M_fp2:,M_fp2:]))
+            if design['FPM']['orient'] == 'V':
+                theta_quad_mask = np.greater(theta_quad, design['FPM']['openang']/2)
+            else:
+                theta_quad_mask = np.less(theta_quad, design['FPM']['openang']/2)
+            theta_rhs_mask = np.concatenate((theta_quad_mask[::-1,:], theta_quad_mask), axis=0)
+            theta_mask = np.concatenate((theta_rhs_mask[:,::-1], theta_rhs_mask), axis=1)
+            return theta_mask & rad_mask
+        else:
+            return rad_mask
+
+    def get_onax_psf(self, fp2res=8, rho_inc=0.25, rho_out=None, Nlam=None, precision='double'): # for SPLC
         if self.design['Pupil']['edge'] == 'floor': # floor to binary
-            TelAp_p = np.floor(np.loadtxt(self.fileorg['TelAp fname'])).astype(int)
+            TelAp_p = np.floor(mask_library.load(self.fileorg['TelAp fname'])).astype(int)
         elif self.design['Pupil']['edge'] == 'round': # round to binary
-            TelAp_p = np.round(np.loadtxt(self.fileorg['TelAp fname'])).astype(int)
+            TelAp_p = np.round(mask_library.load(self.fileorg['TelAp fname'])).astype(int)
         else: # keey it gray
-            TelAp_p = np.loadtxt(self.fileorg['TelAp fname'])
-        A_col = np.loadtxt(self.fileorg['sol fname'])[:,-1]
-        FPM_p = np.loadtxt(self.fileorg['FPM fname'])
-        LS_p = np.loadtxt(self.fileorg['LS fname'])
+            TelAp_p = mask_library.load(self.fileorg['TelAp fname'])
+        A_col = load_solution(self.fileorg['sol fname'])[:,-1]
+        FPM_p = mask_library.load(self.fileorg['FPM fname'])
+        LS_p = mask_library.load(self.fileorg['LS fname'])
         A_p = A_col.reshape(TelAp_p.shape)
         if isinstance(self, QuarterplaneSPLC):
             TelAp = np.concatenate((np.concatenate((TelAp_p[::-1,::-1], TelAp_p[:,::-1]),axis=0),
@@ -1866,22 +3669,16 @@ class SPLC(LyotCoronagraph): # SPLC following Zimmerman et al. (2016), uses diap
         # wavelength ratios
         wrs = np.linspace(1.-bw/2, 1.+bw/2, Nlam)
 
-        intens_polychrom = np.zeros((Nlam, 2*M_fp2, 2*M_fp2))
-        for wi, wr in enumerate(wrs):
-            Psi_B = dx*dy/wr*np.dot(np.dot(np.exp(-1j*2*np.pi/wr*np.dot(mxs.T, xs)), TelAp*A ),
-                                           np.exp(-1j*2*np.pi/wr*np.dot(xs.T, mxs)))
-            Psi_B_stop = np.multiply(Psi_B, FPM)
-            Psi_C = dmx*dmx/wr*np.dot(np.dot(np.exp(-1j*2*np.pi/wr*np.dot(us.T, mxs)), Psi_B_stop),
-                                             np.exp(-1j*2*np.pi/wr*np.dot(mxs.T, us)))
-            Psi_C_stop = np.multiply(Psi_C, LS)
-            Psi_D = du*dv/wr*np.dot(np.dot(np.exp(-1j*2*np.pi/wr*np.dot(xis.T, us)), Psi_C_stop),
-                                           np.exp(-1j*2*np.pi/wr*np.dot(us.T, xis)))
-
-            Psi_C_0 = dmx*dmx/wr*np.dot(np.dot(np.exp(-1j*2*np.pi/wr*np.dot(us.T, mxs)), Psi_B),
-                                               np.exp(-1j*2*np.pi/wr*np.dot(mxs.T, us)))
-            Psi_C_0_stop = np.multiply(Psi_C_0, LS)
-            Psi_D_0_peak = np.sum(Psi_C_0_stop)*du*dv/wr
-            intens_polychrom[wi,:,:] = np.power(np.absolute(Psi_D)/np.absolute(Psi_D_0_peak), 2)
+        core = PropagationCore(wrs, precision=precision)
+        Psi_B = core.mft(TelAp*A, xs, mxs, dx, 'B')
+        Psi_C_0_stop = core.mft(Psi_B, mxs, us, dmx, 'C_0')
+        Psi_C_0_stop *= LS
+        Psi_D_0_peak = np.sum(Psi_C_0_stop, axis=(1,2), dtype=np.complex128)*du*dv/core.wrs
+        Psi_B *= FPM
+        Psi_C_stop = core.mft(Psi_B, mxs, us, dmx, 'C')
+        Psi_C_stop *= LS
+        Psi_D = core.mft(Psi_C_stop, us, xis, du, 'D', compensated=True)
+        intens_polychrom = core.intensity(Psi_D, 'I_D')/np.power(np.absolute(Psi_D_0_peak), 2)[:,None,None]
              
         #seps = np.arange(self.design['FPM']['R0']+self.design['Image']['dR'], rho_out, rho_inc)
         seps = np.arange(0, rho_out, rho_inc)
@@ -1918,19 +3715,17 @@ class SPLC(LyotCoronagraph): # SPLC following Zimmerman et al. (2016), uses diap
 
         return xis, intens_polychrom, seps, radial_intens_polychrom, FoV_mask
 
-    def get_metrics(self, fp1res=8, fp2res=16, rho_out=None, Nlam=None, use_gray_gap_zero=True, verbose=True): # for SPLC class
-        TelAp_basename = os.path.basename(self.fileorg['TelAp fname'])
-        gapstr_beg = TelAp_basename.find('gap')
-        TelAp_nopad_basename = TelAp_basename.replace(TelAp_basename[gapstr_beg:gapstr_beg+4], 'gap0')
-        TelAp_nopad_fname = os.path.join( os.path.dirname(self.fileorg['TelAp fname']), TelAp_nopad_basename )
-        if os.path.exists(TelAp_nopad_fname) and use_gray_gap_zero:
-            TelAp_p = np.loadtxt(TelAp_nopad_fname)
+    def get_metrics(self, fp1res=8, fp2res=16, rho_out=None, Nlam=None, use_gray_gap_zero=True, verbose=True,
+                    precision='double', ref_psf_dir=None): # for SPLC class
+        TelAp_nopad_fname = self.get_telap_variant_fname(gap=0)
+        if TelAp_nopad_fname is not None and use_gray_gap_zero:
+            TelAp_p = mask_library.load(TelAp_nopad_fname)
             telap_flag = 0
         else:
-            TelAp_p = np.loadtxt(self.fileorg['TelAp fname'])
+            TelAp_p = mask_library.load(self.fileorg['TelAp fname'])
             telap_flag = 1
-        A_col = np.loadtxt(self.fileorg['sol fname'])[:,-1]
-        LS_p = np.loadtxt(self.fileorg['LS fname'])
+        A_col = load_solution(self.fileorg['sol fname'])[:,-1]
+        LS_p = mask_library.load(self.fileorg['LS fname'])
         A_p = A_col.reshape(TelAp_p.shape)
         if isinstance(self, QuarterplaneSPLC):
             TelAp = np.concatenate((np.concatenate((TelAp_p[::-1,::-1], TelAp_p[:,::-1]),axis=0),
@@ -1985,31 +3780,19 @@ class SPLC(LyotCoronagraph): # SPLC following Zimmerman et al. (2016), uses diap
         RRs = np.sqrt(XXs**2 + YYs**2)
         p7ap_ind = np.less_equal(RRs, 0.7)
 
-        intens_D_0_polychrom = np.zeros((Nlam, 2*M_fp2, 2*M_fp2))
-        intens_D_0_peak_polychrom = np.zeros((Nlam, 1))
-        intens_TelAp_polychrom = np.zeros((Nlam, 2*M_fp2, 2*M_fp2))
-        intens_TelAp_peak_polychrom = np.zeros((Nlam, 1))
-        for wi, wr in enumerate(wrs):
-            Psi_B_0 = dx*dy/wr*np.dot(np.dot(np.exp(-1j*2*np.pi/wr*np.dot(mxs.T, xs)), TelAp*A),
-                                             np.exp(-1j*2*np.pi/wr*np.dot(xs.T, mxs)))
-            Psi_C_0 = dmx*dmy/wr*np.dot(np.dot(np.exp(-1j*2*np.pi/wr*np.dot(us.T, mxs)), Psi_B_0),
-                                               np.exp(-1j*2*np.pi/wr*np.dot(mxs.T, us)))
-            Psi_C_0_stop = np.multiply(Psi_C_0, LS)
-            Psi_D_0 = du*dv/wr*np.dot(np.dot(np.exp(-1j*2*np.pi/wr*np.dot(xis.T, us)), Psi_C_0_stop),
-                                             np.exp(-1j*2*np.pi/wr*np.dot(us.T, xis)))
-            Psi_D_0_peak = du*dv/wr*np.sum(Psi_C_0_stop)
-
-            intens_D_0_polychrom[wi] = np.power(np.absolute(Psi_D_0), 2)
-            intens_D_0_peak_polychrom[wi] = np.power(np.absolute(Psi_D_0_peak), 2)
-            Psi_TelAp = dx*dy/wr*np.dot(np.dot(np.exp(-1j*2*np.pi/wr*np.dot(xis.T, xs)), TelAp),
-                                               np.exp(-1j*2*np.pi/wr*np.dot(xs.T, xis)))
-            intens_TelAp_polychrom[wi] = np.power(np.absolute(Psi_TelAp), 2)
-            intens_TelAp_peak_polychrom[wi] = (np.sum(TelAp)*dx*dy/wr)**2
+        core = PropagationCore(wrs, precision=precision)
+        Psi_B_0 = core.mft(TelAp*A, xs, mxs, dx, 'B_0')
+        Psi_C_0_stop = core.mft(Psi_B_0, mxs, us, dmx, 'C_0')
+        Psi_C_0_stop *= LS
+        Psi_D_0 = core.mft(Psi_C_0_stop, us, xis, du, 'D_0')
+        Psi_D_0_peak = du*dv/core.wrs*np.sum(Psi_C_0_stop, axis=(1,2), dtype=np.complex128)
+        intens_D_0_polychrom = core.intensity(Psi_D_0, 'I_D_0')
+        intens_D_0_peak_polychrom = np.power(np.absolute(Psi_D_0_peak), 2)
+        TelAp_fname = TelAp_nopad_fname if telap_flag == 0 else self.fileorg['TelAp fname']
+        intens_TelAp, intens_TelAp_peak = get_telap_ref_psf(TelAp_fname, TelAp, xs, dx, xis, wrs, precision, ref_psf_dir)
 
         intens_D_0 = np.mean(intens_D_0_polychrom, axis=0)
         intens_D_0_peak = np.mean(intens_D_0_peak_polychrom)
-        intens_TelAp = np.mean(intens_TelAp_polychrom, axis=0)
-        intens_TelAp_peak = np.mean(intens_TelAp_peak_polychrom)
 
         fwhm_ind_SPLC = np.greater_equal(intens_D_0, intens_D_0_peak/2)
         fwhm_ind_TelAp = np.greater_equal(intens_TelAp, intens_TelAp_peak/2)
@@ -2626,10 +4409,7 @@ class QuarterplaneSPLC(SPLC): # Zimmerman SPLC subclass for the quarter-plane sy
             """.format(arch)
 
         if queue_spec is 'auto':
-            if self.design['LS']['aligntol'] is None:
-                time_est_hrs = int(np.ceil(1.5*(self.design['Pupil']['N']/125.)**2*(self.design['Image']['Nlam']/3.)**3))
-            else:
-                time_est_hrs = int(np.ceil(3*(self.design['Pupil']['N']/125.)**2*(self.design['Image']['Nlam']/3.)**3))
+            time_est_hrs = int(np.ceil(self.estimate_solver_hours()))
             if time_est_hrs > 12:
                 set_queue = """
                 #SBATCH --qos=long
@@ -3271,10 +5051,7 @@ class HalfplaneSPLC(SPLC): # Zimmerman SPLC subclass for the half-plane symmetry
             """.format(arch)
 
         if queue_spec is 'auto':
-            if self.design['LS']['aligntol'] is None:
-                time_est_hrs = int(np.ceil(1.5*(self.design['Pupil']['N']/125.)**2*(self.design['Image']['Nlam']/3.)**3))
-            else:
-                time_est_hrs = int(np.ceil(3*(self.design['Pupil']['N']/125.)**2*(self.design['Image']['Nlam']/3.)**3))
+            time_est_hrs = int(np.ceil(self.estimate_solver_hours()))
             if time_est_hrs > 12:
                 set_queue = """
                 #SBATCH --qos=long
@@ -3345,7 +5122,7 @@ class NdiayeAPLC(LyotCoronagraph): # Image-constrained APLC following N'Diaye et
                                                            ('wingang',(float, None)), ('incon',(float, None)), ('wingcon',(float, None))]) ) ])
     _eval_fields =   { 'Pupil': _design_fields['Pupil'], 'FPM': _design_fields['FPM'], \
                        'LS': _design_fields['LS'], 'Image': _design_fields['Image'], \
-                       'Tel': {'TelAp diam':(float, 12.)}, 'Target': {}, 'Aber': {}, 'WFSC': {} }
+                       'Tel': {'TelAp diam':(float, 12.)}, 'Target': {}, 'Aber': {'Nzern':(int, 11)}, 'WFSC': {} }
     _LS_OD_map = {'hex1':76, 'hex2':82, 'hex3':81, 'hex4':82, 'pie08':90, 'pie12':90, 'key24':90, 'circ':90, 'wfirst':90, 'wfirstCycle5':90}
     _prim_secobs_map = {'hex1':'X', 'hex2':'X', 'hex3':'X', 'hex4':'X', 'ochex1':'X', 'ochex2':'X', 'ochex3':'X', 'ochex4':'X',
                         'pie08':'Cross', 'pie12':'Cross', 'key24':'Cross', 'circ':'Cross', 'wfirst':'WFIRST', 'wfirstCycle5':'wfirstCycle5'}
@@ -3540,32 +5317,23 @@ class NdiayeAPLC(LyotCoronagraph): # Image-constrained APLC following N'Diaye et
         logging.info("Writing the AMPL program")
 
     def get_coron_masks(self, use_gray_gap_zero=True, get_big_telap=False):
-        TelAp_basename = os.path.basename(self.fileorg['TelAp fname'])
         if use_gray_gap_zero:
-            gapstr_beg = TelAp_basename.find('gap')
-            TelAp_nopad_basename = TelAp_basename.replace(TelAp_basename[gapstr_beg:gapstr_beg+4], 'gap0')
-            TelAp_nopad_fname = os.path.join( os.path.dirname(self.fileorg['TelAp fname']), TelAp_nopad_basename )
-            TelAp_p = np.loadtxt(TelAp_nopad_fname)
+            TelAp_p = self.get_telap_level(gap=0)
         elif self.design['Pupil']['edge'] == 'floor': # floor to binary
-            TelAp_p = np.floor(np.loadtxt(self.fileorg['TelAp fname']))
+            TelAp_p = np.floor(mask_library.load(self.fileorg['TelAp fname']))
         else:
-            TelAp_p = np.round(np.loadtxt(self.fileorg['TelAp fname']))
+            TelAp_p = np.round(mask_library.load(self.fileorg['TelAp fname']))
 
         if get_big_telap:
             if self.design['Pupil']['N'] <= 128:
                 s = 4
             else:
                 s = 2
-            gapstr_beg = TelAp_basename.find('gap')
-            TelAp_nopad_basename = TelAp_basename.replace(TelAp_basename[gapstr_beg:gapstr_beg+4], 'gap0')
-            TelAp_nopad_fname = os.path.join( os.path.dirname(self.fileorg['TelAp fname']), TelAp_nopad_basename )
-            TelAp_big_nopad_fname = TelAp_nopad_fname.replace('N{:04d}'.format(self.design['Pupil']['N']),
-                                                              'N{:04d}'.format(s*self.design['Pupil']['N']))
-            TelAp_bp = np.loadtxt(TelAp_big_nopad_fname)
-
-        A_col = np.loadtxt(self.fileorg['sol fname'])[:,-1]
-        FPM_p = np.loadtxt(self.fileorg['FPM fname'])
-        LS_p = np.loadtxt(self.fileorg['LS fname'])
+            TelAp_bp = self.get_telap_level(gap=0, N=s*self.design['Pupil']['N'])
+
+        A_col = load_solution(self.fileorg['sol fname'])[:,-1]
+        FPM_p = mask_library.load(self.fileorg['FPM fname'])
+        LS_p = mask_library.load(self.fileorg['LS fname'])
         A_p = A_col.reshape(TelAp_p.shape)
         if isinstance(self, QuarterplaneAPLC):
             TelAp = np.concatenate((np.concatenate((TelAp_p[::-1,::-1], TelAp_p[:,::-1]),axis=0),
@@ -3631,16 +5399,95 @@ class NdiayeAPLC(LyotCoronagraph): # Image-constrained APLC following N'Diaye et
 
         return xs, dx, XX, YY, mxs, dmx, xis, dxi, wrs
 
-    def get_onax_psf(self, fp2res=8, rho_inc=0.25, rho_out=None, Nlam=None): # for APLC class
+    def _get_onax_setup(self): # for APLC class
+        # Masks and plane coordinates for on-axis propagation, without any propagation, cached until the
+        # solution changes
+        cache_key = os.path.getmtime(self.fileorg['sol fname'])
+        if getattr(self, '_cache_onax_setup', None) is not None and self._cache_onax_setup['key'] == cache_key:
+            return self._cache_onax_setup
+        TelAp, A, FPM, LS = self._get_onax_masks()
+        xs, dx, XX, YY, mxs, dmx, xis, dxi, wrs = self.get_coords()
+        self._cache_onax_setup = {'key': cache_key, 'Psi_A': TelAp*A, 'FPM': FPM, 'LS': LS,
+                                  'xs': np.asarray(xs).ravel(), 'dx': dx, 'mxs': np.asarray(mxs).ravel(), 'dmx': dmx,
+                                  'us': np.asarray(xs).ravel(), 'du': dx, 'rho out': self.design['Image']['oda'] + 1.}
+        return self._cache_onax_setup
+
+    def _get_fpm_extent(self, design): # for APLC class
+        # Half-width of the FP1 grid needed by an occulting spot, and the default image plane extent
+        return design['FPM']['rad'], design['Image']['oda'] + 1.
+
+    def _get_fp1_field(self, fp1_extent, fp1res=None, Nlam=None): # for APLC class
+        # FP1 field at each wavelength on a grid of half-width fp1_extent, cached until the solution changes
+        if fp1res is None:
+            fp1res = float(self.design['FPM']['M'])/self.design['FPM']['rad']
+        if Nlam is None:
+            Nlam = self.design['Image']['Nlam']
+        cache_key = (fp1_extent, fp1res, Nlam, os.path.getmtime(self.fileorg['sol fname']))
+        if getattr(self, '_cache_fp1_field', None) is not None and self._cache_fp1_field['key'] == cache_key:
+            return self._cache_fp1_field
+        TelAp, A, FPM, LS = self._get_onax_masks()
+        xs, dx, XX, YY, mxs, dmx, xis, dxi, wrs = self.get_coords(Nlam=Nlam)
+        M_fp1 = int(np.ceil(fp1_extent*fp1res))
+        dmx = 1./fp1res
+        mxs = np.linspace(-M_fp1+0.5, M_fp1-0.5, 2*M_fp1)*dmx
+        core = PropagationCore(wrs)
+        Psi_A = TelAp*A
+        Psi_B = core.mft(Psi_A, xs, mxs, dx, 'B').copy()
+        self._cache_fp1_field = {'key': cache_key, 'core': core, 'Psi_B': Psi_B, 'mxs': mxs, 'dmx': dmx,
+                                 'Psi_A': Psi_A, 'LS': LS, 'us': np.asarray(xs).ravel(), 'du': dx}
+        return self._cache_fp1_field
+
+    def _propagate_fp1_to_lyot(self, fp1, design): # for APLC class
+        # Lyot plane field for an occulting spot variant by Babinet subtraction, and the unocculted peak
+        core = fp1['core']
+        import scda_masks
+        spot_rad = round(design['FPM']['rad']/fp1['dmx'], 9) # in FP1 pixels
+        FPM = self._get_gray_fpm(fp1, scda_masks.make_occspot_fpm(spot_rad))
+        Psi_C_stop = core.mft(fp1['Psi_B']*FPM, fp1['mxs'], fp1['us'], fp1['dmx'], 'C')
+        np.subtract(fp1['Psi_A'][::-1,::-1], Psi_C_stop, out=Psi_C_stop)
+        Psi_C_stop *= fp1['LS']
+        Psi_D_0_peak = np.sum(fp1['Psi_A']*fp1['LS'])*fp1['du']*fp1['du']/core.wrs
+        return Psi_C_stop, Psi_D_0_peak
+
+    def _propagate_pupil_to_lyot(self, Psi_A_stack, core, setup, get_unocculted=False): # for APLC class
+        # Occulted Lyot plane fields for a stack of pupil fields, one per wavelength of the core, or a single
+        # pupil field for all of them, by Babinet subtraction of the field diffracted by the occulting spot.
+        # With get_unocculted, also the unocculted fields, the flipped pupil fields.
+        Psi_B = core.mft(Psi_A_stack, setup['xs'], setup['mxs'], setup['dx'], 'B')
+        Psi_C = Psi_A_stack[...,::-1,::-1] - core.mft(Psi_B*setup['FPM'], setup['mxs'], setup['xs'], setup['dmx'], 'C')
+        if not get_unocculted:
+            return Psi_C
+        return Psi_C, np.broadcast_to(Psi_A_stack[...,::-1,::-1], Psi_C.shape)
+
+    def _get_dark_zone_mask(self, xis, design=None): # for APLC class
+        if design is None:
+            design = self.design
+        XXs, YYs = np.meshgrid(xis, xis)
+        RRs = np.sqrt(XXs**2 + YYs**2)
+        M_fp2 = len(xis)//2
+        rad_mask = (RRs >= design['FPM']['rad'] + design['Image']['ida']) & (RRs <= design['Image']['oda'])
+        if 'bowang' in design['Image'] and design['Image']['bowang'] != 180: # bowtie angle constraints
+            theta_quad = np.rad2deg(np.arctan2(YYs[M_fp2:,M_fp2:], XXs[M_fp2:,M_fp2:]))
+            if design['Image']['bowang'] >= 0: # horizontal dark zone
+                theta_quad_mask = np.less(theta_quad, design['Image']['bowang']/2)
+            else: # vertical dark zone
+                theta_quad_mask = np.greater(theta_quad, -design['Image']['bowang']/2)
+            theta_rhs_mask = np.concatenate((theta_quad_mask[::-1,:], theta_quad_mask), axis=0)
+            theta_mask = np.concatenate((theta_rhs_mask[:,::-1], theta_rhs_mask), axis=1)
+            return theta_mask & rad_mask
+        else:
+            return rad_mask
+
+    def get_onax_psf(self, fp2res=8, rho_inc=0.25, rho_out=None, Nlam=None, precision='double'): # for APLC class
         if self.design['Pupil']['edge'] == 'floor': # floor to binary
-            TelAp_p = np.floor(np.loadtxt(self.fileorg['TelAp fname'])).astype(int)
+            TelAp_p = np.floor(mask_library.load(self.fileorg['TelAp fname'])).astype(int)
         elif self.design['Pupil']['edge'] == 'round': # round to binary
-            TelAp_p = np.round(np.loadtxt(self.fileorg['TelAp fname'])).astype(int)
+            TelAp_p = np.round(mask_library.load(self.fileorg['TelAp fname'])).astype(int)
         else: # keey it gray
-            TelAp_p = np.loadtxt(self.fileorg['TelAp fname'])
-        A_col = np.loadtxt(self.fileorg['sol fname'])[:,-1]
-        FPM_p = np.loadtxt(self.fileorg['FPM fname'])
-        LS_p = np.loadtxt(self.fileorg['LS fname'])
+            TelAp_p = mask_library.load(self.fileorg['TelAp fname'])
+        A_col = load_solution(self.fileorg['sol fname'])[:,-1]
+        FPM_p = mask_library.load(self.fileorg['FPM fname'])
+        LS_p = mask_library.load(self.fileorg['LS fname'])
         A_p = A_col.reshape(TelAp_p.shape)
         if isinstance(self, QuarterplaneAPLC):
             TelAp = np.concatenate((np.concatenate((TelAp_p[::-1,::-1], TelAp_p[:,::-1]),axis=0),
@@ -3694,16 +5541,16 @@ class NdiayeAPLC(LyotCoronagraph): # Image-constrained APLC following N'Diaye et
         # wavelength ratios
         wrs = np.linspace(1.-bw/2, 1.+bw/2, Nlam)
 
-        intens_polychrom = np.zeros((Nlam, 2*M_fp2, 2*M_fp2))
-        for wi, wr in enumerate(wrs):
-            Psi_A = TelAp*A
-            Psi_B = dx*dx/wr*np.exp(-1j*2*np.pi/wr*mxs.T*xs)*Psi_A*np.exp(-1j*2*np.pi/wr*xs.T*mxs)
-            Psi_B_stop = np.multiply(Psi_B, FPM)
-            Psi_C = Psi_A[::-1,::-1] - dmx*dmx/wr*np.exp(-1j*2*np.pi/wr*xs.T*mxs)*Psi_B_stop*np.exp(-1j*2*np.pi/wr*mxs.T*xs)
-            Psi_C_stop = np.multiply(Psi_C, LS)
-            Psi_D = dx*dx/wr*np.exp(-1j*2*np.pi/wr*xis.T*xs)*Psi_C_stop*np.exp(-1j*2*np.pi/wr*xs.T*xis)
-            Psi_D_0_peak = np.sum(A*TelAp*LS)*dx*dx/wr
-            intens_polychrom[wi,:,:] = np.power(np.absolute(Psi_D)/Psi_D_0_peak, 2)
+        core = PropagationCore(wrs, precision=precision)
+        Psi_A = TelAp*A
+        Psi_B_stop = core.mft(Psi_A, xs, mxs, dx, 'B')
+        Psi_B_stop *= FPM
+        Psi_C_stop = core.mft(Psi_B_stop, mxs, xs, dmx, 'C', compensated=True)
+        np.subtract(Psi_A[::-1,::-1], Psi_C_stop, out=Psi_C_stop)
+        Psi_C_stop *= LS
+        Psi_D = core.mft(Psi_C_stop, xs, xis, dx, 'D', compensated=True)
+        Psi_D_0_peak = np.sum(A*TelAp*LS)*dx*dx/core.wrs
+        intens_polychrom = core.intensity(Psi_D, 'I_D')/np.power(Psi_D_0_peak, 2)[:,None,None]
              
         seps = np.arange(self.design['FPM']['rad']+self.design['Image']['ida'], rho_out, rho_inc)
         radial_intens_polychrom = np.zeros((len(wrs), len(seps)))
@@ -3735,25 +5582,23 @@ class NdiayeAPLC(LyotCoronagraph): # Image-constrained APLC following N'Diaye et
 
         return xis, intens_polychrom, seps, radial_intens_polychrom
 
-    def get_metrics(self, fp2res=16, rho_out=None, Nlam=None, use_gray_gap_zero=True, verbose=True): # for APLC class
-        TelAp_basename = os.path.basename(self.fileorg['TelAp fname'])
-        gapstr_beg = TelAp_basename.find('gap')
-        TelAp_nopad_basename = TelAp_basename.replace(TelAp_basename[gapstr_beg:gapstr_beg+4], 'gap0')
-        TelAp_nopad_fname = os.path.join( os.path.dirname(self.fileorg['TelAp fname']), TelAp_nopad_basename )
+    def get_metrics(self, fp2res=16, rho_out=None, Nlam=None, use_gray_gap_zero=True, verbose=True,
+                    precision='double', ref_psf_dir=None): # for APLC class
+        TelAp_nopad_fname = self.get_telap_variant_fname(gap=0)
         #if self.design['Pupil']['edge'] == 'floor': # floor to binary
         #    TelAp_p = np.floor(np.loadtxt(self.fileorg['TelAp fname'])).astype(int)
         #elif self.design['Pupil']['edge'] == 'round': # round to binary
         #    TelAp_p = np.round(np.loadtxt(self.fileorg['TelAp fname'])).astype(int)
         #else:
         #    TelAp_p = np.loadtxt(self.fileorg['TelAp fname'])
-        if os.path.exists(TelAp_nopad_fname) and use_gray_gap_zero:
-            TelAp_p = np.loadtxt(TelAp_nopad_fname)
+        if TelAp_nopad_fname is not None and use_gray_gap_zero:
+            TelAp_p = mask_library.load(TelAp_nopad_fname)
             telap_flag = 0
         else:
-            TelAp_p = np.loadtxt(self.fileorg['TelAp fname'])
+            TelAp_p = mask_library.load(self.fileorg['TelAp fname'])
             telap_flag = 1
-        A_col = np.loadtxt(self.fileorg['sol fname'])[:,-1]
-        LS_p = np.loadtxt(self.fileorg['LS fname'])
+        A_col = load_solution(self.fileorg['sol fname'])[:,-1]
+        LS_p = mask_library.load(self.fileorg['LS fname'])
         A_p = A_col.reshape(TelAp_p.shape)
         if isinstance(self, QuarterplaneAPLC):
             TelAp = np.concatenate((np.concatenate((TelAp_p[::-1,::-1], TelAp_p[:,::-1]),axis=0),
@@ -3792,24 +5637,15 @@ class NdiayeAPLC(LyotCoronagraph): # Image-constrained APLC following N'Diaye et
         RRs = np.sqrt(XXs**2 + YYs**2)
         p7ap_ind = np.less_equal(RRs, 0.7)
 
-        intens_D_0_polychrom = np.zeros((Nlam, 2*M_fp2, 2*M_fp2))
-        intens_D_0_peak_polychrom = np.zeros((Nlam, 1))
-        intens_TelAp_polychrom = np.zeros((Nlam, 2*M_fp2, 2*M_fp2))
-        intens_TelAp_peak_polychrom = np.zeros((Nlam, 1))
-        for wi, wr in enumerate(wrs):
-            Psi_D_0 = dx*dy/wr*np.dot(np.dot(np.exp(-1j*2*np.pi/wr*np.dot(xis.T, xs)), TelAp*A*LS[::-1,::-1]),
-                                             np.exp(-1j*2*np.pi/wr*np.dot(xs.T, xis)))
-            intens_D_0_polychrom[wi] = np.power(np.absolute(Psi_D_0), 2)
-            intens_D_0_peak_polychrom[wi] = (np.sum(TelAp*A*LS[::-1,::-1])*dx*dy/wr)**2
-            Psi_TelAp = dx*dy/wr*np.dot(np.dot(np.exp(-1j*2*np.pi/wr*np.dot(xis.T, xs)), TelAp),
-                                               np.exp(-1j*2*np.pi/wr*np.dot(xs.T, xis)))
-            intens_TelAp_polychrom[wi] = np.power(np.absolute(Psi_TelAp), 2)
-            intens_TelAp_peak_polychrom[wi] = (np.sum(TelAp)*dx*dy/wr)**2
+        core = PropagationCore(wrs, precision=precision)
+        Psi_D_0 = core.mft(TelAp*A*LS[::-1,::-1], xs, xis, dx, 'D_0')
+        intens_D_0_polychrom = core.intensity(Psi_D_0, 'I_D_0')
+        intens_D_0_peak_polychrom = (np.sum(TelAp*A*LS[::-1,::-1])*dx*dy/core.wrs)**2
+        TelAp_fname = TelAp_nopad_fname if telap_flag == 0 else self.fileorg['TelAp fname']
+        intens_TelAp, intens_TelAp_peak = get_telap_ref_psf(TelAp_fname, TelAp, xs, dx, xis, wrs, precision, ref_psf_dir)
 
         intens_D_0 = np.mean(intens_D_0_polychrom, axis=0)
         intens_D_0_peak = np.mean(intens_D_0_peak_polychrom)
-        intens_TelAp = np.mean(intens_TelAp_polychrom, axis=0)
-        intens_TelAp_peak = np.mean(intens_TelAp_peak_polychrom)
 
         fwhm_ind_APLC = np.greater_equal(intens_D_0, intens_D_0_peak/2)
         fwhm_ind_TelAp = np.greater_equal(intens_TelAp, intens_TelAp_peak/2)
@@ -3843,44 +5679,72 @@ class NdiayeAPLC(LyotCoronagraph): # Image-constrained APLC following N'Diaye et
             print("Band-averaged FWHM PSF area / (lambda0/D)^2: {:.2f}".format(self.eval_metrics['fwhm area']))
         return telap_flag
 
-    def get_yield_input_products(self, pixscale_lamoD=0.25, star_diam_vec=None, Npts_star_diam=7, Nlam=None,
-                                 norm='aperture'):
-        # Assumes quarter-plane symmetry in the final focal plane
-        TelAp, Apod, FPM, LS = self.get_coron_masks(use_gray_gap_zero=True, get_big_telap=False)
-
-        if star_diam_vec is None:
-            star_diam_vec = np.concatenate([np.linspace(0,0.09,10), np.linspace(0.1, 1, 10), np.array([2., 3., 4.])])
+    def _get_offax_psf_cache(self, pixscale_lamoD=0.25, Nlam=None, norm='aperture', precision='double'): # for APLC class
+        # Propagation setup for band-averaged PSFs of offset point sources, along with a cache of the PSFs
+        # already computed, keyed by offset. The finite-star maps, the off-axis PSF cube, and the jitter
+        # maps all draw from it, so each offset is propagated only once.
         if Nlam is None:
             Nlam = self.design['Image']['Nlam']
+        cache_key = (pixscale_lamoD, Nlam, norm, precision, os.path.getmtime(self.fileorg['sol fname']))
+        if getattr(self, '_cache_offax_psfs', None) is not None and self._cache_offax_psfs['key'] == cache_key:
+            return self._cache_offax_psfs
+        with stage_timer('mask loading'):
+            TelAp, Apod, FPM, LS = self.get_coron_masks(use_gray_gap_zero=True, get_big_telap=False)
+
         bw = self.design['Image']['bw']
         wrs = np.linspace(1.-bw/2, 1.+bw/2, Nlam)
-        seps = np.arange(self.design['FPM']['rad']+self.design['Image']['ida'],
-                         self.design['Image']['oda']+1*pixscale_lamoD, pixscale_lamoD)
-        
         N = self.design['Pupil']['N']
         M_fp1 = self.design['FPM']['M']
         fpm_rad = self.design['FPM']['rad']
         rho2 = self.design['Image']['oda'] + 0.5
-        bowang = self.design['Image']['bowang']
         M_fp2 = int(np.ceil(rho2/pixscale_lamoD))
-        M_fp2_ext = int(np.ceil((rho2+2.5)/pixscale_lamoD))
-        wc = M_fp2_ext - M_fp2
         
         # pupil plane
         D = 1.
         dx = (D/2)/N
-        dy = dx
         xs = np.matrix(np.linspace(-N+0.5,N-0.5,2*N)*dx)
         XX, YY = np.meshgrid(np.array(xs), np.array(xs))
         
         # FPM
         dmx = fpm_rad/M_fp1
-        dmy = dmx
         mxs = np.matrix(np.linspace(-M_fp1+0.5,M_fp1-0.5,2*M_fp1)*dmx)
         
         # FP2
         dxi = pixscale_lamoD
         xis = np.matrix(np.linspace(-M_fp2+0.5,M_fp2-0.5,2*M_fp2)*dxi)
+
+        # Mirror symmetries of the final focal plane, which let an offset PSF be flipped into another quadrant
+        mirror_xy = (isinstance(self, (QuarterplaneAPLC, HalfplaneAPLC)), isinstance(self, QuarterplaneAPLC))
+        self._cache_offax_psfs = {'key': cache_key, 'psfs': {}, 'mirror xy': mirror_xy,
+                                  'args': (TelAp, Apod, FPM, LS, xs, dx, XX, YY, mxs, dmx, xis, dxi),
+                                  'wrs': wrs, 'norm': norm,
+                                  'core': PropagationCore(wrs, precision=precision)}
+        return self._cache_offax_psfs
+
+    def get_yield_input_products(self, pixscale_lamoD=0.25, star_diam_vec=None, Npts_star_diam=7, Nlam=None,
+                                 norm='aperture', precision='double', offax_psf_fname=None, offax_psf_header=None,
+                                 offax_psf_bundle=None):
+        # Assumes quarter-plane symmetry in the final focal plane
+        # The off-axis PSFs are produced one at a time: the sky transmission map is accumulated as they come,
+        # and if offax_psf_fname is given, the off-axis PSF cube is streamed to that FITS file (with header
+        # offax_psf_header) and returned memory-mapped, so memory use doesn't grow with the number of offsets.
+        # Likewise with an EvalBundleWriter as offax_psf_bundle, the cube is streamed to its OFFAX_PSF sections
+        # and returned as a lazy EvalBundleCube on a new reader of the bundle. The caller closes that reader,
+        # with offax_psf_map.bundle.close(), once done with the cube and before appending more to the bundle.
+        psf_cache = self._get_offax_psf_cache(pixscale_lamoD, Nlam, norm, precision)
+        TelAp, Apod, FPM, LS, xs, dx, XX, YY, mxs, dmx, xis, dxi = psf_cache['args']
+        wrs = psf_cache['wrs']
+
+        if star_diam_vec is None:
+            star_diam_vec = np.concatenate([np.linspace(0,0.09,10), np.linspace(0.1, 1, 10), np.array([2., 3., 4.])])
+        seps = np.arange(self.design['FPM']['rad']+self.design['Image']['ida'],
+                         self.design['Image']['oda']+1*pixscale_lamoD, pixscale_lamoD)
+        
+        rho2 = self.design['Image']['oda'] + 0.5
+        bowang = self.design['Image']['bowang']
+        M_fp2 = int(np.ceil(rho2/pixscale_lamoD))
+        M_fp2_ext = int(np.ceil((rho2+2.5)/pixscale_lamoD))
+        wc = M_fp2_ext - M_fp2
         xis_ext = np.matrix(np.linspace(-M_fp2_ext+0.5,M_fp2_ext-0.5,2*M_fp2_ext)*dxi)
         
         offax_Xis = np.array(xis[0,M_fp2:].T)
@@ -3890,41 +5754,446 @@ class NdiayeAPLC(LyotCoronagraph): # Image-constrained APLC following N'Diaye et
 
         intens_2d_vs_star_diam = np.zeros((len(star_diam_vec), 2*M_fp2, 2*M_fp2))
         intens_rad_vs_star_diam = np.zeros((len(star_diam_vec), len(seps)))
-        offax_psf_map_ext = np.zeros((len(offax_XisEtas_ext), 2*M_fp2, 2*M_fp2))
-        offax_psf_map = np.zeros((len(offax_XisEtas), 2*M_fp2, 2*M_fp2))
 
         for si, star_diam in enumerate(star_diam_vec):
-            intens_2d_vs_star_diam[si,:,:], \
-            intens_rad_vs_star_diam[si,:] = get_finite_star_aplc_psf(TelAp, Apod, FPM, LS,
-                                                                     xs, dx, XX, YY, mxs, dmx, xis, dxi, bowang,
-                                                                     star_diam, Npts_star_diam, wrs=wrs,
-                                                                     seps=seps, norm=norm,
-                                                                     get_radial_curve=True)
+            with stage_timer('finite star'):
+                intens_2d_vs_star_diam[si,:,:], \
+                intens_rad_vs_star_diam[si,:] = get_finite_star_aplc_psf(TelAp, Apod, FPM, LS,
+                                                                         xs, dx, XX, YY, mxs, dmx, xis, dxi, bowang,
+                                                                         star_diam, Npts_star_diam, wrs=wrs,
+                                                                         seps=seps, norm=norm,
+                                                                         get_radial_curve=True, psf_cache=psf_cache)
 
         if norm is 'aperture':
             contrast_convert_fac = np.sum(np.power(TelAp, 2))*dx*dx/(dxi*dxi) / np.power(np.sum(Apod*LS)*dx*dx, 2)
         else:
             contrast_convert_fac = 1
 
-        for oi, (delta_xi, delta_eta) in enumerate(offax_XisEtas_ext):
-            offax_psf_map_ext[oi,:,:] = fast_bandavg_aplc_psf(TelAp, Apod, FPM, LS,
-                                                              xs, dx, XX, YY, mxs, dmx, xis, dxi,
-                                                              delta_xi, delta_eta, wrs, norm)
-            if (delta_xi, delta_eta) in offax_XisEtas:
-                ii = offax_XisEtas.index((delta_xi, delta_eta))
-                offax_psf_map[ii,:,:] = offax_psf_map_ext[oi,:,:]
-            
-        sky_trans_map = np.sum(np.concatenate([offax_psf_map_ext,
-                                               offax_psf_map_ext[:,::-1,:],
-                                               offax_psf_map_ext[:,:,::-1],
-                                               offax_psf_map_ext[:,::-1,::-1]], axis=0), axis=0)
+        # The offsets of the PSF cube are a subset of the extended offsets in the same order, so its frames
+        # come out in sequence and can be streamed
+        offax_set = set(offax_XisEtas)
+        if offax_psf_fname is not None:
+            if offax_psf_header is None:
+                offax_psf_header = pyfits.Header()
+            stream_header = pyfits.PrimaryHDU(np.zeros((1, 1, 1)), header=offax_psf_header).header
+            stream_header['NAXIS1'] = 2*M_fp2
+            stream_header['NAXIS2'] = 2*M_fp2
+            stream_header['NAXIS3'] = len(offax_XisEtas)
+            if os.path.exists(offax_psf_fname):
+                os.remove(offax_psf_fname)
+            offax_psf_stream = pyfits.StreamingHDU(offax_psf_fname, stream_header)
+        elif offax_psf_bundle is None:
+            offax_psf_map = np.zeros((len(offax_XisEtas), 2*M_fp2, 2*M_fp2))
+        sky_trans_map = np.zeros((2*M_fp2, 2*M_fp2))
+        ii = 0
+        for (delta_xi, delta_eta) in offax_XisEtas_ext:
+            with stage_timer('off-axis PSF'):
+                offax_psf = get_cached_bandavg_aplc_psf(psf_cache, delta_xi, delta_eta, store=False)
+            sky_trans_map += offax_psf
+            sky_trans_map += offax_psf[::-1,:]
+            sky_trans_map += offax_psf[:,::-1]
+            sky_trans_map += offax_psf[::-1,::-1]
+            if (delta_xi, delta_eta) in offax_set:
+                if offax_psf_fname is not None:
+                    offax_psf_stream.write(offax_psf[None,:,:])
+                elif offax_psf_bundle is not None:
+                    offax_psf_bundle.write_frame('OFFAX_PSF', offax_psf, len(offax_XisEtas))
+                else:
+                    offax_psf_map[ii,:,:] = offax_psf
+                ii += 1
+        if offax_psf_fname is not None:
+            offax_psf_stream.close()
+            offax_psf_map = pyfits.getdata(offax_psf_fname, memmap=True)
+        elif offax_psf_bundle is not None:
+            offax_psf_map = EvalBundle(offax_psf_bundle.fname).cube('OFFAX_PSF')
 
         return intens_2d_vs_star_diam, intens_rad_vs_star_diam, np.ravel(xis), seps, star_diam_vec, \
                offax_psf_map, np.array(offax_XisEtas).T, sky_trans_map, contrast_convert_fac
 
+    def get_jitter_stellar_intens(self, jitter_mas_vec, stellar_intens_map, telap_diam=None, lam0_um=1.0,
+                                  pixscale_lamoD=0.25, Nlam=None, norm='aperture', Nsamp_jitter=5):
+        # Stellar intensity maps smeared by Gaussian pointing jitter, for each RMS jitter per axis (mas) in
+        # jitter_mas_vec and each finite-star map in stellar_intens_map. Each jitter value is sampled on its own
+        # offset lattice, extending to at least 3 sigma with a spacing of pixscale_lamoD times a power of 2, the
+        # largest that gives Nsamp_jitter (at least 3) points per half axis within 3 sigma. So the spacing never
+        # exceeds sigma, a jitter's map doesn't depend on the other values in jitter_mas_vec, and the lattices of
+        # all jitter values are nested on one grid, their points shared between them. The lattice PSFs are kept
+        # only for the duration of the call, on top of the PSFs already in the offset PSF cache, which they don't
+        # add to. Since the leakage is quadratic in small tip/tilt offsets, the excess leakage from jitter adds
+        # to the finite-star leakage, and it is computed for a point source.
+        if telap_diam is None:
+            telap_diam = self._eval_fields['Tel']['TelAp diam'][1]
+        psf_cache = self._get_offax_psf_cache(pixscale_lamoD, Nlam, norm)
+        lamoD_mas = lam0_um*1e-6/telap_diam*180/np.pi*3600*1e3
+        sigma_vec = np.array(jitter_mas_vec, dtype=float)/lamoD_mas
+        jitter_intens_map = np.zeros((len(sigma_vec),) + stellar_intens_map.shape)
+        if np.max(sigma_vec) <= 0:
+            jitter_intens_map[:] = stellar_intens_map
+            return jitter_intens_map
+        Nsamp_jitter = max(Nsamp_jitter, 3)
+        jitter_cache = dict(psf_cache, psfs=dict(psf_cache['psfs']))
+        point_psf = get_cached_bandavg_aplc_psf(jitter_cache, 0., 0.)
+        for ji, sigma in enumerate(sigma_vec):
+            if sigma > 0:
+                lattice_step = pixscale_lamoD*2.**np.floor(np.log2(3*sigma/Nsamp_jitter/pixscale_lamoD))
+                Nhalf = int(np.ceil(3*sigma/lattice_step - 1e-9))
+                lattice_vec = np.arange(-Nhalf, Nhalf+1)*lattice_step
+                lattice_psfs = np.array([[get_cached_bandavg_aplc_psf(jitter_cache, delta_xi, delta_eta) for delta_xi in lattice_vec]
+                                         for delta_eta in lattice_vec])
+                weights_1d = np.exp(-0.5*(lattice_vec/sigma)**2)
+                weights = np.outer(weights_1d, weights_1d)/np.sum(weights_1d)**2
+                jitter_excess = np.tensordot(weights, lattice_psfs, axes=([0,1],[0,1])) - point_psf
+            else:
+                jitter_excess = 0
+            jitter_intens_map[ji] = stellar_intens_map + jitter_excess
+        return jitter_intens_map
+
+# Seconds per unit of estimated work for each propagation backend, used by PropagationCore to pick the cheapest
+# one for a given pair of grids. Refit on the local machine with calibrate_propagation_backends().
+prop_cost_coeffs = {'mft': 7.0e-10, 'czt': 2.0e-9, 'fft': 5.0e-9}
+# Backend of every PropagationCore made without an explicit one, e.g. to validate an engine with scda_golden.py
+prop_default_backend = 'auto'
+
+def get_propagation_work(backend, N_in, N_out, fft_len):
+    # Work estimate for one 2-D transform at one wavelength, separable along each axis
+    if backend == 'mft':
+        return float(N_out)*N_in*(N_in + N_out)
+    elif backend in ('czt', 'fft'):
+        return float(N_in + N_out)*fft_len*(1 + np.log2(fft_len))*(3 if backend == 'czt' else 1)
+
+def calibrate_propagation_backends(N_vec=(64, 128, 256, 512), Nlam=3, Nrep=2):
+    # Time each backend on square grids of the given sizes and refit prop_cost_coeffs in place
+    wrs = np.linspace(0.95, 1.05, Nlam)
+    work = {'mft': [], 'czt': [], 'fft': []}
+    times = {'mft': [], 'czt': [], 'fft': []}
+    for N in N_vec:
+        xs = (np.arange(N) - N/2. + 0.5)/N
+        field = np.random.randn(N, N) + 1j*np.random.randn(N, N)
+        core = PropagationCore([1.], backend='mft')
+        for backend in ('mft', 'czt', 'fft'):
+            # The FFT backend needs an output spacing commensurate with the input grid
+            core.backend = backend
+            xis = (np.arange(N) - N/2. + 0.5)*(1. if backend == 'fft' else 1.3)
+            core.mft(field, xs, xis, 1./N, 'calib') # warm the kernel and chirp caches
+            t_start = time.time()
+            for ri in range(Nrep):
+                core.mft(field, xs, xis, 1./N, 'calib')
+            times[backend].append((time.time() - t_start)/Nrep)
+            if backend == 'czt':
+                fft_len = int(2**np.ceil(np.log2(2*N - 1)))
+            else:
+                fft_len = core.get_fft_len(xs, xis)[0] if backend == 'fft' else None
+            work[backend].append(get_propagation_work(backend, N, N, fft_len))
+    for backend in work:
+        w = np.array(work[backend])
+        prop_cost_coeffs[backend] = np.sum(w*np.array(times[backend]))/np.sum(w*w)
+    logging.info("Calibrated propagation cost coefficients: {}".format(prop_cost_coeffs))
+    return prop_cost_coeffs
+
+# J0 kernel matrices kept across HankelEngine instances, keyed by grid and wavelength ratio, so that the
+# axisymmetric designs of a survey, which share their radial grids, evaluate the Bessel function only once
+hankel_kernel_cache = {}
+hankel_kernel_cache_max = 256
+
+class HankelEngine(object):
+    # Zero-order Hankel transforms of radial fields over a stack of wavelengths, in the normalization of the
+    # axisymmetric APLC model: 2*pi/wr * sum_r J0(2*pi*r*rho/wr)*f(r)*r*dr. Returns arrays of shape (Nlam, N_out).
+    #
+    # method='matrix' applies cached J0 kernel matrices. method='fftlog' instead resamples the field on a
+    # logarithmic radial grid and evaluates the transform as a correlation with the FFT (Hamilton 2000 FFTLog,
+    # unbiased), in O(N log N) without any Bessel function evaluations. FFTLog is accurate for smooth, bright
+    # fields such as the unocculted PSF used in throughput metrics; its ringing from sharp mask edges is far
+    # above dark zone contrast levels, so it is not used for the occulted PSF unless asked for. Use
+    # check_methods() to compare the two on a given field.
+    def __init__(self, wrs, method='matrix'):
+        setattr(self, 'wrs', np.asarray(wrs, dtype=float).ravel())
+        setattr(self, 'method', method)
+        setattr(self, '_fftlog_plans', {})
+
+    def get_kernel(self, out_coords, in_coords):
+        out_coords = np.asarray(out_coords, dtype=float).ravel()
+        in_coords = np.asarray(in_coords, dtype=float).ravel()
+        grid_key = (out_coords.size, out_coords[0], out_coords[-1], in_coords.size, in_coords[0], in_coords[-1])
+        kernel = np.empty((len(self.wrs), out_coords.size, in_coords.size))
+        for wi, wr in enumerate(self.wrs):
+            kernel_key = grid_key + (wr,)
+            if kernel_key not in hankel_kernel_cache:
+                if len(hankel_kernel_cache) >= hankel_kernel_cache_max:
+                    hankel_kernel_cache.clear()
+                hankel_kernel_cache[kernel_key] = scipy.special.j0(2*np.pi/wr*np.outer(out_coords, in_coords))
+            kernel[wi] = hankel_kernel_cache[kernel_key]
+        return kernel
+
+    def peak(self, field, in_coords, d_in):
+        # Transform evaluated at rho = 0
+        in_coords = np.asarray(in_coords, dtype=float).ravel()
+        return 2*np.pi*d_in/self.wrs*np.sum(np.asarray(field)*in_coords, axis=-1)
+
+    def transform(self, field, in_coords, out_coords, d_in, method=None):
+        # field is a radial profile sampled at in_coords, or a stack of them over wavelength
+        if method is None:
+            method = self.method
+        in_coords = np.asarray(in_coords, dtype=float).ravel()
+        out_coords = np.asarray(out_coords, dtype=float).ravel()
+        weighted = np.asarray(field)*in_coords
+        if weighted.ndim == 1:
+            weighted = np.tile(weighted, (len(self.wrs), 1))
+        if method == 'matrix':
+            kernel = self.get_kernel(out_coords, in_coords)
+            result = np.matmul(kernel, weighted[:,:,None])[:,:,0]
+        elif method == 'fftlog':
+            result = np.empty((len(self.wrs), out_coords.size), dtype=weighted.dtype)
+            for wi, wr in enumerate(self.wrs):
+                result[wi] = self._fftlog_transform(weighted[wi], in_coords, 2*np.pi/wr*out_coords)
+        else:
+            logging.error("Unrecognized Hankel transform method {}".format(method))
+            return None
+        return 2*np.pi*d_in/self.wrs[:,None]*result
+
+    def _get_fftlog_plan(self, in_coords, ks):
+        # Log-spaced radial and frequency grids and the Fourier transform of the kernel exp(t)*J0(exp(t)),
+        # which is 2^(-iw)*Gamma((1 - iw)/2)/Gamma((1 + iw)/2)
+        plan_key = (in_coords.size, in_coords[0], in_coords[-1], ks[0], ks[-1])
+        if plan_key not in self._fftlog_plans:
+            r_min = in_coords[0]
+            r_max = in_coords[-1]
+            step = (in_coords[1] - in_coords[0])/r_max/2
+            k_min = np.min(ks[ks > 0])/2
+            k_max = np.max(ks)*2
+            N_log = int(np.ceil(max(np.log(r_max/r_min), np.log(k_max/k_min))/step)) + 1
+            N_pad = int(2**np.ceil(np.log2(2*N_log)))
+            log_rs = np.log(r_min) + np.arange(N_log)*step
+            log_ks = np.log(k_min) + np.arange(N_log)*step
+            omegas = 2*np.pi*np.fft.fftfreq(N_pad, d=step)
+            kernel_ft = np.exp(-1j*omegas*np.log(2.) + scipy.special.loggamma((1 - 1j*omegas)/2)
+                               - scipy.special.loggamma((1 + 1j*omegas)/2))
+            shift = np.exp(1j*omegas*(log_rs[0] + log_ks[0]))
+            self._fftlog_plans[plan_key] = (log_rs, log_ks, kernel_ft*shift, N_pad)
+        return self._fftlog_plans[plan_key]
+
+    def _fftlog_transform(self, weighted, in_coords, ks):
+        # sum_r f(r)*r*J0(k*r) at each k, with f(r)*r given by weighted. With r = exp(x) and k = exp(y), k times
+        # the integral of f(r)*r*J0(k*r)*dr is the correlation of f(exp(x))*exp(x) with exp(t)*J0(exp(t)).
+        log_rs, log_ks, kernel_ft, N_pad = self._get_fftlog_plan(in_coords, ks)
+        r_log = np.exp(log_rs)
+        log_field = np.interp(r_log, in_coords, weighted.real, left=0, right=0)
+        if np.iscomplexobj(weighted):
+            log_field = log_field + 1j*np.interp(r_log, in_coords, weighted.imag, left=0, right=0)
+        padded = np.zeros(N_pad, dtype=complex)
+        padded[:len(log_rs)] = log_field[::-1]
+        # correlation sum_j h(x_j)*K(x_j + y_l), done as a convolution with the reversed field
+        conv = np.fft.ifft(np.fft.fft(padded)*kernel_ft*np.exp(1j*2*np.pi*np.fft.fftfreq(N_pad)*(len(log_rs) - 1)))
+        k_log = np.exp(log_ks)
+        transform_log = conv[:len(log_ks)]/k_log
+        if not np.iscomplexobj(weighted):
+            transform_log = transform_log.real
+        result = np.zeros(ks.shape, dtype=transform_log.dtype)
+        pos_ind = ks > 0
+        result[pos_ind] = np.interp(np.log(ks[pos_ind]), log_ks, transform_log.real)
+        if np.iscomplexobj(transform_log):
+            result[pos_ind] += 1j*np.interp(np.log(ks[pos_ind]), log_ks, transform_log.imag)
+        result[~pos_ind] = np.sum(weighted)*(in_coords[1] - in_coords[0])
+        return result/(in_coords[1] - in_coords[0])
+
+    def check_methods(self, field, in_coords, out_coords, d_in):
+        # Maximum deviation of the FFTLog transform from the matrix transform, relative to the peak amplitude
+        ref_trans = self.transform(field, in_coords, out_coords, d_in, method='matrix')
+        fast_trans = self.transform(field, in_coords, out_coords, d_in, method='fftlog')
+        return np.max(np.abs(fast_trans - ref_trans))/np.max(np.abs(ref_trans))
+
+class PropagationCore(object):
+    # Matrix Fourier transforms over a stack of wavelengths at once. Kernel stacks, chirp factors and
+    # intermediate buffers are kept between calls, so an evaluator that sends many fields through the same
+    # planes (e.g. a grid of off-axis sources) allocates them only once. Arrays returned by mft(), tilt() and
+    # intensity() are buffers owned by the core, overwritten by the next call with the same name.
+    #
+    # The transform between a pair of planes is done by one of three backends:
+    #   'mft': dense kernel matrices applied with stacked np.matmul
+    #   'czt': chirp-z (Bluestein) transform along each axis, exact for any pair of uniform grids
+    #   'fft': zero-padded FFT along each axis, only valid when dx*dxi/wr is 1/Nfft for an integer Nfft >= N_in
+    # backend='auto' picks the cheapest valid one per pair of grids from prop_cost_coeffs. By default the
+    # backend is the module's prop_default_backend.
+    #
+    # With precision='single', kernels, fields and buffers are complex64, which halves memory traffic and
+    # BLAS time. Propagations where the dark zone forms by cancellation of bright terms should be called with
+    # compensated=True: their matrix products are accumulated in complex128 over blocks of comp_block input
+    # samples, so the rounding error does not grow with the pupil size, and their result is kept in
+    # complex128 for the Babinet subtraction that follows. Intensities are always returned in float64.
+    # The FFT and chirp-z backends compute in double precision regardless, and only store in single.
+    def __init__(self, wrs, backend=None, precision='double', comp_block=128):
+        if backend is None:
+            backend = prop_default_backend
+        setattr(self, 'wrs', np.asarray(wrs, dtype=float).ravel())
+        setattr(self, 'backend', backend)
+        setattr(self, 'precision', precision)
+        setattr(self, 'cdtype', np.complex64 if precision == 'single' else np.complex128)
+        setattr(self, 'comp_block', comp_block)
+        setattr(self, '_kernels', {})
+        setattr(self, '_chirps', {})
+        setattr(self, '_buffers', {})
+
+    def get_kernel(self, out_coords, in_coords):
+        out_coords = np.asarray(out_coords, dtype=float).ravel()
+        in_coords = np.asarray(in_coords, dtype=float).ravel()
+        kernel_key = (out_coords.size, out_coords[0], out_coords[-1], in_coords.size, in_coords[0], in_coords[-1])
+        if kernel_key not in self._kernels:
+            with stage_timer('kernel construction'):
+                self._kernels[kernel_key] = np.exp(-1j*2*np.pi/self.wrs[:,None,None]*
+                                                   np.outer(out_coords, in_coords)[None,:,:]).astype(self.cdtype)
+        return self._kernels[kernel_key]
+
+    def get_buffer(self, name, shape, dtype=None):
+        if dtype is None:
+            dtype = self.cdtype
+        if name not in self._buffers or self._buffers[name].shape != shape or self._buffers[name].dtype != dtype:
+            self._buffers[name] = np.empty(shape, dtype=dtype)
+        return self._buffers[name]
+
+    def get_fft_len(self, in_coords, out_coords):
+        # FFT lengths per wavelength that make the zero-padded FFT backend exact, or None if there are none
+        in_coords = np.asarray(in_coords, dtype=float).ravel()
+        out_coords = np.asarray(out_coords, dtype=float).ravel()
+        fft_lens = self.wrs/((in_coords[1] - in_coords[0])*(out_coords[1] - out_coords[0]))
+        if np.all(np.abs(fft_lens - np.round(fft_lens)) < 1e-6*fft_lens) and np.min(fft_lens) >= in_coords.size - 0.5:
+            return [int(np.round(L)) for L in fft_lens]
+        return None
+
+    def select_backend(self, in_coords, out_coords):
+        if self.backend != 'auto':
+            return self.backend
+        N_in = np.asarray(in_coords).size
+        N_out = np.asarray(out_coords).size
+        czt_len = int(2**np.ceil(np.log2(N_in + N_out - 1)))
+        costs = {'mft': prop_cost_coeffs['mft']*get_propagation_work('mft', N_in, N_out, None),
+                 'czt': prop_cost_coeffs['czt']*get_propagation_work('czt', N_in, N_out, czt_len)}
+        fft_lens = self.get_fft_len(in_coords, out_coords)
+        if fft_lens is not None:
+            costs['fft'] = prop_cost_coeffs['fft']*get_propagation_work('fft', N_in, N_out, max(fft_lens))
+        return min(costs, key=costs.get)
+
+    def _get_chirp_factors(self, in_coords, out_coords, backend):
+        chirp_key = (backend, in_coords.size, in_coords[0], in_coords[-1], out_coords.size, out_coords[0], out_coords[-1])
+        if chirp_key not in self._chirps:
+            N_in = in_coords.size
+            N_out = out_coords.size
+            dx = in_coords[1] - in_coords[0]
+            dxi = out_coords[1] - out_coords[0]
+            ns = np.arange(N_in)
+            ks = np.arange(N_out)
+            wrs = self.wrs[:,None]
+            # exp(-i2pi/wr*(x0 + n*dx)*(xi0 + k*dxi)) split into input, output and cross (n*k) terms
+            pre = np.exp(-1j*2*np.pi/wrs*ns*dx*out_coords[0])
+            post = np.exp(-1j*2*np.pi/wrs*in_coords[0]*out_coords)
+            if backend == 'czt':
+                # n*k = (n^2 + k^2 - (k - n)^2)/2 turns the cross term into a convolution with a chirp
+                alpha = dx*dxi/wrs
+                pre = pre*np.exp(-1j*np.pi*alpha*ns**2)
+                post = post*np.exp(-1j*np.pi*alpha*ks**2)
+                fft_len = int(2**np.ceil(np.log2(N_in + N_out - 1)))
+                chirp = np.zeros((len(self.wrs), fft_len), dtype=complex)
+                chirp[:,:N_out] = np.exp(1j*np.pi*alpha*ks**2)
+                chirp[:,fft_len-N_in+1:] = np.exp(1j*np.pi*alpha*ns[1:][::-1]**2)
+                self._chirps[chirp_key] = (pre, post, np.fft.fft(chirp, axis=-1))
+            else:
+                self._chirps[chirp_key] = (pre, post, self.get_fft_len(in_coords, out_coords))
+        return self._chirps[chirp_key]
+
+    def _transform_last_axis(self, field, in_coords, out_coords, backend):
+        pre, post, chirp_data = self._get_chirp_factors(in_coords, out_coords, backend)
+        N_out = out_coords.size
+        weighted = field*pre[:,None,:]
+        if backend == 'czt':
+            fft_len = chirp_data.shape[-1]
+            conv = np.fft.ifft(np.fft.fft(weighted, n=fft_len, axis=-1)*chirp_data[:,None,:], axis=-1)
+            return conv[:,:,:N_out]*post[:,None,:]
+        result = np.empty(weighted.shape[:2] + (N_out,), dtype=complex)
+        for wi, fft_len in enumerate(chirp_data):
+            spec = np.fft.fft(weighted[wi], n=fft_len, axis=-1)
+            result[wi] = spec[:,np.arange(N_out) % fft_len]*post[wi]
+        return result
+
+    def _compensated_matmul(self, left, right, out, name):
+        # left*right with single precision products accumulated in complex128 over blocks of the inner dimension
+        block_prod = self.get_buffer(name + ' block', out.shape)
+        out[:] = 0
+        for b0 in range(0, left.shape[-1], self.comp_block):
+            np.matmul(left[...,b0:b0+self.comp_block], right[...,b0:b0+self.comp_block,:], out=block_prod)
+            out += block_prod
+        return out
+
+    @timed_stage('propagation')
+    def mft(self, field, in_coords, out_coords, d_in, name, backend=None, compensated=False):
+        # Propagate a field, or a stack of fields over wavelength, between planes sampled at in_coords and out_coords
+        if backend is None:
+            backend = self.select_backend(in_coords, out_coords)
+        Nlam = len(self.wrs)
+        N_out = np.asarray(out_coords).size
+        compensated = compensated and self.precision == 'single'
+        result = self.get_buffer(name, (Nlam, N_out, N_out), dtype=np.complex128 if compensated else None)
+        if backend == 'mft':
+            kernel = self.get_kernel(out_coords, in_coords)
+            field = np.asarray(field, dtype=self.cdtype)
+            if compensated:
+                half_mft = self.get_buffer(name + ' half', kernel.shape, dtype=np.complex128)
+                self._compensated_matmul(kernel, field, half_mft, name + ' half')
+                self._compensated_matmul(half_mft.astype(self.cdtype), kernel.transpose(0,2,1), result, name)
+            else:
+                half_mft = self.get_buffer(name + ' half', kernel.shape)
+                np.matmul(kernel, field, out=half_mft)
+                np.matmul(half_mft, kernel.transpose(0,2,1), out=result)
+        elif backend in ('czt', 'fft'):
+            in_coords = np.asarray(in_coords, dtype=float).ravel()
+            out_coords = np.asarray(out_coords, dtype=float).ravel()
+            if backend == 'fft' and self.get_fft_len(in_coords, out_coords) is None:
+                logging.error("The FFT propagation backend does not apply to these grids, use 'czt' or 'mft'")
+                return None
+            field = np.asarray(field)
+            if field.ndim == 2:
+                field = field[None,:,:]
+            half = self._transform_last_axis(field, in_coords, out_coords, backend)
+            result[:] = self._transform_last_axis(half.transpose(0,2,1), in_coords, out_coords, backend).transpose(0,2,1)
+        else:
+            logging.error("Unrecognized propagation backend {}".format(backend))
+            return None
+        result *= (d_in*d_in/self.wrs)[:,None,None]
+        return result
+
+    def check_backends(self, field, in_coords, out_coords, d_in, rtol=1e-9):
+        # Propagate the same field with every applicable backend and return the maximum deviation of each
+        # from the dense MFT, relative to the peak amplitude. Deviations above rtol are logged as warnings.
+        ref_field = self.mft(field, in_coords, out_coords, d_in, 'check ref', backend='mft').copy()
+        ref_peak = np.max(np.abs(ref_field))
+        backends = ['czt']
+        if self.get_fft_len(in_coords, out_coords) is not None:
+            backends.append('fft')
+        deviations = {'mft': 0.}
+        for backend in backends:
+            test_field = self.mft(field, in_coords, out_coords, d_in, 'check ' + backend, backend=backend)
+            deviations[backend] = np.max(np.abs(test_field - ref_field))/ref_peak
+            if deviations[backend] > rtol:
+                logging.warning("Propagation backend {} deviates from the MFT by {:.2e} (relative)".format(
+                                backend, deviations[backend]))
+        return deviations
+
+    def tilt(self, XX, YY, delta_xi, delta_eta, name, dtype=None):
+        # Wavelength stack of the pupil plane tilt for a point source offset by (delta_xi, delta_eta) lambda0/D
+        phase = self.get_buffer(name + ' phase', (len(self.wrs),) + XX.shape, dtype=float)
+        np.multiply((-2*np.pi/self.wrs)[:,None,None], delta_xi*XX + delta_eta*YY, out=phase)
+        result = self.get_buffer(name, phase.shape, dtype=dtype)
+        np.cos(phase, out=result.real)
+        np.sin(phase, out=result.imag)
+        return result
+
+    def intensity(self, field, name):
+        result = self.get_buffer(name, field.shape, dtype=float)
+        np.multiply(field.real, field.real, out=result)
+        result += np.square(field.imag)
+        return result
+
 def get_finite_star_aplc_psf(TelAp, Apod, FPM, LS, xs, dx, XX, YY, mxs, dmx, xis, dxi, bowang,
                              star_diam_lamoD=0.1, Npts_star_diam=7,
-                             wrs=None, seps=None, get_radial_curve=False, norm='peak'):
+                             wrs=None, seps=None, get_radial_curve=False, norm='peak', psf_cache=None,
+                             precision='double'):
     if wrs is None:
         wrs = np.linspace(0.95, 1.05, 5)
 
@@ -3935,99 +6204,134 @@ def get_finite_star_aplc_psf(TelAp, Apod, FPM, LS, xs, dx, XX, YY, mxs, dmx, xis
     disk_samp_XiEta = zip(XiXi[star_disk], EtaEta[star_disk])
 
     intens_2d_src = np.zeros((xis.shape[1], xis.shape[1]))
+    core = PropagationCore(wrs, precision=precision)
     
     for (delxi, deleta) in disk_samp_XiEta:
-        intens_2d_bandavg = fast_bandavg_aplc_psf(TelAp, Apod, FPM, LS, xs, dx, XX, YY, mxs, dmx,
-                                                  xis, dxi, delxi, deleta, wrs, norm)
+        if psf_cache is not None:
+            intens_2d_bandavg = get_cached_bandavg_aplc_psf(psf_cache, delxi, deleta)
+        else:
+            intens_2d_bandavg = fast_bandavg_aplc_psf(TelAp, Apod, FPM, LS, xs, dx, XX, YY, mxs, dmx,
+                                                      xis, dxi, delxi, deleta, wrs, norm, core=core)
         intens_2d_src += intens_2d_bandavg/len(disk_samp_XiEta)
        
     if get_radial_curve: 
-        if seps is None:
-            seps = np.arange(2.0, 10.25, 0.25)
-        intens_radial_src = np.zeros(seps.shape)
+        with stage_timer('radial binning'):
+            if seps is None:
+                seps = np.arange(2.0, 10.25, 0.25)
+            intens_radial_src = np.zeros(seps.shape)
         
-        XXs = np.asarray(np.dot(np.matrix(np.ones(xis.shape)).T, xis))
-        YYs = np.asarray(np.dot(xis.T, np.matrix(np.ones(xis.shape))))
-        RRs = np.sqrt(XXs**2 + YYs**2)
-        M_fp2 = XXs.shape[0] / 2
-
-        if bowang != 180: # Define bowtie angle constraints
-            if bowang >= 0: # horizontal dark zone
-                theta_quad = np.rad2deg(np.arctan2(YYs[M_fp2:,M_fp2:], XXs[M_fp2:,M_fp2:]))
-                theta_quad_mask = np.less(theta_quad, bowang/2.)
-            else: # vertical dark zone
-                theta_quad = np.rad2deg(np.arctan2(YYs[M_fp2:,M_fp2:], XXs[M_fp2:,M_fp2:]))
-                theta_quad_mask = np.greater(theta_quad, -bowang/2.)
-            theta_rhs_mask = np.concatenate((theta_quad_mask[::-1,:], theta_quad_mask), axis=0)
-            theta_mask = np.concatenate((theta_rhs_mask[:,::-1], theta_rhs_mask), axis=1)
-
-        for si, sep in enumerate(seps):
-            r_in = np.max([seps[0], sep-0.25/2])
-            r_out = np.min([seps[-1], sep+0.25/2])
-            if bowang != 180:
-                meas_mask = (theta_mask & (RRs >= r_in) & (RRs <= r_out))
-                meas_ann_ind = np.nonzero(np.ravel(meas_mask))[0]
-            else:
-                meas_ann_ind = np.nonzero(np.logical_and(np.greater_equal(RRs, r_in).ravel(),
-                                                         np.less_equal(RRs, r_out).ravel()))[0]
-            intens_radial_src[si] = np.mean(np.ravel(intens_2d_src)[meas_ann_ind])
+            XXs = np.asarray(np.dot(np.matrix(np.ones(xis.shape)).T, xis))
+            YYs = np.asarray(np.dot(xis.T, np.matrix(np.ones(xis.shape))))
+            RRs = np.sqrt(XXs**2 + YYs**2)
+            M_fp2 = XXs.shape[0] / 2
+
+            if bowang != 180: # Define bowtie angle constraints
+                if bowang >= 0: # horizontal dark zone
+                    theta_quad = np.rad2deg(np.arctan2(YYs[M_fp2:,M_fp2:], XXs[M_fp2:,M_fp2:]))
+                    theta_quad_mask = np.less(theta_quad, bowang/2.)
+                else: # vertical dark zone
+                    theta_quad = np.rad2deg(np.arctan2(YYs[M_fp2:,M_fp2:], XXs[M_fp2:,M_fp2:]))
+                    theta_quad_mask = np.greater(theta_quad, -bowang/2.)
+                theta_rhs_mask = np.concatenate((theta_quad_mask[::-1,:], theta_quad_mask), axis=0)
+                theta_mask = np.concatenate((theta_rhs_mask[:,::-1], theta_rhs_mask), axis=1)
+
+            for si, sep in enumerate(seps):
+                r_in = np.max([seps[0], sep-0.25/2])
+                r_out = np.min([seps[-1], sep+0.25/2])
+                if bowang != 180:
+                    meas_mask = (theta_mask & (RRs >= r_in) & (RRs <= r_out))
+                    meas_ann_ind = np.nonzero(np.ravel(meas_mask))[0]
+                else:
+                    meas_ann_ind = np.nonzero(np.logical_and(np.greater_equal(RRs, r_in).ravel(),
+                                                             np.less_equal(RRs, r_out).ravel()))[0]
+                intens_radial_src[si] = np.mean(np.ravel(intens_2d_src)[meas_ann_ind])
             
         return intens_2d_src, intens_radial_src
     else:
         return intens_2d_src
        
+def get_cached_bandavg_aplc_psf(psf_cache, delta_xi, delta_eta, store=True):
+    # Band-averaged APLC PSF of a point source at the given offset, looked up in or added to a cache made by
+    # NdiayeAPLC._get_offax_psf_cache(). Offsets mirrored across a symmetry axis are flipped from the cached PSF.
+    # With store=False a PSF that is not in the cache yet is computed without adding it, for one-pass sweeps.
+    mirror_x, mirror_y = psf_cache['mirror xy']
+    flip_x = mirror_x and delta_xi < 0
+    flip_y = mirror_y and delta_eta < 0
+    if flip_x:
+        delta_xi = -delta_xi
+    if flip_y:
+        delta_eta = -delta_eta
+    offset_key = (round(delta_xi, 9), round(delta_eta, 9))
+    if offset_key in psf_cache['psfs']:
+        psf = psf_cache['psfs'][offset_key]
+    else:
+        TelAp, Apod, FPM, LS, xs, dx, XX, YY, mxs, dmx, xis, dxi = psf_cache['args']
+        psf = fast_bandavg_aplc_psf(TelAp, Apod, FPM, LS, xs, dx, XX, YY, mxs, dmx, xis, dxi,
+                                    delta_xi, delta_eta, psf_cache['wrs'], psf_cache['norm'], core=psf_cache['core'])
+        if store:
+            psf_cache['psfs'][offset_key] = psf
+    if flip_x:
+        psf = psf[:,::-1]
+    if flip_y:
+        psf = psf[::-1,:]
+    return psf
+
 def fast_bandavg_aplc_psf(TelAp, A, FPM, LS, xs, dx, XX, YY, mxs, dmx, xis, dxi, delta_xi, delta_eta, wrs,
-                          norm = 'peak'):
+                          norm = 'peak', core=None, return_polychrom=False, precision='double'):
     # norm parameter is either 'aperture' for integral of illuminated aperture energy (per Stark yield input definition),
     # or 'peak' for unocculted PSF peak (contrast units)
-    intens_D_polychrom = np.zeros((wrs.shape[0], xis.shape[1], xis.shape[1]))
+    # Pass the same PropagationCore for repeated calls to reuse its kernels and buffers
+    # precision='single' propagates in complex64, with the Babinet subtraction and final propagation compensated
+    if core is None:
+        core = PropagationCore(wrs, precision=precision)
     if norm == 'peak':
-        intens_norm = np.power(np.sum(A*LS[::-1,::-1])*dx*dx/wrs, 2)
+        intens_norm = np.power(np.sum(A*LS[::-1,::-1])*dx*dx/core.wrs, 2)
     elif norm == 'aperture':
-        intens_norm = np.sum(np.power(TelAp, 2))*dx*dx
-    for wi, wr in enumerate(wrs):
-        Psi_A = np.exp(-1j*2*np.pi/wr*(delta_xi*XX + delta_eta*YY))
-        Psi_A_stop = np.multiply(Psi_A, A)
-        Psi_B = dx*dx/wr*np.exp(-1j*2*np.pi/wr*mxs.T*xs)*Psi_A_stop*np.exp(-1j*2*np.pi/wr*xs.T*mxs)
-        Psi_B_stop = np.multiply(Psi_B, FPM)
-        Psi_C = Psi_A_stop[::-1,::-1] - \
-                dmx*dmx/wr*np.exp(-1j*2*np.pi/wr*xs.T*mxs)*Psi_B_stop*np.exp(-1j*2*np.pi/wr*mxs.T*xs)
-        Psi_C_stop = np.multiply(Psi_C, LS)
-        Psi_D = dx*dx/wr*np.exp(-1j*2*np.pi/wr*xis.T*xs)*Psi_C_stop*np.exp(-1j*2*np.pi/wr*xs.T*xis)
-        if norm == 'peak':
-            intens_D_polychrom[wi,:,:] = np.power(np.absolute(Psi_D), 2) / intens_norm[wi]
-        elif norm == 'aperture':
-            intens_D_polychrom[wi,:,:] = dxi*dxi*np.power(np.absolute(Psi_D), 2) / intens_norm
-            
+        intens_norm = np.ones(core.wrs.shape)*np.sum(np.power(TelAp, 2))*dx*dx/(dxi*dxi)
+    Psi_A_stop = core.tilt(XX, YY, delta_xi, delta_eta, 'A', dtype=np.complex128)
+    Psi_A_stop *= A
+    Psi_B_stop = core.mft(Psi_A_stop, xs, mxs, dx, 'B')
+    Psi_B_stop *= FPM
+    Psi_C_stop = core.mft(Psi_B_stop, mxs, xs, dmx, 'C', compensated=True)
+    np.subtract(Psi_A_stop[:,::-1,::-1], Psi_C_stop, out=Psi_C_stop)
+    Psi_C_stop *= LS
+    Psi_D = core.mft(Psi_C_stop, xs, xis, dx, 'D', compensated=True)
+    intens_D_polychrom = core.intensity(Psi_D, 'I_D')
+    intens_D_polychrom /= intens_norm[:,None,None]
+    if return_polychrom: # the 'I_D' buffer is overwritten by the next call with this core
+        return np.mean(intens_D_polychrom, axis=0), intens_D_polychrom.copy()
     return np.mean(intens_D_polychrom, axis=0)
 
 def fast_bandavg_splc_psf(TelAp, A, FPM, LS, xs, dx, XX, YY, mxs, dmx, us, du, xis, dxi, delta_xi, delta_eta, wrs,
-                          norm = 'peak'):
+                          norm = 'peak', core=None, return_polychrom=False, precision='double'):
     # norm parameter is either 'aperture' for integral of illuminated aperture energy (per Stark yield input definition),
     # or 'peak' for unocculted PSF peak (contrast units)
-    intens_D_polychrom = np.zeros((wrs.shape[0], xis.shape[1], xis.shape[1]))
-    if norm == 'aperture':
-        intens_norm = np.sum(np.power(TelAp, 2))*dx*dx
-    for wi, wr in enumerate(wrs):
-        Psi_A = np.exp(-1j*2*np.pi/wr*(delta_xi*XX + delta_eta*YY))
-        Psi_A_stop = np.multiply(Psi_A, A)
-        Psi_B = dx*dx/wr*np.exp(-1j*2*np.pi/wr*mxs.T*xs)*Psi_A_stop*np.exp(-1j*2*np.pi/wr*xs.T*mxs)
-        Psi_B_0 = dx*dx/wr*np.exp(-1j*2*np.pi/wr*mxs.T*xs)*A*np.exp(-1j*2*np.pi/wr*xs.T*mxs)
-        Psi_B_stop = np.multiply(Psi_B, FPM)
-        Psi_C = dmx*dmx/wr*np.exp(-1j*2*np.pi/wr*us.T*mxs)*Psi_B_stop*np.exp(-1j*2*np.pi/wr*mxs.T*us)
-        Psi_C_0 = dmx*dmx/wr*np.exp(-1j*2*np.pi/wr*us.T*mxs)*Psi_B_0*np.exp(-1j*2*np.pi/wr*mxs.T*us)
-        Psi_C_stop = np.multiply(Psi_C, LS)
-        Psi_C_0_stop = np.multiply(Psi_C_0, LS)
-        Psi_D = du*du/wr*np.exp(-1j*2*np.pi/wr*xis.T*us)*Psi_C_stop*np.exp(-1j*2*np.pi/wr*us.T*xis)
-        Psi_D_0_peak = du*du/wr*np.sum(Psi_C_0_stop)
-        if norm == 'peak':
-            intens_D_polychrom[wi,:,:] = np.power(np.absolute(Psi_D), 2) / np.power(np.absolute(Psi_D_0_peak), 2)
-        elif norm == 'aperture':
-            intens_D_polychrom[wi,:,:] = dxi*dxi*np.power(np.absolute(Psi_D), 2) / intens_norm
-        else:
-            logging.error('unrecognized value for norm parameter')
-            return 1
-
+    # Pass the same PropagationCore for repeated calls to reuse its kernels and buffers
+    # precision='single' propagates in complex64, with the final propagation to the dark zone compensated
+    if core is None:
+        core = PropagationCore(wrs, precision=precision)
+    if norm not in ('peak', 'aperture'):
+        logging.error('unrecognized value for norm parameter')
+        return 1
+    Psi_A_stop = core.tilt(XX, YY, delta_xi, delta_eta, 'A')
+    Psi_A_stop *= A
+    Psi_B_stop = core.mft(Psi_A_stop, xs, mxs, dx, 'B')
+    Psi_B_stop *= FPM
+    Psi_C_stop = core.mft(Psi_B_stop, mxs, us, dmx, 'C')
+    Psi_C_stop *= LS
+    Psi_D = core.mft(Psi_C_stop, us, xis, du, 'D', compensated=True)
+    if norm == 'peak':
+        Psi_B_0 = core.mft(A, xs, mxs, dx, 'B_0')
+        Psi_C_0_stop = core.mft(Psi_B_0, mxs, us, dmx, 'C_0')
+        Psi_C_0_stop *= LS
+        Psi_D_0_peak = du*du/core.wrs*np.sum(Psi_C_0_stop, axis=(1,2), dtype=np.complex128)
+        intens_norm = np.power(np.absolute(Psi_D_0_peak), 2)
+    else:
+        intens_norm = np.ones(core.wrs.shape)*np.sum(np.power(TelAp, 2))*dx*dx/(dxi*dxi)
+    intens_D_polychrom = core.intensity(Psi_D, 'I_D')
+    intens_D_polychrom /= intens_norm[:,None,None]
+    if return_polychrom: # the 'I_D' buffer is overwritten by the next call with this core
+        return np.mean(intens_D_polychrom, axis=0), intens_D_polychrom.copy()
     return np.mean(intens_D_polychrom, axis=0)
     
 class HalfplaneAPLC(NdiayeAPLC): # N'Diaye APLC subclass for the half-plane symmetry case
@@ -4492,10 +6796,7 @@ class HalfplaneAPLC(NdiayeAPLC): # N'Diaye APLC subclass for the half-plane symm
             """.format(arch)
 
         if queue_spec is 'auto':
-            if self.design['LS']['aligntol'] is None:
-                time_est_hrs = int(np.ceil(1.5*(self.design['Pupil']['N']/125.)**2*(self.design['Image']['Nlam']/3.)**3))
-            else:
-                time_est_hrs = int(np.ceil(3*(self.design['Pupil']['N']/125.)**2*(self.design['Image']['Nlam']/3.)**3))
+            time_est_hrs = int(np.ceil(self.estimate_solver_hours()))
             if time_est_hrs > 12:
                 set_queue = """
                 #SBATCH --qos=long
@@ -5051,10 +7352,7 @@ class QuarterplaneAPLC(NdiayeAPLC): # N'Diaye APLC subclass for the quarter-plan
             """.format(arch)
 
         if queue_spec is 'auto':
-            if self.design['LS']['aligntol'] is None:
-                time_est_hrs = int(np.ceil(1.5*(self.design['Pupil']['N']/125.)**2*(self.design['Image']['Nlam']/3.)**3))
-            else:
-                time_est_hrs = int(np.ceil(3*(self.design['Pupil']['N']/125.)**2*(self.design['Image']['Nlam']/3.)**3))
+            time_est_hrs = int(np.ceil(self.estimate_solver_hours()))
             if time_est_hrs > 12:
                 set_queue = """
                 #SBATCH --qos=long
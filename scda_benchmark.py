@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+'''
+Benchmark suite for the SCDA design and evaluation tools
+
+USAGE
+
+Execute directly from the command line, specifying a benchmark directory as an
+argument. For example:
+
+$ ./scda_benchmark.py /tmp/scda_bench
+
+$ ./scda_benchmark.py /tmp/scda_bench --sizes 125 250 --apertures circ hex --label after_mft_patch
+
+The benchmark does not need the mask library. It synthesizes quarter-plane
+telescope apertures (circular, hex-segmented, and circular with struts), focal
+plane masks, Lyot stops, Lyot dark zones and pseudo-solution apodizers in the
+.dat formats the design classes read, under <bench dir>/InputMasks. The masks
+are deterministic, so runs on different days time the same inputs.
+
+Each hot path is timed as the best of --nrep repetitions, with the in-memory
+caches cleared before every repetition:
+
+* survey construction: DesignParamSurvey over a small grid of QuarterplaneAPLC designs
+* write_ampl: one QuarterplaneAPLC AMPL program
+* get_onax_psf, in double and single precision
+* get_metrics
+* propagation: one band-averaged off-axis PSF with each PropagationCore backend
+* get_yield_input_products, on a 1 lambda/D image grid
+
+OUTPUTS
+
+* Appends a record of the run (label, date, host, versions, git commit, and the
+time of every case) as one JSON line to <bench dir>/scda_benchmark_history.jsonl
+
+* Compares the run with the previous record in the history, or with the last
+record with the label given by --baseline, and flags every case that got slower
+by more than the fractional tolerance --tol. The exit status is 1 if any case
+regressed.
+
+'''
+
+import sys
+import os
+import time
+import datetime
+import socket
+import platform
+import subprocess
+import json
+import argparse
+SCDA_location = os.environ.get("SCDA", os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.expanduser(SCDA_location))
+import numpy as np
+import scda
+
+# Pupil parameters of the synthetic apertures. The file names follow the design classes' conventions for these
+# parameters; the contents are synthesized here.
+APERTURE_PUPILS = {'circ':   {'prim':'circ', 'secobs':'X', 'thick':'025', 'centobs':0, 'gap':1, 'edge':'gray'},
+                   'hex':    {'prim':'hex3', 'secobs':'X', 'thick':'025', 'centobs':1, 'gap':1, 'edge':'gray'},
+                   'struts': {'prim':'key24', 'secobs':'X', 'thick':'025', 'centobs':1, 'gap':1, 'edge':'gray'}}
+CASES = ['survey construction', 'write_ampl', 'get_onax_psf double', 'get_onax_psf single', 'get_metrics',
+         'propagation mft', 'propagation czt', 'propagation auto', 'get_yield_input_products']
+HISTORY_FNAME = 'scda_benchmark_history.jsonl'
+
+def get_quarter_coords(N, ss=1):
+    # Pixel center coordinates of an N x N quarter-plane array in units of the pupil diameter, each pixel
+    # subsampled ss x ss for gray edges
+    xs = (np.arange(N*ss) + 0.5)/(N*ss)*0.5
+    return np.meshgrid(xs, xs)
+
+def bin_gray(mask_ss, ss):
+    N = mask_ss.shape[0]//ss
+    return mask_ss.reshape(N, ss, N, ss).mean(axis=(1,3))
+
+def make_synthetic_telap(N, kind, gap_width=0.005, ss=4):
+    # Gray-edged quarter-plane telescope aperture, normalized to a unit diameter circumscribed circle
+    XX, YY = get_quarter_coords(N, ss)
+    RR = np.sqrt(XX**2 + YY**2)
+    if kind == 'hex': # three rings of hexagonal segments around a missing central segment
+        apothem = 0.5/(np.sqrt(3)*3.5)
+        circ_rad = 2*apothem/np.sqrt(3)
+        aperture = np.zeros(XX.shape, dtype=bool)
+        for q in range(-3, 4):
+            for r in range(-3, 4):
+                if abs(q + r) > 3 or (q == 0 and r == 0):
+                    continue
+                xc = 1.5*circ_rad*q
+                yc = np.sqrt(3)*circ_rad*(r + q/2.)
+                if xc < -circ_rad or yc < -2*apothem: # segment does not reach the quarter plane
+                    continue
+                dx = np.abs(XX - xc)
+                dy = np.abs(YY - yc)
+                aperture |= np.maximum(dy, dx*np.sqrt(3)/2 + dy/2) <= apothem - gap_width/2
+    else:
+        aperture = RR <= 0.5
+        if kind == 'struts': # secondary obscuration and diagonal spiders
+            aperture &= RR >= 0.14
+            aperture &= np.abs(XX - YY)/np.sqrt(2) >= gap_width + 0.005
+        elif kind != 'circ':
+            raise ValueError("Unrecognized synthetic aperture {}".format(kind))
+    return bin_gray(aperture.astype(float), ss)
+
+def make_synthetic_masks(coron, kind, overwrite=False):
+    # Write synthetic TelAp (padded and unpadded), FPM, LS and LDZ files and a pseudo-solution for a
+    # QuarterplaneAPLC or QuarterplaneSPLC design, to the file names the design expects
+    N = coron.design['Pupil']['N']
+    TelAp_fname = coron.fileorg['TelAp fname']
+    TelAp_nopad_fname = TelAp_fname.replace('gap{:d}'.format(coron.design['Pupil']['gap']), 'gap0')
+    for fname, gap_width in ((TelAp_fname, 0.01), (TelAp_nopad_fname, 0.005)):
+        if overwrite or not os.path.exists(fname):
+            np.savetxt(fname, make_synthetic_telap(N, kind, gap_width=gap_width), fmt='%.6f')
+    if overwrite or not os.path.exists(coron.fileorg['FPM fname']):
+        if isinstance(coron, scda.SPLC): # annular diaphragm sampled at fpmres points per lambda0/D
+            R0 = coron.design['FPM']['R0']
+            R1 = coron.design['FPM']['R1']
+            fpmres = coron.design['FPM']['fpmres']
+            M = int(np.ceil(R1*fpmres))
+            MX, MY = np.meshgrid((np.arange(M) + 0.5)/fpmres, (np.arange(M) + 0.5)/fpmres)
+            FPM = (np.sqrt(MX**2 + MY**2) >= R0) & (np.sqrt(MX**2 + MY**2) <= R1)
+        else: # occulting spot spanning M points
+            M = coron.design['FPM']['M']
+            MX, MY = np.meshgrid((np.arange(M) + 0.5)/M, (np.arange(M) + 0.5)/M)
+            FPM = np.sqrt(MX**2 + MY**2) <= 1.
+        np.savetxt(coron.fileorg['FPM fname'], FPM.astype(float), fmt='%d')
+    if isinstance(coron, scda.SPLC):
+        N_LS = coron.design['LS']['N']
+    else:
+        N_LS = N
+    XL, YL = get_quarter_coords(N_LS)
+    RL = np.sqrt(XL**2 + YL**2)
+    LS_id = coron.design['LS']['id']/200.
+    LS_od = coron.design['LS']['od']/200.
+    if overwrite or not os.path.exists(coron.fileorg['LS fname']):
+        np.savetxt(coron.fileorg['LS fname'], ((RL >= LS_id) & (RL <= LS_od)).astype(float), fmt='%d')
+    if coron.design['LS']['aligntol'] is not None and (overwrite or not os.path.exists(coron.fileorg['LDZ fname'])):
+        tol = coron.design['LS']['aligntol']*0.5/N_LS
+        LDZ = ((RL >= LS_id - tol) & (RL <= LS_od + tol)) & ~((RL >= LS_id + tol) & (RL <= LS_od - tol))
+        np.savetxt(coron.fileorg['LDZ fname'], LDZ.astype(float), fmt='%d')
+    XX, YY = get_quarter_coords(N)
+    RR = np.sqrt(XX**2 + YY**2)
+    if overwrite or not os.path.exists(coron.fileorg['sol fname']):
+        Apod = np.loadtxt(TelAp_nopad_fname)*np.clip(1 - (2*RR)**2, 0, 1)**2 # smooth prolate-like taper
+        np.savetxt(coron.fileorg['sol fname'], np.column_stack([XX.ravel(), YY.ravel(), Apod.ravel()]), fmt='%.8g')
+
+def get_fileorg(bench_dir, run_label):
+    mask_dir = os.path.join(bench_dir, 'InputMasks')
+    run_dir = os.path.join(bench_dir, run_label)
+    fileorg = {'work dir': run_dir, 'ampl src dir': os.path.join(run_dir, 'amplsrc'),
+               'slurm dir': os.path.join(run_dir, 'slurmsh'), 'log dir': os.path.join(run_dir, 'logs'),
+               'sol dir': os.path.join(run_dir, 'solutions'), 'eval dir': os.path.join(run_dir, 'eval'),
+               'TelAp dir': os.path.join(mask_dir, 'TelAp'), 'FPM dir': os.path.join(mask_dir, 'FPM'),
+               'LS dir': os.path.join(mask_dir, 'LS')}
+    for dirname in fileorg.values():
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+    return fileorg
+
+def clear_caches(coron=None):
+    # Drop the in-memory caches so every repetition times a cold evaluation
+    scda.telap_ref_psf_cache.clear()
+    scda.hankel_kernel_cache.clear()
+    scda.file_checksum_cache.clear()
+    scda.file_status_index.invalidate()
+    if coron is not None:
+        for attr in list(vars(coron).keys()):
+            if attr.startswith('_cache_'):
+                setattr(coron, attr, None)
+
+def time_call(func, nrep, coron=None):
+    times = []
+    for ri in range(nrep):
+        clear_caches(coron)
+        t_start = time.time()
+        func()
+        times.append(time.time() - t_start)
+    return min(times)
+
+def run_cases(bench_dir, sizes, apertures, cases, nrep):
+    results = {}
+    for N in sizes:
+        for kind in apertures:
+            pupil = dict(APERTURE_PUPILS[kind], N=N)
+            design = {'Pupil': pupil, 'FPM': {'rad': 4., 'M': 60},
+                      'LS': {'shape': 'ann', 'id': 20, 'od': 80, 'obscure': 0, 'aligntol': 2},
+                      'Image': {'ida': -0.5, 'oda': 10., 'bw': 0.10, 'Nlam': 3}}
+            fileorg = get_fileorg(bench_dir, "N{0:04d}_{1:s}".format(N, kind))
+            coron = scda.QuarterplaneAPLC(design=design, fileorg=fileorg)
+            make_synthetic_masks(coron, kind)
+            coron.check_ampl_input_files()
+            print("N = {0:d}, {1:s} aperture".format(N, kind))
+            for case in cases:
+                if case == 'survey construction':
+                    survey_config = {'Pupil': pupil, 'FPM': {'rad': [3.5, 4.0], 'M': 60},
+                                     'LS': {'shape': 'ann', 'id': [20, 25], 'od': [78, 80], 'obscure': 0, 'aligntol': None},
+                                     'Image': {'ida': -0.5, 'bw': [0.10, 0.15], 'Nlam': 3}}
+                    for survey_coron in scda.DesignParamSurvey(scda.QuarterplaneAPLC, survey_config, fileorg=dict(fileorg)).coron_list:
+                        make_synthetic_masks(survey_coron, kind)
+                    func = lambda: scda.DesignParamSurvey(scda.QuarterplaneAPLC, survey_config, fileorg=dict(fileorg))
+                elif case == 'write_ampl':
+                    func = lambda: coron.write_ampl(overwrite=True, verbose=False)
+                elif case.startswith('get_onax_psf'):
+                    precision = case.split()[-1]
+                    func = lambda: coron.get_onax_psf(fp2res=8, precision=precision)
+                elif case == 'get_metrics':
+                    func = lambda: coron.get_metrics(verbose=False)
+                elif case.startswith('propagation'):
+                    backend = case.split()[-1]
+                    TelAp, Apod, FPM, LS = coron.get_coron_masks()
+                    xs, dx, XX, YY, mxs, dmx, xis, dxi, wrs = coron.get_coords(fp2res=4)
+                    func = lambda: scda.fast_bandavg_aplc_psf(TelAp, Apod, FPM, LS, xs, dx, XX, YY, mxs, dmx, xis, dxi,
+                                                              1.5, 0.5, wrs, 'aperture',
+                                                              core=scda.PropagationCore(wrs, backend=backend))
+                elif case == 'get_yield_input_products':
+                    func = lambda: coron.get_yield_input_products(pixscale_lamoD=1., star_diam_vec=np.array([0., 0.1]),
+                                                                  Npts_star_diam=3, Nlam=3)
+                else:
+                    print("Unrecognized benchmark case {:s}, skipped".format(case))
+                    continue
+                case_key = "{0:s} N={1:d} {2:s}".format(case, N, kind)
+                results[case_key] = time_call(func, nrep, coron)
+                print("    {0:32s} {1:10.4f} s".format(case, results[case_key]))
+                sys.stdout.flush()
+    return results
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCDA_location,
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+def load_history(history_fname):
+    if not os.path.exists(history_fname):
+        return []
+    return [json.loads(line) for line in open(history_fname) if line.strip()]
+
+def compare_runs(record, baseline, tol, min_diff=0.01):
+    # Cases that got slower than the baseline by more than the fractional tolerance tol, ignoring differences
+    # below min_diff seconds. Returns a list of (case, baseline time, new time) tuples.
+    regressions = []
+    print("Comparison with run {0:s} of {1:s}:".format(str(baseline['label']), baseline['date']))
+    for case_key in sorted(record['results']):
+        if case_key not in baseline['results']:
+            continue
+        t_base = baseline['results'][case_key]
+        t_new = record['results'][case_key]
+        flag = ''
+        if t_new > (1 + tol)*t_base and t_new - t_base > min_diff:
+            regressions.append((case_key, t_base, t_new))
+            flag = '  REGRESSION'
+        print("    {0:48s} {1:10.4f} s -> {2:10.4f} s ({3:+6.1f}%){4:s}".format(
+              case_key, t_base, t_new, 100*(t_new/t_base - 1) if t_base > 0 else 0., flag))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the SCDA hot paths on synthetic masks")
+    parser.add_argument('bench_dir', help="directory for the synthetic masks, run files and benchmark history")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[125, 250, 500, 1000], help="pupil array sizes N")
+    parser.add_argument('--apertures', nargs='+', default=sorted(APERTURE_PUPILS.keys()), choices=sorted(APERTURE_PUPILS.keys()))
+    parser.add_argument('--cases', nargs='+', default=CASES, choices=CASES)
+    parser.add_argument('--nrep', type=int, default=3, help="repetitions per case, the best time is kept")
+    parser.add_argument('--label', default=None, help="label stored with this run")
+    parser.add_argument('--baseline', default=None, help="label of the run to compare with, default the previous run")
+    parser.add_argument('--tol', type=float, default=0.2, help="fractional slowdown flagged as a regression")
+    args = parser.parse_args()
+
+    bench_dir = os.path.abspath(args.bench_dir)
+    if not os.path.exists(bench_dir):
+        os.makedirs(bench_dir)
+    history_fname = os.path.join(bench_dir, HISTORY_FNAME)
+    history = load_history(history_fname)
+
+    results = run_cases(bench_dir, args.sizes, args.apertures, args.cases, args.nrep)
+    record = {'label': args.label, 'date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+              'host': socket.gethostname(), 'python': platform.python_version(), 'numpy': np.__version__,
+              'git commit': get_git_commit(), 'nrep': args.nrep, 'results': results}
+    history_fobj = open(history_fname, 'a')
+    history_fobj.write(json.dumps(record, sort_keys=True) + "\n")
+    history_fobj.close()
+    print("Appended run to {:s}".format(history_fname))
+
+    baseline = None
+    if args.baseline is not None:
+        labeled = [run for run in history if run['label'] == args.baseline]
+        if len(labeled) > 0:
+            baseline = labeled[-1]
+        else:
+            print("No run labeled {:s} in the history".format(args.baseline))
+    elif len(history) > 0:
+        baseline = history[-1]
+    if baseline is not None:
+        regressions = compare_runs(record, baseline, args.tol)
+        if len(regressions) > 0:
+            print("{0:d} case(s) slower than the baseline by more than {1:.0f}%".format(len(regressions), 100*args.tol))
+            sys.exit(1)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+'''
+Golden-output regression harness for the SCDA propagation engines
+
+USAGE
+
+First freeze the outputs of the reference engine (dense MFT propagation in
+double precision) on a set of synthetic designs:
+
+$ ./scda_golden.py freeze /tmp/scda_golden
+
+Then, after changing the propagation code or to validate another engine,
+recompute the same outputs and compare them with the frozen ones:
+
+$ ./scda_golden.py compare /tmp/scda_golden --engine single
+
+The consistency checks compare results of the evaluation functions that must agree
+with each other, independently of any frozen outputs:
+
+$ ./scda_golden.py check /tmp/scda_golden
+
+    eval_bundle            every extension of an evaluation bundle against the per-file products
+    jitter_independence    the jitter-smeared stellar intensity of each jitter value alone against
+                           the same value computed along with others
+    fpm_variant_nominal    the focal plane mask variant with the solved design's parameters against
+                           the on-axis PSF, for the APLC and the SPLC
+
+The engines are PropagationCore configurations:
+
+    reference   backend 'mft', double precision (the frozen outputs)
+    auto        backend chosen by the cost model, double precision
+    czt         chirp-z backend, double precision
+    single      backend chosen by the cost model, single precision with compensated dark zone steps
+
+The synthetic designs are a QuarterplaneAPLC and a QuarterplaneSPLC on a hex-segmented
+aperture, with masks made by scda_benchmark.py under <golden dir>/InputMasks. The
+frozen quantities are:
+
+* SPLC.get_metrics: every numerical entry of eval_metrics
+* NdiayeAPLC.get_onax_psf: the polychromatic intensity cube and the radial curves
+* fast_bandavg_aplc_psf: a band-averaged off-axis PSF
+* get_yield_input_products: stellar intensity maps and curves, off-axis PSF cube, and
+  sky transmission map
+
+OUTPUTS
+
+* freeze writes golden.npz (the quantities) and golden.json (the engine, design
+size, date, git commit and the run time of each function) to the golden directory.
+
+* compare prints the error of every quantity next to its tolerance, and the run time
+of every function next to the frozen one with the speedup. The error of an array is
+its largest absolute deviation relative to the largest absolute reference value; a
+scalar's is relative to its reference value. Tolerances depend on the precision
+and can be overridden per quantity group with --tol group=value. The exit status is
+1 if any quantity is out of tolerance.
+
+* check prints the error of every quantity of every check next to its tolerance. The
+exit status is 1 if any check fails.
+
+'''
+
+import sys
+import os
+import time
+import datetime
+import json
+import argparse
+from collections import OrderedDict
+SCDA_location = os.environ.get("SCDA", os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.expanduser(SCDA_location))
+import numpy as np
+import scda
+import scda_benchmark
+
+ENGINES = OrderedDict([('reference', {'backend': 'mft', 'precision': 'double'}),
+                       ('auto',      {'backend': 'auto', 'precision': 'double'}),
+                       ('czt',       {'backend': 'czt', 'precision': 'double'}),
+                       ('single',    {'backend': 'auto', 'precision': 'single'})])
+
+# Tolerances per quantity group, the part of a quantity name before the first '/'
+TOLERANCES = {'double': {'eval_metrics': 1e-8, 'onax_psf': 1e-8, 'offax_psf': 1e-8, 'yield': 1e-8},
+              'single': {'eval_metrics': 1e-4, 'onax_psf': 1e-4, 'offax_psf': 1e-4, 'yield': 1e-4}}
+
+def get_golden_designs(golden_dir, N):
+    fileorg = scda_benchmark.get_fileorg(golden_dir, "N{:04d}_golden".format(N))
+    pupil = dict(scda_benchmark.APERTURE_PUPILS['hex'], N=N)
+    aplc = scda.QuarterplaneAPLC(design={'Pupil': pupil, 'FPM': {'rad': 4., 'M': 60},
+                                         'LS': {'shape': 'ann', 'id': 20, 'od': 80, 'obscure': 0},
+                                         'Image': {'ida': -0.5, 'oda': 6., 'bw': 0.10, 'Nlam': 3}},
+                                 fileorg=dict(fileorg))
+    splc = scda.QuarterplaneSPLC(design={'Pupil': pupil, 'FPM': {'R0': 3.5, 'R1': 8., 'fpmres': 4},
+                                         'LS': {'N': N//2, 'shape': 'ann', 'id': 25, 'od': 75, 'obscure': 0},
+                                         'Image': {'bw': 0.10, 'Nlam': 3}},
+                                 fileorg=dict(fileorg))
+    for coron in (aplc, splc):
+        scda_benchmark.make_synthetic_masks(coron, 'hex')
+    return aplc, splc
+
+def compute_products(golden_dir, N, engine):
+    # Quantities and function run times of one engine on the golden designs, with the engine's propagation
+    # backend as the module default for the duration
+    prev_backend = scda.prop_default_backend
+    scda.prop_default_backend = ENGINES[engine]['backend']
+    try:
+        return _compute_products(golden_dir, N, engine)
+    finally:
+        scda.prop_default_backend = prev_backend
+
+def _compute_products(golden_dir, N, engine):
+    precision = ENGINES[engine]['precision']
+    aplc, splc = get_golden_designs(golden_dir, N)
+    products = OrderedDict()
+    times = OrderedDict()
+
+    scda_benchmark.clear_caches(splc)
+    t_start = time.time()
+    splc.get_metrics(verbose=False, precision=precision)
+    times['SPLC.get_metrics'] = time.time() - t_start
+    for key in sorted(splc.eval_metrics):
+        val = splc.eval_metrics[key]
+        if isinstance(val, (int, float, np.number)) and not isinstance(val, bool):
+            products['eval_metrics/' + key] = np.array(float(val))
+
+    scda_benchmark.clear_caches(aplc)
+    t_start = time.time()
+    xis, intens_polychrom, seps, radial_intens_polychrom = aplc.get_onax_psf(fp2res=8, precision=precision)
+    times['NdiayeAPLC.get_onax_psf'] = time.time() - t_start
+    products['onax_psf/intens_polychrom'] = np.array(intens_polychrom)
+    products['onax_psf/radial_intens_polychrom'] = np.array(radial_intens_polychrom)
+
+    TelAp, Apod, FPM, LS = aplc.get_coron_masks()
+    xs, dx, XX, YY, mxs, dmx, xis, dxi, wrs = aplc.get_coords(fp2res=4)
+    t_start = time.time()
+    products['offax_psf/bandavg'] = np.array(scda.fast_bandavg_aplc_psf(TelAp, Apod, FPM, LS, xs, dx, XX, YY, mxs, dmx,
+                                                                        xis, dxi, 1.5, 0.5, wrs, 'aperture',
+                                                                        precision=precision))
+    times['fast_bandavg_aplc_psf'] = time.time() - t_start
+
+    scda_benchmark.clear_caches(aplc)
+    t_start = time.time()
+    stellar_intens_map, stellar_intens_curves, xis, seps, star_diams, offax_psf, offax_offsets, sky_trans, convert_fac = \
+      aplc.get_yield_input_products(pixscale_lamoD=1., star_diam_vec=np.array([0., 0.1, 0.5]), Npts_star_diam=3,
+                                    Nlam=3, precision=precision)
+    times['get_yield_input_products'] = time.time() - t_start
+    products['yield/stellar_intens_map'] = np.array(stellar_intens_map)
+    products['yield/stellar_intens_curves'] = np.array(stellar_intens_curves)
+    products['yield/offax_psf'] = np.array(offax_psf)
+    products['yield/sky_trans'] = np.array(sky_trans)
+    return products, times
+
+def get_error(new, ref):
+    new = np.asarray(new, dtype=float)
+    ref = np.asarray(ref, dtype=float)
+    if new.shape != ref.shape:
+        return np.inf
+    if ref.ndim == 0:
+        return abs(float(new) - float(ref))/abs(float(ref)) if ref != 0 else abs(float(new))
+    ref_scale = np.nanmax(np.abs(ref))
+    if not ref_scale > 0:
+        return np.nanmax(np.abs(new))
+    return np.nanmax(np.abs(new - ref))/ref_scale
+
+def freeze(golden_dir, N):
+    products, times = compute_products(golden_dir, N, 'reference')
+    np.savez(os.path.join(golden_dir, 'golden.npz'), **dict([(name.replace('/', '__'), val) for name, val in products.items()]))
+    meta = OrderedDict([('engine', 'reference'), ('N', N), ('date', datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+                        ('git commit', scda_benchmark.get_git_commit()), ('times', times)])
+    meta_fobj = open(os.path.join(golden_dir, 'golden.json'), 'w')
+    json.dump(meta, meta_fobj, indent=2)
+    meta_fobj.close()
+    print("Froze {0:d} reference quantities in {1:s}".format(len(products), golden_dir))
+    for func_name, func_time in times.items():
+        print("    {0:32s} {1:10.4f} s".format(func_name, func_time))
+
+def compare(golden_dir, engine, tol_overrides):
+    meta = json.load(open(os.path.join(golden_dir, 'golden.json')))
+    golden = np.load(os.path.join(golden_dir, 'golden.npz'))
+    tolerances = dict(TOLERANCES[ENGINES[engine]['precision']])
+    tolerances.update(tol_overrides)
+    products, times = compute_products(golden_dir, meta['N'], engine)
+
+    failures = []
+    print("Engine {0:s} against the reference frozen on {1:s}:".format(engine, meta['date']))
+    print("    {0:48s} {1:>10s} {2:>10s}".format('quantity', 'error', 'tolerance'))
+    for name, val in products.items():
+        golden_key = name.replace('/', '__')
+        if golden_key not in golden.files:
+            print("    {0:48s} {1:>10s}".format(name, 'not frozen'))
+            continue
+        err = get_error(val, golden[golden_key])
+        tol = tolerances[name.split('/')[0]]
+        status = 'ok'
+        if not err <= tol:
+            status = 'FAIL'
+            failures.append(name)
+        print("    {0:48s} {1:10.2e} {2:10.2e} {3:s}".format(name, err, tol, status))
+    print("    {0:32s} {1:>12s} {2:>12s} {3:>8s}".format('function', 'reference', engine, 'speedup'))
+    for func_name, func_time in times.items():
+        ref_time = meta['times'].get(func_name)
+        if ref_time is not None:
+            print("    {0:32s} {1:10.4f} s {2:10.4f} s {3:7.2f}x".format(func_name, ref_time, func_time, ref_time/func_time))
+    if len(failures) > 0:
+        print("{0:d} quantities out of tolerance".format(len(failures)))
+    return failures
+
+def check_eval_bundle(golden_dir, N):
+    # Every extension of an evaluation bundle against the product written to its own file
+    aplc, splc = get_golden_designs(golden_dir, N)
+    aplc.get_metrics(verbose=False)
+    eval_kwargs = {'pixscale_lamoD': 1., 'star_diam_vec': np.array([0., 0.1, 0.5]), 'Npts_star_diam': 3, 'Nlam': 3,
+                   'jitter_mas_vec': [1.], 'telap_diam': 10.}
+    eval_dir = aplc.fileorg['eval dir']
+    aplc.fileorg['eval subdir'] = os.path.join(eval_dir, 'check_files')
+    aplc.write_eval_products(**eval_kwargs)
+    aplc.fileorg['eval subdir'] = os.path.join(eval_dir, 'check_bundle')
+    aplc.write_eval_products(bundle=True, **eval_kwargs)
+    file_products = [('STELLAR_INTENS', 'stellar_intens.fits'), ('STAR_DIAMS', 'stellar_intens_diam_list.fits'),
+                     ('OFFAX_PSF', 'offax_psf.fits'), ('OFFAX_OFFSETS', 'offax_psf_offset_list.fits'),
+                     ('SKY_TRANS', 'sky_trans.fits'), ('STELLAR_INTENS_JITTER', 'stellar_intens_jitter_1.00mas.fits')]
+    bundle = scda.EvalBundle(os.path.join(eval_dir, 'check_bundle', 'eval_bundle.fits'))
+    results = []
+    for extname, fname in file_products:
+        ref = scda.pyfits.getdata(os.path.join(eval_dir, 'check_files', fname))
+        results.append((extname, get_error(bundle.get(extname), ref), 0.))
+    for extname, mask in zip(['TELAP', 'APOD', 'FPM', 'LS'], aplc.get_coron_masks(use_gray_gap_zero=False)):
+        results.append((extname, get_error(bundle.get(extname), mask), 0.))
+    missing = set(bundle.extnames()) - set([result[0] for result in results])
+    bundle.close()
+    for extname in sorted(missing):
+        results.append((extname, np.inf, 0.))
+    return results
+
+def check_jitter_independence(golden_dir, N):
+    # The jitter-smeared map of each jitter value alone against the same value in a list of jitters
+    aplc, splc = get_golden_designs(golden_dir, N)
+    jitter_mas_vec = [1., 3., 10.]
+    intens_kwargs = {'telap_diam': 10., 'pixscale_lamoD': 1., 'Nlam': 3}
+    stellar_intens_map = np.zeros((1,) + scda.get_cached_bandavg_aplc_psf(aplc._get_offax_psf_cache(1., 3), 0., 0.).shape)
+    jitter_intens_map = aplc.get_jitter_stellar_intens(jitter_mas_vec, stellar_intens_map, **intens_kwargs)
+    results = []
+    for ji, jitter_mas in enumerate(jitter_mas_vec):
+        alone_intens_map = aplc.get_jitter_stellar_intens([jitter_mas], stellar_intens_map, **intens_kwargs)
+        results.append(("{:.0f}mas".format(jitter_mas), get_error(jitter_intens_map[ji], alone_intens_map[0]), 1e-12))
+    return results
+
+def check_fpm_variant_nominal(golden_dir, N):
+    # The FPM variant with the solved design's parameters against the on-axis PSF, with gray-pixel FPMs made
+    # by scda_masks in place of the binary synthetic ones
+    import scda_masks
+    results = []
+    for coron in get_golden_designs(golden_dir, N):
+        fpm_job = [job for job in scda_masks.get_mask_jobs(coron, overwrite=True) if job[0] == 'FPM'][0]
+        gray_fpm_fname = coron.fileorg['FPM fname'].replace('.dat', '_gray.dat')
+        scda_masks.make_mask_file(('FPM', gray_fpm_fname, fpm_job[2]))
+        coron.fileorg['FPM fname'] = gray_fpm_fname
+        intens_polychrom = coron.get_onax_psf(fp2res=4)[1]
+        xis, intens_maps, mean_contrast, peak_contrast = coron.get_fpm_variant_contrast([{}], fp2res=4)
+        results.append((coron.__class__.__name__, get_error(intens_maps[0], np.mean(intens_polychrom, axis=0)), 1e-8))
+    return results
+
+# Consistency checks of the evaluation functions, each returning (quantity, error, tolerance) triples
+CHECKS = OrderedDict([('eval_bundle', check_eval_bundle),
+                      ('jitter_independence', check_jitter_independence),
+                      ('fpm_variant_nominal', check_fpm_variant_nominal)])
+
+def check(golden_dir, N, check_names):
+    failures = []
+    print("    {0:48s} {1:>10s} {2:>10s}".format('check/quantity', 'error', 'tolerance'))
+    for check_name in check_names:
+        for name, err, tol in CHECKS[check_name](golden_dir, N):
+            status = 'ok'
+            if not err <= tol:
+                status = 'FAIL'
+                failures.append(check_name + '/' + name)
+            print("    {0:48s} {1:10.2e} {2:10.2e} {3:s}".format(check_name + '/' + name, err, tol, status))
+    if len(failures) > 0:
+        print("{0:d} checks failed".format(len(failures)))
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Freeze reference outputs or compare a propagation engine against them")
+    parser.add_argument('action', choices=['freeze', 'compare', 'check'])
+    parser.add_argument('golden_dir', help="directory for the synthetic masks and the frozen outputs")
+    parser.add_argument('--N', type=int, default=125, help="pupil array size of the golden designs (freeze and check only)")
+    parser.add_argument('--engine', default='auto', choices=list(ENGINES.keys()), help="engine to compare (compare only)")
+    parser.add_argument('--tol', nargs='+', default=[], help="tolerance overrides as group=value, e.g. yield=1e-6")
+    parser.add_argument('--checks', nargs='+', default=list(CHECKS.keys()), choices=list(CHECKS.keys()),
+                        help="consistency checks to run (check only)")
+    args = parser.parse_args()
+
+    golden_dir = os.path.abspath(args.golden_dir)
+    if not os.path.exists(golden_dir):
+        os.makedirs(golden_dir)
+    if args.action == 'freeze':
+        freeze(golden_dir, args.N)
+    elif args.action == 'check':
+        if len(check(golden_dir, args.N, args.checks)) > 0:
+            sys.exit(1)
+    else:
+        tol_overrides = dict([(item.split('=')[0], float(item.split('=')[1])) for item in args.tol])
+        if len(compare(golden_dir, args.engine, tol_overrides)) > 0:
+            sys.exit(1)
@@ -0,0 +1,387 @@
+"""
+Generation of the input mask arrays (telescope apertures, Lyot stops, Lyot
+dark zones, and focal plane masks) for the SCDA design classes, replacing
+the make_telap, make_Lyotstop and make_*_FPM notebooks
+
+Every pupil plane mask is binned from one high-resolution master array per
+aperture family (or Lyot stop design) into a pyramid of resolution levels,
+so all sizes of a mask are consistent with each other and with the other
+masks. Telescope aperture levels can be cached on disk and retrieved on
+demand. Feature padding is a morphological erosion of the open area
+with a disk, and the Lyot dark zone is the difference of a dilation and an
+erosion of the Lyot stop, instead of products of many shifted copies.
+"""
+
+import os
+import logging
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+import scipy.ndimage
+import scda
+
+prim_key_map = {'hex1':'hex1', 'hex2':'hex2', 'hex3':'hex3', 'hex4':'hex4',
+                'key24':'keystone24', 'pie08':'piewedge8', 'pie12':'piewedge12',
+                'ochex1':'hex1_outer_circular', 'ochex2':'hex2_outer_circular',
+                'ochex3':'hex3_outer_circular', 'ochex4':'hex4_outer_circular'}
+secobs_key_map = {'Cross':'cross', 'X':'x'}
+# Telescope aperture feature padding for each 'gap' setting, in thousandths of the pupil diameter
+gap_pad_map = {0:0., 1:0.2, 2:1.1, 3:1.8}
+
+telap_source_cache = {} # high-resolution sources loaded in this process, keyed by design parameters and file checksums
+telap_master_cache = {} # padded telescope aperture masters, keyed by aperture family, gap, source checksums and padding
+lyot_stop_master_cache = {} # Lyot stop masters, keyed by their design parameters
+
+def get_disk_footprint(radius):
+    r = int(np.floor(radius))
+    xs = np.arange(-r, r+1)
+    XX, YY = np.meshgrid(xs, xs)
+    return XX**2 + YY**2 <= radius**2
+
+def erode_mask(mask, radius):
+    # Grow the obscured regions of a (gray) mask by radius pixels: a minimum filter over a disk, with fractional
+    # radii blended linearly between the neighboring whole-pixel disks
+    if radius <= 0:
+        return np.array(mask, dtype=float)
+    r_floor = int(np.floor(radius))
+    frac = radius - r_floor
+    eroded = scipy.ndimage.grey_erosion(mask, footprint=get_disk_footprint(r_floor), mode='constant', cval=0.) \
+             if r_floor > 0 else np.array(mask, dtype=float)
+    if frac > 0:
+        eroded_next = scipy.ndimage.grey_erosion(mask, footprint=get_disk_footprint(r_floor + 1), mode='constant', cval=0.)
+        eroded = (1 - frac)*eroded + frac*eroded_next
+    return eroded
+
+def dilate_mask(mask, radius):
+    # Grow the open regions of a mask by radius pixels, the complement of erode_mask()
+    return 1. - erode_mask(1. - np.asarray(mask, dtype=float), radius)
+
+def bin_mask(mask, binfac):
+    # Block-average a square array binfac x binfac, with the block edges aligned on the array center
+    half_L = mask.shape[0]//2
+    K = half_L//binfac
+    mask = mask[half_L-K*binfac:half_L+K*binfac, half_L-K*binfac:half_L+K*binfac]
+    return mask.reshape(2*K, binfac, 2*K, binfac).mean(axis=3).mean(axis=1)
+
+def crop_symm(mask, N, symm):
+    # Quarter-plane (N x N), half-plane (2N x N) or full (2N x 2N) crop around the array center
+    L = mask.shape[0]
+    if symm == 'quart':
+        return mask[L//2:L//2+N, L//2:L//2+N]
+    elif symm == 'half':
+        return mask[L//2-N:L//2+N, L//2:L//2+N]
+    else:
+        return mask[L//2-N:L//2+N, L//2-N:L//2+N]
+
+def get_coords(L):
+    xs = np.linspace(-L/2. + 0.5, L/2. - 0.5, L)
+    return np.meshgrid(xs, xs)
+
+def get_telap_source_fnames(src_dir, prim, secobs, thick, centobs, D=2000):
+    # The JPL offset mask files in src_dir that load_telap_source() composes a telescope aperture from
+    fnames = OrderedDict()
+    if centobs and secobs is not None:
+        fnames['secobs'] = os.path.join(src_dir, "{0:s}_spiders_{1:04d}pix_{2:.1f}cm_offset.fits".format(
+                                        secobs_key_map[secobs], D, int(thick)/10.))
+    if prim == 'circ':
+        if centobs:
+            fnames['key24'] = os.path.join(src_dir, "{0:s}_{1:04d}pix_offset.fits".format(prim_key_map['key24'], D))
+    elif prim in prim_key_map:
+        if centobs:
+            fnames['prim'] = os.path.join(src_dir, "{0:s}_{1:04d}pix_offset.fits".format(prim_key_map[prim], D))
+        else:
+            fnames['prim'] = os.path.join(src_dir, "{0:s}_{1:04d}pix_offset_no_central_obsc.fits".format(prim_key_map[prim], D))
+    else:
+        raise ValueError("No high-resolution source for primary mirror {}".format(prim))
+    return fnames
+
+def get_telap_source_checksums(src_dir, prim, secobs, thick, centobs, D=2000):
+    # Checksums of the source files of a telescope aperture, part of the keys of everything made from them
+    return tuple([scda.get_file_checksum(fname) for fname in get_telap_source_fnames(src_dir, prim, secobs, thick, centobs, D).values()])
+
+def load_telap_source(src_dir, prim, secobs, thick, centobs, D=2000):
+    # High-resolution telescope aperture from the JPL offset masks in src_dir, as composed by make_telap.ipynb:
+    # the primary times the secondary support structure, or the bare primary without a central obscuration
+    source_fnames = get_telap_source_fnames(src_dir, prim, secobs, thick, centobs, D)
+    source_key = (os.path.abspath(src_dir), prim, secobs, thick, bool(centobs), D,
+                  get_telap_source_checksums(src_dir, prim, secobs, thick, centobs, D))
+    if source_key in telap_source_cache:
+        return telap_source_cache[source_key]
+    secobs_array = None
+    if 'secobs' in source_fnames:
+        secobs_array = scda.pyfits.getdata(source_fnames['secobs']).astype(float)
+    if prim == 'circ':
+        L = secobs_array.shape[0] if secobs_array is not None else D
+        Xs, Ys = get_coords(L)
+        prim_array = (Xs**2 + Ys**2 < (D/2.)**2).astype(float)
+        if centobs: # borrow the central obscuration of the keystone aperture, with its segment gaps closed
+            key24 = scda.pyfits.getdata(source_fnames['key24'])
+            prim_array *= crop_symm(dilate_mask(key24, 2), L//2, 'full')
+    else:
+        prim_array = scda.pyfits.getdata(source_fnames['prim']).astype(float)
+    telap = prim_array*secobs_array if secobs_array is not None else prim_array
+    telap_source_cache[source_key] = telap
+    return telap
+
+def get_telap_master_key(src_dir, prim, secobs, thick, centobs, gap, D=2000):
+    # Everything a padded telescope aperture master depends on: the aperture family, the checksums of its
+    # source files, and the padding of the gap setting
+    return (os.path.abspath(src_dir), prim, secobs, thick, bool(centobs), gap, D,
+            get_telap_source_checksums(src_dir, prim, secobs, thick, centobs, D), gap_pad_map[gap])
+
+def get_telap_master(src_dir, prim, secobs, thick, centobs, gap, D=2000):
+    # High-resolution telescope aperture with its features padded for the 'gap' setting, the master from which
+    # every resolution level of the aperture family is binned
+    master_key = get_telap_master_key(src_dir, prim, secobs, thick, centobs, gap, D)
+    if master_key not in telap_master_cache:
+        telap_master_cache[master_key] = erode_mask(load_telap_source(src_dir, prim, secobs, thick, centobs, D), D*gap_pad_map[gap]/1000.)
+    return telap_master_cache[master_key]
+
+def bin_level(master, N, D, symm='full'):
+    # Pyramid level of N points per half diameter from a master sampled at D points across the pupil. Block
+    # averaging preserves the open area and the gray edge pixels, and all masks binned from masters of the same
+    # D share one pixel grid at every level.
+    if (D//2) % N != 0:
+        raise ValueError("N={0:d} does not divide the master half diameter of {1:d} pixels".format(N, D//2))
+    return crop_symm(bin_mask(master, (D//2)//N), N, symm)
+
+def make_telap(src_dir, prim, secobs, thick, centobs, gap, N, symm='quart', D=2000):
+    # Gray-pixel telescope aperture of N points per half diameter, with the features padded for the 'gap' setting
+    return bin_level(get_telap_master(src_dir, prim, secobs, thick, centobs, gap, D), N, D, symm)
+
+def get_telap_pyramid_fname(cache_dir, prim, secobs, thick, centobs, gap, symm='quart', D=2000):
+    return os.path.join(cache_dir, "TelAp_{0:s}_{1:s}{2:s}{3:s}cobs{4:d}gap{5:d}_D{6:04d}_pyramid.npz".format(
+                                   symm, prim, str(secobs), thick, int(centobs), gap, D))
+
+def get_telap_level(src_dir, prim, secobs, thick, centobs, gap, N, symm='quart', cache_dir=None, D=2000):
+    # Level N of the telescope aperture pyramid of an aperture family. The levels built so far are kept in one
+    # .npz file per family in cache_dir, and a missing level is binned from the master and added to it. The file
+    # also stores the source file checksums and padding its levels were made with, and is rebuilt if they changed.
+    if cache_dir is None:
+        return make_telap(src_dir, prim, secobs, thick, centobs, gap, N, symm, D)
+    pyramid_fname = get_telap_pyramid_fname(cache_dir, prim, secobs, thick, centobs, gap, symm, D)
+    master_key = get_telap_master_key(src_dir, prim, secobs, thick, centobs, gap, D)
+    source_sig = np.array(repr(master_key[7:])) # source checksums and padding
+    levels = {}
+    if os.path.exists(pyramid_fname):
+        pyramid = np.load(pyramid_fname)
+        if 'source' in pyramid.files and str(pyramid['source']) == str(source_sig):
+            levels = dict([(key, pyramid[key]) for key in pyramid.files if key != 'source'])
+        else:
+            logging.warning("The source files or padding of {:s} changed, rebuilding its levels".format(pyramid_fname))
+        pyramid.close()
+    level_key = "N{:04d}".format(N)
+    if level_key not in levels:
+        levels[level_key] = make_telap(src_dir, prim, secobs, thick, centobs, gap, N, symm, D)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_fname = pyramid_fname[:-4] + ".{:d}.npz".format(os.getpid())
+        np.savez(tmp_fname, source=source_sig, **levels)
+        os.rename(tmp_fname, pyramid_fname)
+    return levels[level_key]
+
+def make_telap_pyramid(src_dir, prim, secobs, thick, centobs, gap, N_levels=(1000, 500, 250, 125, 50), symm='quart',
+                       cache_dir=None, D=2000):
+    # All the given levels of a telescope aperture pyramid, from one padded master
+    return dict([(N, get_telap_level(src_dir, prim, secobs, thick, centobs, gap, N, symm, cache_dir, D)) for N in N_levels])
+
+def get_lyot_stop_master(shape, iD, oD, obscure=0, pad=0, src_dir=None, prim=None, secobs=None, thick='025', centobs=True,
+                         D=2000):
+    # Full-plane binary Lyot stop sampled at D points across the pupil, the master of its resolution levels.
+    # The inner and outer diameters iD and oD are in percent of the pupil diameter. The outer edge is a circle
+    # ('ann'), a hexagon ('hex') or the undersized aperture perimeter (a primary mirror key). With obscure = 1
+    # or 2 the stop also blocks the secondary support structure, or the whole aperture, padded by pad
+    # thousandths of the diameter.
+    master_key = (shape, iD, oD, obscure, pad, src_dir and os.path.abspath(src_dir), prim, secobs, thick, bool(centobs), D)
+    if master_key in lyot_stop_master_cache:
+        return lyot_stop_master_cache[master_key]
+    inD = iD/100.
+    outD = oD/100.
+    if shape in ('ann', 'hex') and obscure == 0:
+        L = D
+    else:
+        telap = load_telap_source(src_dir, prim if prim is not None else 'circ', secobs, thick, centobs, D)
+        L = telap.shape[0]
+    Xs, Ys = get_coords(L)
+    if shape in prim_key_map: # undersize the aperture perimeter, with the segment gaps closed
+        perim = dilate_mask(load_telap_source(src_dir, shape, secobs, thick, False, D), 1)
+        w = int(round(D*(1. - outD)/2))
+        outer = np.ones(perim.shape)
+        for ang in np.arange(0, 360, 60):
+            outer = np.minimum(outer, np.roll(np.roll(perim, int(round(w*np.cos(np.deg2rad(ang)))), 1),
+                                              int(round(w*np.sin(np.deg2rad(ang)))), 0))
+    elif shape == 'hex':
+        outer = np.maximum(np.abs(Ys), np.abs(Xs)*np.sqrt(3)/2 + np.abs(Ys)/2) <= outD*D/2
+    else:
+        outer = Xs**2 + Ys**2 < (outD*D/2)**2
+    LS = outer*(Xs**2 + Ys**2 > (inD*D/2)**2)
+    if obscure == 1 and secobs is not None: # block the secondary support structure
+        secobs_array = scda.pyfits.getdata(os.path.join(src_dir, "{0:s}_spiders_{1:04d}pix_{2:.1f}cm_offset.fits".format(
+                                           secobs_key_map[secobs], D, int(thick)/10.))).astype(float)
+        LS = LS*np.round(erode_mask(crop_symm(secobs_array, L//2, 'full'), int(round(D*pad/1000.))))
+    elif obscure == 2: # block all aperture features
+        LS = LS*np.round(erode_mask(telap, int(round(D*pad/1000.))))
+    lyot_stop_master_cache[master_key] = LS.astype(bool) # binary, so kept compact
+    return lyot_stop_master_cache[master_key]
+
+def make_lyot_stop(N, shape, iD, oD, symm='quart', obscure=0, pad=0, src_dir=None, prim=None, secobs=None, thick='025',
+                   centobs=True, D=2000, ss=4):
+    # Lyot stop level of N points per half diameter binned from its master (see get_lyot_stop_master), as the
+    # full-plane gray array and its crop for the symmetry. An analytic stop whose N doesn't divide the master
+    # sampling is sampled at ss x ss points per pixel instead.
+    if shape in ('ann', 'hex') and obscure == 0 and (D//2) % N != 0:
+        D = 2*N*ss
+    LS_full = bin_level(get_lyot_stop_master(shape, iD, oD, obscure, pad, src_dir, prim, secobs, thick, centobs, D), N, D)
+    return LS_full, crop_symm(LS_full, N, symm)
+
+def make_lyot_dark_zone(LS_full, N, aligntol, symm='quart'):
+    # Lyot plane dark zone for a stop alignment tolerance of +/- aligntol thousandths of the pupil diameter:
+    # the region swept by the edges of the binary stop, i.e. its dilation minus its erosion by the tolerance
+    LS_bin = np.round(LS_full)
+    dz_width = int(np.ceil(2*N*aligntol/1000.))
+    fat_LS = erode_mask(LS_bin, dz_width)
+    thin_LS = dilate_mask(LS_bin, dz_width)
+    LDZ = np.logical_xor(thin_LS > 0.5, fat_LS > 0.5).astype(int)
+    return crop_symm(LDZ, N, symm)
+
+def get_gray_quarter(M, binfac, is_open):
+    # Gray-pixel quarter-plane mask of M x M points, from the open area fraction of binfac x binfac subpixels.
+    # is_open takes subpixel coordinates in mask pixels from the array center. Sampled one row at a time to keep
+    # the supersampled grid small.
+    sub_xs = (np.arange(M*binfac) + 0.5)/binfac
+    quarter = np.empty((M, M))
+    for ii in range(M):
+        Xs, Ys = np.meshgrid(sub_xs, ii + (np.arange(binfac) + 0.5)/binfac)
+        quarter[ii] = is_open(Xs, Ys).reshape(binfac, M, binfac).mean(axis=2).mean(axis=0)
+    return quarter
+
+def make_occspot_fpm(M, binfac=100):
+    # Quarter of a gray-pixel occulting spot spanning 2M points across. A fractional M, the spot radius on a
+    # grid of another resolution, gives a quarter of ceil(M) points.
+    return get_gray_quarter(int(np.ceil(M)), binfac, lambda Xs, Ys: Xs**2 + Ys**2 <= M**2)
+
+def make_diaphragm_fpm(R0, R1, fpmres, openang=180, orient='H', binfac=100):
+    # Quarter of a gray-pixel annular diaphragm between R0 and R1 lambda0/D sampled at fpmres points per lambda0/D,
+    # optionally restricted to a bowtie opening of openang degrees oriented horizontally ('H') or vertically ('V')
+    M = int(np.ceil(fpmres*R1))
+    def is_open(Xs, Ys):
+        RR2 = Xs**2 + Ys**2
+        FPM = (RR2 > (fpmres*R0)**2) & (RR2 < (fpmres*R1)**2)
+        if openang < 180:
+            theta = np.rad2deg(np.arctan2(Ys, Xs))
+            if orient == 'V':
+                FPM &= theta > openang/2.
+            else:
+                FPM &= theta < openang/2.
+        return FPM
+    return get_gray_quarter(M, binfac, is_open)
+
+def get_symm(coron):
+    if isinstance(coron, (scda.QuarterplaneAPLC, scda.QuarterplaneSPLC)):
+        return 'quart'
+    elif isinstance(coron, (scda.HalfplaneAPLC, scda.HalfplaneSPLC)):
+        return 'half'
+    return 'full'
+
+def get_mask_jobs(coron, src_dir=None, overwrite=False):
+    # Mask files of a design that are missing (or all of them, with overwrite), as (kind, file name, parameters)
+    # tuples for make_mask_file()
+    if isinstance(coron, scda.AxisymAPLC): # no input mask files
+        return []
+    jobs = []
+    pupil = coron.design['Pupil']
+    symm = get_symm(coron)
+    gray_gap_zero_fname = coron.fileorg['TelAp fname'].replace('gap{:d}'.format(pupil['gap']), 'gap0')
+    for fname, gap in ((coron.fileorg['TelAp fname'], pupil['gap']), (gray_gap_zero_fname, 0)):
+        jobs.append(('TelAp', fname, {'src_dir': src_dir, 'prim': pupil['prim'], 'secobs': pupil['secobs'],
+                                      'thick': pupil['thick'], 'centobs': pupil['centobs'], 'gap': gap,
+                                      'N': pupil['N'], 'symm': symm}))
+    if isinstance(coron, scda.SPLC):
+        jobs.append(('FPM', coron.fileorg['FPM fname'], {'R0': coron.design['FPM']['R0'], 'R1': coron.design['FPM']['R1'],
+                                                         'fpmres': coron.design['FPM']['fpmres'],
+                                                         'openang': coron.design['FPM']['openang'],
+                                                         'orient': coron.design['FPM']['orient']}))
+        N_LS = coron.design['LS']['N']
+    else:
+        jobs.append(('FPM', coron.fileorg['FPM fname'], {'M': coron.design['FPM']['M']}))
+        N_LS = pupil['N']
+    LS_params = {'N': N_LS, 'shape': coron.design['LS']['shape'], 'iD': coron.design['LS']['id'],
+                 'oD': coron.design['LS']['od'], 'symm': symm, 'obscure': coron.design['LS']['obscure'],
+                 'pad': coron.design['LS']['pad'], 'src_dir': src_dir, 'prim': pupil['prim'], 'secobs': pupil['secobs'],
+                 'thick': pupil['thick'], 'centobs': pupil['centobs']}
+    jobs.append(('LS', coron.fileorg['LS fname'], LS_params))
+    if coron.design['LS']['aligntol'] is not None:
+        jobs.append(('LDZ', coron.fileorg['LDZ fname'], dict(LS_params, aligntol=coron.design['LS']['aligntol'])))
+    return [job for job in jobs if overwrite or not os.path.exists(job[1])]
+
+def make_mask_file(job):
+    # Build and write one mask file. Returns the file name, or None if it could not be made.
+    kind, fname, params = job
+    try:
+        if kind == 'TelAp':
+            mask = make_telap(params['src_dir'], params['prim'], params['secobs'], params['thick'], params['centobs'],
+                              params['gap'], params['N'], params['symm'])
+            fmt = '%.6f'
+        elif kind == 'FPM':
+            if 'M' in params:
+                mask = make_occspot_fpm(params['M'])
+            else:
+                mask = make_diaphragm_fpm(params['R0'], params['R1'], params['fpmres'], params['openang'], params['orient'])
+            fmt = '%.6f'
+        else:
+            LS_params = dict([(key, val) for key, val in params.items() if key != 'aligntol'])
+            LS_full, mask = make_lyot_stop(**LS_params)
+            if kind == 'LDZ':
+                mask = make_lyot_dark_zone(LS_full, params['N'], params['aligntol'], params['symm'])
+            else:
+                mask = np.round(mask)
+            fmt = '%d'
+    except (IOError, OSError, ValueError, KeyError, TypeError) as err:
+        logging.error("Could not make {0:s}: {1:s}".format(fname, str(err)))
+        return None
+    if not os.path.exists(os.path.dirname(os.path.abspath(fname))):
+        os.makedirs(os.path.dirname(os.path.abspath(fname)))
+    np.savetxt(fname, mask, fmt=fmt, delimiter=" ")
+    logging.info("Wrote {0:s} array to {1:s}".format(kind, fname))
+    return fname
+
+def get_master_key(job):
+    # Jobs with the same key are levels of one master: the telescope apertures of an aperture family and gap, or
+    # the Lyot stops and dark zones of one stop design
+    kind, fname, params = job
+    if kind == 'FPM':
+        return (kind, fname)
+    level_params = [(key, val) for key, val in sorted(params.items()) if key not in ('N', 'aligntol')]
+    return ('TelAp' if kind == 'TelAp' else 'LS', tuple(level_params))
+
+def make_mask_group(job_group):
+    # Make the files of one master's levels in one process, so the master is built once
+    return [make_mask_file(job) for job in job_group]
+
+def make_missing_masks(coron_list, src_dir=None, Nproc=None, overwrite=False):
+    # Make the missing mask files of a list of designs, each file once, in parallel over Nproc processes (default
+    # all cores). The files binned from the same master, e.g. one aperture at several N, go to the same process.
+    # Returns the list of files written.
+    jobs = {}
+    for coron in coron_list:
+        for job in get_mask_jobs(coron, src_dir, overwrite):
+            jobs[job[1]] = job
+    job_groups = OrderedDict()
+    for fname in sorted(jobs):
+        job_groups.setdefault(get_master_key(jobs[fname]), []).append(jobs[fname])
+    job_groups = list(job_groups.values())
+    if len(job_groups) == 0:
+        return []
+    if Nproc is None:
+        Nproc = multiprocessing.cpu_count()
+    Nproc = min(Nproc, len(job_groups))
+    if Nproc > 1:
+        pool = multiprocessing.Pool(Nproc)
+        try:
+            written = pool.map(make_mask_group, job_groups, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        written = [make_mask_group(job_group) for job_group in job_groups]
+    return [fname for group_written in written for fname in group_written if fname is not None]
@@ -26,6 +26,9 @@ OUTPUTS
 newly submitted, and how many programs in the survey have been submitted so
 far.
 
+* Converts each finished solution to a compact binary copy (same name, extension
+.npz), which the evaluation functions read instead of the text file.
+
 * Creates a text file containing a crontab command, if it doesn't already exist.
 This crontab file will have the same name as the survey, minus the .pkl
 extension, and prepended with "crontab_". For the above example, the cron file
@@ -85,6 +88,8 @@ max_submission_count = QUEUE_MAX - qcount
 new_submission_count = 0
 if new_submission_count < max_submission_count:
     for coron in survey.coron_list:
+        if getattr(coron, 'screen_status', None) is not None: # pruned by the feasibility screen
+            continue
         if coron.ampl_submission_status is not True:
             try:
                 subprocess.check_call("sbatch {0:s}".format(coron.fileorg['slurm fname']), shell=True)
@@ -98,21 +103,36 @@ if new_submission_count < max_submission_count:
         if new_submission_count == max_submission_count:
             break
 
-# Tally all submissions to date, check for the existence of solution files, and update the corresponding statuses
+# Tally all submissions to date, check for the existence of solution files, and update the corresponding statuses.
+# File status comes from one listing per directory rather than a stat call per file.
+status_index = scda.file_status_index
+status_index.refresh()
 overall_submission_count = 0
 solution_count = 0
 queue_timeout_count = 0
+screened_count = 0
 for coron in survey.coron_list:
+    if getattr(coron, 'screen_status', None) is not None:
+        screened_count += 1
     if coron.ampl_submission_status is True:
         overall_submission_count += 1
-        if os.path.exists(coron.fileorg['sol fname']):
-            sol_mode = os.stat(coron.fileorg['sol fname']).st_mode
+        if status_index.exists(coron.fileorg['sol fname']):
+            sol_mode = status_index.stat(coron.fileorg['sol fname']).st_mode
             if not bool(stat.S_IRGRP & sol_mode):
                 os.chmod(coron.fileorg['sol fname'], 0644)
             coron.solution_status = True
             solution_count += 1
+            # Convert the text solution to the compact binary copy read by the evaluation functions.
+            # A solution still being written fails to parse or goes stale, and is converted on a later run.
+            try:
+                if not scda.binary_solution_is_current(coron.fileorg['sol fname']):
+                    bin_sol_fname = scda.write_binary_solution(coron.fileorg['sol fname'])
+                    os.chmod(bin_sol_fname, 0644)
+            except (IOError, OSError, ValueError):
+                print("Could not convert {0:s} to the binary solution format".format(coron.fileorg['sol fname']))
+                sys.stdout.flush()
 
-            if os.path.exists(coron.fileorg['log fname']):
+            if status_index.exists(coron.fileorg['log fname']):
                 if hasattr(coron, 'ampl_completion_time') and coron.solver['method'] == 'barhom':
                     log = open(coron.fileorg['log fname'])
                     lines = log.readlines()
@@ -121,23 +141,35 @@ for coron in survey.coron_list:
                             split_line = line.split()
                             coron.ampl_completion_time = float(split_line[split_line.index('seconds')-1])/3600
                             break
-                log_mode = os.stat(coron.fileorg['log fname']).st_mode
+                log_mode = status_index.stat(coron.fileorg['log fname']).st_mode
                 if not bool(stat.S_IRGRP & log_mode):
                     os.chmod(coron.fileorg['log fname'], 0644)
-        elif os.path.exists(coron.fileorg['log fname']):
+        elif status_index.exists(coron.fileorg['log fname']):
             if 'TIME LIMIT' in open(coron.fileorg['log fname']).read():
                 print("Queue timeout indicated in log:")
                 print("          {0:s}".format(coron.fileorg['log fname']))
                 sys.stdout.flush()
                 queue_timeout_count += 1
-            log_mode = os.stat(coron.fileorg['log fname']).st_mode
+            log_mode = status_index.stat(coron.fileorg['log fname']).st_mode
             if not bool(stat.S_IRGRP & log_mode):
                 os.chmod(coron.fileorg['log fname'], 0644)
 
 print("{0:d} out of {1:d} optimization jobs in the survey have been submitted, {2:d} have solutions, and {3:d} logs indicate a queue timeout.".format(
        overall_submission_count, survey.N_combos, solution_count, queue_timeout_count))
-
-if solution_count == survey.N_combos or (new_submission_count == 0 and qcount == 0):
+if screened_count > 0:
+    print("{0:d} designs were pruned by the feasibility screen and will not be submitted.".format(screened_count))
+
+refined = False
+if isinstance(survey, scda.AdaptiveDesignParamSurvey) and not survey.converged and solution_count + screened_count == survey.N_combos:
+    new_corons = survey.refine()
+    if len(new_corons) > 0:
+        refined = True
+        print("Refined the adaptive survey grid, {0:d} new designs to submit:".format(len(new_corons)))
+        for coron in new_corons:
+            print("          {0:s}".format(coron.fileorg['slurm fname']))
+        sys.stdout.flush()
+
+if not refined and (solution_count + screened_count == survey.N_combos or (new_submission_count == 0 and qcount == 0)):
     print("Done! Computing metrics...")
     survey.get_metrics(verbose=False)
     print("Got the metrics")